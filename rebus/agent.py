@@ -105,9 +105,66 @@ class Agent(object):
     def get(self, desc_domain, selector):
         return self.bus.get(self.id, desc_domain, selector)
 
+    def get_many(self, desc_domain, selectors, with_values=False):
+        """
+        Returns a list containing, for each selector, a Descriptor or None.
+
+        :param with_values: if True, values are fetched in bulk too, instead
+            of being fetched one by one when they are first read
+        """
+        descs = self.bus.get_many(self.id, desc_domain, selectors)
+        if with_values:
+            lazy = [desc for desc in descs
+                    if desc is not None and desc.bus is not None]
+            values = self.bus.get_values_many(
+                self.id, desc_domain, [desc.selector for desc in lazy])
+            for desc, value in zip(lazy, values):
+                desc.value = value
+                desc.bus = None
+        return descs
+
+    def get_values_many(self, desc_domain, selectors):
+        return self.bus.get_values_many(self.id, desc_domain, selectors)
+
     def find(self, domain, selector_regex, limit):
         return self.bus.find(self.id, domain, selector_regex, limit)
 
+    def iter_find_pages(self, domain, selector_regex, limit=0,
+                        page_size=1000):
+        """
+        Yields lists of selectors matching selector_regex, from most recent
+        to oldest, one list per page fetched from the bus.
+
+        :param limit: max number of selectors to yield. Unlimited if 0.
+        :param page_size: number of selectors requested at once
+        """
+        cursor = ''
+        while True:
+            size = page_size if limit == 0 else min(page_size, limit)
+            selectors, cursor = self.bus.find_page(
+                self.id, domain, selector_regex, size, cursor)
+            if selectors:
+                yield selectors
+            if limit != 0:
+                limit -= len(selectors)
+                if limit <= 0:
+                    return
+            if not cursor:
+                return
+
+    def iter_find(self, domain, selector_regex, limit=0, page_size=1000):
+        """
+        Yields selectors matching selector_regex, from most recent to oldest.
+        Selectors are fetched from the bus page by page.
+
+        :param limit: max number of selectors to yield. Unlimited if 0.
+        :param page_size: number of selectors requested at once
+        """
+        for selectors in self.iter_find_pages(domain, selector_regex, limit,
+                                              page_size):
+            for selector in selectors:
+                yield selector
+
     def list_uuids(self, desc_domain):
         return self.bus.list_uuids(self.id, desc_domain)
 
@@ -238,7 +295,11 @@ class Agent(object):
             # processing has already been started by another instance of
             # the same agent having the same configuration
             return False
-        desc = self.get(desc_domain, selector)
+        # fetch the descriptor and those of other slots at once
+        selectors = [selector] + list(set(slots.itervalues()) -
+                                      set([selector]))
+        descs = dict(zip(selectors, self.get_many(desc_domain, selectors)))
+        desc = descs[selector]
         if desc is None:
             # that would be a bug
             self.log.warning(
@@ -246,9 +307,7 @@ class Agent(object):
                 "%s)", desc_domain, selector, sender_id, request_id)
             return False
 
-        additional_descs = {k: self.get(desc_domain, s)
-                            if s != selector else
-                            desc for k, s in slots.iteritems()}
+        additional_descs = {k: descs[s] for k, s in slots.iteritems()}
         if not self.descriptor_filter(desc, **additional_descs):
             return False
         # TODO detect infinite loops ?
@@ -22,16 +22,17 @@ class Cat(Agent):
 
     def run(self):
         for selregex in self.config['selectors']:
-            sels = self.find(self.domain, selregex, self.config['max_number'])
-            if len(sels) > 0:
-                for s in sels:
-                    desc = self.get(self.domain, s)
-                    if desc:
+            # values are fetched and written one page at a time
+            for sels in self.iter_find_pages(self.domain, selregex,
+                                             self.config['max_number']):
+                values = self.get_values_many(self.domain, sels)
+                for s, value in zip(sels, values):
+                    if value is not None:
                         if self.config['raw']:
-                            sys.stdout.write(str(desc.value))
+                            sys.stdout.write(str(value))
                         else:
-                            sys.stdout.write(desc.selector+":\n")
-                            sys.stdout.write(str(desc.value))
+                            sys.stdout.write(s+":\n")
+                            sys.stdout.write(str(value))
                             sys.stdout.write("\n")
                     else:
                         self.log.warning("selector [%s:%s] not found",
@@ -29,10 +29,12 @@ class LinkFinder(Agent):
         self.prefix = self.config['selector_prefix']
         # make sure all known descriptors are recorded in self.memories
         # useful in case the agent is re-started
-        for desc in self.bus.find_by_selector(
-                self.id, self.domain, self.prefix):
-            pth, hsh = desc.selector.split('%', 1)
-            val = self._calc_val(desc)
+        selectors = [desc.selector for desc in self.bus.find_by_selector(
+            self.id, self.domain, self.prefix)]
+        values = self.get_values_many(self.domain, selectors)
+        for selector, value in zip(selectors, values):
+            pth, hsh = selector.split('%', 1)
+            val = self._calc_val(value)
             key = (pth, val)
             self.memories[key].add(hsh)
 
@@ -41,22 +43,22 @@ class LinkFinder(Agent):
         if descriptor.domain != self.domain:
             return
         pth, hsh = sel.split('%', 1)
-        val = self._calc_val(descriptor)
+        val = self._calc_val(descriptor.value)
         key = (pth, val)
         if key in self.memories:
             related = self.memories[key]
             self.log.debug("%r related to %r", sel, related)
-            for r in related:
-                rel_sel = pth+'%'+r
-                rel_desc = self.get(self.domain, rel_sel)
+            rel_descs = self.get_many(self.domain,
+                                      [pth+'%'+r for r in related])
+            for rel_desc in rel_descs:
                 linktype = pth.strip("/").replace("/", "-")
                 self.declare_link(descriptor, rel_desc, linktype,
                                   "Same value on %s" % pth, isSymmetric=True)
         self.memories[key].add(hsh)
 
-    def _calc_val(self, desc):
+    def _calc_val(self, value):
         try:
-            val = str(desc.value)
+            val = str(value)
             if len(val) < 200:
                 return val
             else:
@@ -54,8 +54,7 @@ class LinkGrapher(Agent):
                 yield fmt % i
                 i += 1
 
-        for s in sels:
-            link = self.get(self.domain, s)
+        for link in self.get_many(self.domain, list(sels), with_values=True):
             uu1, uu2 = link.uuid, link.value["otherUUID"]
             linktype = link.value["linktype"]
             labels[uu1] = link.label
@@ -19,12 +19,12 @@ class Ls(Agent):
     def run(self):
         done = set()
         for regex in self.config['selectors']:
-            sels = self.find(self.domain, regex, self.config['limit'])
-            if len(sels) > 0:
-                for s in sels:
-                    if s not in done:
-                        sys.stdout.write(s+"\n")
-                        done.add(s)
-            else:
+            found = False
+            for s in self.iter_find(self.domain, regex, self.config['limit']):
+                found = True
+                if s not in done:
+                    sys.stdout.write(s+"\n")
+                    done.add(s)
+            if not found:
                 self.log.warning("selector [%s:%s] not found",
                                  self.domain, regex)
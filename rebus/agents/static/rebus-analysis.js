@@ -199,6 +199,25 @@ $(document).on('click', function(event) {
                 }
         });
     }
+    if (target.hasClass('lineageicon')) {
+        p = target.parent();
+        pp = p.parent();
+        params = {'domain': unescape(pp.attr('data-domain')), 'selector': unescape(pp.attr('data-selector'))};
+        $.ajax({
+            url: '/lineage',
+            type: 'POST',
+            dataType: 'text',
+            data: params,
+            success: function(response) {
+                p.popover('destroy');
+                p.popover({
+                    content: response,
+                    html: true,
+                    trigger: 'focus'});
+                p.popover('show');
+            }
+        });
+    }
     if (target.hasClass('request-process-link')) {
         pp = target.closest('.container-key');
         params = {'domain': unescape(pp.attr('data-domain')), 'selector': unescape(pp.attr('data-selector')), 'targets': [target.text()]};
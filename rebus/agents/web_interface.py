@@ -274,6 +274,7 @@ class Application(tornado.web.Application):
             (r"/agents", AgentsHandler),
             (r"/processing/list_processors", ProcessingListHandler),
             (r"/processing/request", ProcessingRequestsHandler),
+            (r"/lineage", LineageHandler),
         ]
         params = {
             'static_path': os.path.join(os.path.dirname(__file__), 'static'),
@@ -462,12 +463,15 @@ class AnalysisListHandler(tornado.web.RequestHandler):
 class SelectorsHandler(tornado.web.RequestHandler):
     @tornado.web.asynchronous
     def get(self):
-        self.application.async.async_find(
-            self.get_selectors_cb,
-            self.get_argument('domain', 'default'), '/.*', 100)
+        self.domain = self.get_argument('domain', 'default')
+        self.application.async.async_find_page(
+            self.get_selectors_cb, self.domain, '/.*', 100,
+            self.get_argument('cursor', ''))
 
-    def get_selectors_cb(self, sels):
-        self.render('selectors.html', selectors=sorted(sels))
+    def get_selectors_cb(self, page):
+        sels, cursor = page
+        self.render('selectors.html', selectors=sorted(sels),
+                    domain=self.domain, cursor=cursor)
 
 
 class MonitorHandler(tornado.web.RequestHandler):
@@ -635,6 +639,38 @@ class ProcessingRequestsHandler(tornado.web.RequestHandler):
         self.finish()
 
 
+class LineageHandler(tornado.web.RequestHandler):
+    """
+    Lists precursors and descendants of this descriptor, up to max_depth
+    generations away (default: 3, 0 for unlimited). Selectors are fetched
+    from the storage's lineage index, descriptors are not retrieved.
+    """
+    @tornado.web.asynchronous
+    def post(self, *args, **kwargs):
+        self.domain = str(self.get_argument('domain'))
+        self.selector = str(self.get_argument('selector'))
+        try:
+            self.max_depth = int(self.get_argument('max_depth', '3'))
+        except ValueError:
+            self.send_error(400)
+            return
+        self.application.async.async_get_ancestors(
+            self.ancestors_cb, self.domain, self.selector, self.max_depth)
+
+    def ancestors_cb(self, ancestors):
+        self.ancestors = ancestors
+        self.application.async.async_get_descendants(
+            self.descendants_cb, self.domain, self.selector, self.max_depth)
+
+    def descendants_cb(self, descendants):
+        if self.request.connection.stream.closed():
+            return
+        self.finish(self.render_string('lineage_popover.html',
+                                       domain=self.domain,
+                                       ancestors=self.ancestors,
+                                       descendants=descendants))
+
+
 class AgentsHandler(tornado.web.RequestHandler):
     """
     Displays information about agents.
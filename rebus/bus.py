@@ -1,4 +1,5 @@
 from rebus.tools.registry import Registry
+from rebus.tools.value_reader import ValueReader
 import time
 
 DEFAULT_DOMAIN = "default"
@@ -105,6 +106,87 @@ class Bus(object):
         """
         raise NotImplementedError
 
+    def get_many(self, agent_id, desc_domain, selectors):
+        """
+        Gets several Descriptor objects from the bus. Returns a list
+        containing, for each selector, a Descriptor, or None if it was not
+        found.
+
+        This implementation calls get() for each selector; slave buses fetch
+        descriptors in chunks, as described in rebus.tools.chunks.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptors being fetched belong to
+        :param selectors: list of selectors of the descriptors being fetched
+        """
+        return [self.get(agent_id, desc_domain, selector) for selector in
+                selectors]
+
+    def get_values_many(self, agent_id, desc_domain, selectors):
+        """
+        Returns a list containing, for each selector, the descriptor's value,
+        or None if it was not found.
+
+        This implementation calls get_value() for each selector; slave buses
+        fetch values in chunks, as described in rebus.tools.chunks.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptors being fetched belong to
+        :param selectors: list of selectors of the descriptors being fetched
+        """
+        return [self.get_value(agent_id, desc_domain, selector) for selector
+                in selectors]
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        """
+        Returns part of a descriptor's value: value[offset:offset+length].
+
+        Returns None if the descriptor was not found.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptor being fetched belongs to
+        :param selector: selector of the descriptor being fetched
+        :param offset: position of the first byte to return
+        :param length: max number of bytes to return
+        """
+        raise NotImplementedError
+
+    def get_value_size(self, agent_id, desc_domain, selector):
+        """
+        Returns the length of a descriptor's value.
+
+        Returns None if the descriptor was not found.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptor being fetched belongs to
+        :param selector: selector of the descriptor being fetched
+        """
+        raise NotImplementedError
+
+    def open_value(self, agent_id, desc_domain, selector,
+                   block_size=1024*1024):
+        """
+        Returns a read-only file-like object giving access to a descriptor's
+        value, which is fetched by parts of at least block_size bytes.
+        May be used with modules such as tarfile or zipfile.
+
+        Returns None if the descriptor was not found.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the descriptor being fetched belongs to
+        :param selector: selector of the descriptor being fetched
+        :param block_size: minimum size of fetched parts
+        """
+        size = self.get_value_size(agent_id, desc_domain, selector)
+        if size is None:
+            return None
+
+        def read_range(offset, length):
+            return self.get_value_range(agent_id, desc_domain, selector,
+                                        offset, length) or ''
+        return ValueReader(read_range, size, selector, block_size)
+
     def list_uuids(self, agent_id, desc_domain):
         """
         Returns a dictionary mapping known UUIDs to corresponding labels.
@@ -149,6 +231,40 @@ class Bus(object):
         """
         raise NotImplementedError
 
+    def find_page(self, agent_id, desc_domain, selector_regex, limit,
+                  cursor=''):
+        """
+        Returns (selectors, cursor): a page of at most *limit* selectors, as
+        returned by find(), and an opaque cursor string from which the next
+        page may be requested. The returned cursor is '' once all matching
+        selectors have been returned.
+
+        :param agent_id: current agent id
+        :param desc_domain: string, domain in which the search is performed
+        :param selector_regex: string, regex
+        :param limit: int, max number of selectors to return
+        :param cursor: string, cursor returned along the previous page, or ''
+            for the first page
+        """
+        raise NotImplementedError
+
+    def find_by_selector_page(self, agent_id, desc_domain, selector_prefix,
+                              limit, cursor=''):
+        """
+        Returns (descriptors, cursor): a page of at most *limit* descriptors,
+        as returned by find_by_selector(), and an opaque cursor string from
+        which the next page may be requested. The returned cursor is '' once
+        all matching descriptors have been returned.
+
+        :param agent_id: current agent id
+        :param desc_domain: domain the Descriptors being searched belong to
+        :param selector_prefix: search prefix for the Descriptors
+        :param limit: int, max number of descriptors to return
+        :param cursor: string, cursor returned along the previous page, or ''
+            for the first page
+        """
+        raise NotImplementedError
+
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         """
         Returns a list of descriptors whose uuid match given parameter.
@@ -238,6 +354,34 @@ class Bus(object):
         """
         raise NotImplementedError
 
+    def get_descendants(self, agent_id, desc_domain, selector, max_depth=0):
+        """
+        Returns a list of (selector, depth) of descriptors that have been
+        spawned from given selector, directly (depth 1) or not, in
+        breadth-first order. Descriptors are not fetched.
+
+        :param agent_id: current agent id
+        :param desc_domain: string, domain of the descriptor
+        :param selector: string, selector containing a hash
+        :param max_depth: int, max depth of returned descendants. Unlimited
+            if 0.
+        """
+        raise NotImplementedError
+
+    def get_ancestors(self, agent_id, desc_domain, selector, max_depth=0):
+        """
+        Returns a list of (selector, depth) of precursors of given selector
+        (depth 1), their precursors (depth 2), etc., in breadth-first order.
+        Descriptors are not fetched.
+
+        :param agent_id: current agent id
+        :param desc_domain: string, domain of the descriptor
+        :param selector: string, selector containing a hash
+        :param max_depth: int, max depth of returned ancestors. Unlimited if
+            0.
+        """
+        raise NotImplementedError
+
     def store_internal_state(self, agent_id, state):
         """
         Called by agents that need their serialized internal state to be
@@ -14,6 +14,7 @@ from rebus.tools.serializer import b64serializer as serializer
 from rebus.busmaster import BusMaster
 from rebus.tools.sched import Sched
 from rebus.tools import format_check
+from rebus.tools.chunks import CHUNK_SELECTORS, bounded_results
 
 
 log = logging.getLogger("rebus.bus")
@@ -237,6 +238,73 @@ class DBusMaster(dbus.service.Object, BusMaster):
             return ""
         return serializer.dumps(value)
 
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='ssas', out_signature='as')
+    def get_many(self, agent_id, desc_domain, selectors):
+        log.debug("GET_MANY: %s %s (%d selectors)", agent_id, desc_domain,
+                  len(selectors))
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        selectors = [str(selector) for selector in selectors[:CHUNK_SELECTORS]]
+        valid = [selector for selector in selectors
+                 if format_check.is_valid_selector(selector)]
+        descs = dict(zip(valid, self.store.get_many(str(desc_domain), valid)))
+
+        def serialize(selector):
+            desc = descs.get(selector)
+            if desc is None:
+                return ""
+            return desc.serialize_meta(serializer)
+        return bounded_results(selectors, serialize)
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='ssas', out_signature='as')
+    def get_values_many(self, agent_id, desc_domain, selectors):
+        log.debug("GETVALUES_MANY: %s %s (%d selectors)", agent_id,
+                  desc_domain, len(selectors))
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+
+        def serialize(selector):
+            if not format_check.is_valid_selector(selector):
+                return ""
+            value = self.store.get_value(str(desc_domain), str(selector))
+            if value is None:
+                return ""
+            return serializer.dumps(value)
+        # values are read one at a time, so that values that do not fit in
+        # the reply are not read
+        return bounded_results(selectors[:CHUNK_SELECTORS], serialize)
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sssxx', out_signature='s')
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        log.debug("GETVALUERANGE: %s %s:%s [%d:+%d]", agent_id, desc_domain,
+                  selector, offset, length)
+        if not format_check.is_valid_domain(desc_domain):
+            return ""
+        if not format_check.is_valid_selector(selector):
+            return ""
+        value = self.store.get_value_range(str(desc_domain), str(selector),
+                                           int(offset), int(length))
+        if value is None:
+            return ""
+        return serializer.dumps(value)
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sss', out_signature='x')
+    def get_value_size(self, agent_id, desc_domain, selector):
+        log.debug("GETVALUESIZE: %s %s:%s", agent_id, desc_domain, selector)
+        if not format_check.is_valid_domain(desc_domain):
+            return -1
+        if not format_check.is_valid_selector(selector):
+            return -1
+        size = self.store.get_value_size(str(desc_domain), str(selector))
+        if size is None:
+            return -1
+        return size
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='ss', out_signature='a{ss}')
     def list_uuids(self, agent_id, desc_domain):
@@ -268,6 +336,34 @@ class DBusMaster(dbus.service.Object, BusMaster):
             str(desc_domain), str(selector_prefix), int(limit), int(offset))
         return [desc.serialize_meta(serializer) for desc in descs]
 
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sssus', out_signature='ass')
+    def find_page(self, agent_id, desc_domain, selector_regex, limit,
+                  cursor):
+        log.debug("FIND_PAGE: %s %s:%s (max %d after %r)", agent_id,
+                  desc_domain, selector_regex, limit, cursor)
+        if not format_check.is_valid_domain(desc_domain):
+            return [], ''
+        if not format_check.is_valid_cursor(cursor):
+            return [], ''
+        selectors, cursor = self.store.find_page(
+            str(desc_domain), str(selector_regex), int(limit), str(cursor))
+        return [str(s) for s in selectors], cursor
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sssus', out_signature='ass')
+    def find_by_selector_page(self, agent_id, desc_domain, selector_prefix,
+                              limit, cursor):
+        log.debug("FINDBYSELECTOR_PAGE: %s %s %s (max %d after %r)",
+                  agent_id, desc_domain, selector_prefix, limit, cursor)
+        if not format_check.is_valid_domain(desc_domain):
+            return [], ''
+        if not format_check.is_valid_cursor(cursor):
+            return [], ''
+        descs, cursor = self.store.find_by_selector_page(
+            str(desc_domain), str(selector_prefix), int(limit), str(cursor))
+        return [desc.serialize_meta(serializer) for desc in descs], cursor
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='sss', out_signature='as')
     def find_by_uuid(self, agent_id, desc_domain, uuid):
@@ -361,6 +457,30 @@ class DBusMaster(dbus.service.Object, BusMaster):
                                         recurse=bool(recurse))
         return [desc.serialize_meta(serializer) for desc in descs]
 
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sssi', out_signature='a(si)')
+    def get_descendants(self, agent_id, desc_domain, selector, max_depth):
+        log.debug("GET_DESCENDANTS: %s %s:%s (depth %d)", agent_id,
+                  desc_domain, selector, max_depth)
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        if not format_check.is_valid_fullselector(selector):
+            return []
+        return list(self.store.get_descendants(str(desc_domain),
+                                               str(selector), max_depth))
+
+    @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
+                         in_signature='sssi', out_signature='a(si)')
+    def get_ancestors(self, agent_id, desc_domain, selector, max_depth):
+        log.debug("GET_ANCESTORS: %s %s:%s (depth %d)", agent_id,
+                  desc_domain, selector, max_depth)
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        if not format_check.is_valid_fullselector(selector):
+            return []
+        return list(self.store.get_ancestors(str(desc_domain), str(selector),
+                                             max_depth))
+
     @dbus.service.method(dbus_interface='com.airbus.rebus.bus',
                          in_signature='ss', out_signature='')
     def store_internal_state(self, agent_id, state):
@@ -12,6 +12,7 @@ from rebus.agent import Agent
 from rebus.bus import Bus, DEFAULT_DOMAIN
 from rebus.descriptor import Descriptor
 from rebus.tools.serializer import b64serializer as serializer
+from rebus.tools.chunks import fetch_in_chunks
 log = logging.getLogger("rebus.bus.dbus")
 DEFAULT_BUS = "(local dbus instance)"
 
@@ -143,6 +144,36 @@ class DBus(Bus):
             return None
         return Descriptor.unserialize_value(serializer, result)
 
+    def get_many(self, agent_id, desc_domain, selectors):
+        def fetch(chunk):
+            return [Descriptor.unserialize(serializer, str(s), bus=self)
+                    if str(s) else None for s in
+                    self.iface.get_many(str(agent_id), desc_domain, chunk)]
+        return fetch_in_chunks(selectors, fetch)
+
+    def get_values_many(self, agent_id, desc_domain, selectors):
+        def fetch(chunk):
+            values = self.iface.get_values_many(str(agent_id), desc_domain,
+                                                chunk)
+            return [Descriptor.unserialize_value(serializer, str(s))
+                    if str(s) else None for s in values]
+        return fetch_in_chunks(selectors, fetch)
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        result = str(self.iface.get_value_range(str(agent_id), desc_domain,
+                                                selector, offset, length))
+        if result == "":
+            return None
+        return Descriptor.unserialize_value(serializer, result)
+
+    def get_value_size(self, agent_id, desc_domain, selector):
+        size = int(self.iface.get_value_size(str(agent_id), desc_domain,
+                                             selector))
+        if size < 0:
+            return None
+        return size
+
     def list_uuids(self, agent_id, desc_domain):
         return {str(k): str(v) for k, v in
                 self.iface.list_uuids(str(agent_id), desc_domain).items()}
@@ -159,6 +190,19 @@ class DBus(Bus):
         return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
                 dlist]
 
+    def find_page(self, agent_id, desc_domain, selector_regex, limit,
+                  cursor=''):
+        slist, cursor = self.iface.find_page(
+            str(agent_id), desc_domain, selector_regex, limit, cursor)
+        return [str(i) for i in slist], str(cursor)
+
+    def find_by_selector_page(self, agent_id, desc_domain, selector_prefix,
+                              limit, cursor=''):
+        dlist, cursor = self.iface.find_by_selector_page(
+            str(agent_id), desc_domain, selector_prefix, limit, cursor)
+        return ([Descriptor.unserialize(serializer, str(s), bus=self) for s in
+                 dlist], str(cursor))
+
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         dlist = self.iface.find_by_uuid(str(agent_id), desc_domain, uuid)
         return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
@@ -195,6 +239,16 @@ class DBus(Bus):
                 self.iface.get_children(str(agent_id), desc_domain, selector,
                                         recurse)]
 
+    def get_descendants(self, agent_id, desc_domain, selector, max_depth=0):
+        return [(str(sel), int(depth)) for sel, depth in
+                self.iface.get_descendants(str(agent_id), desc_domain,
+                                           selector, max_depth)]
+
+    def get_ancestors(self, agent_id, desc_domain, selector, max_depth=0):
+        return [(str(sel), int(depth)) for sel, depth in
+                self.iface.get_ancestors(str(agent_id), desc_domain,
+                                         selector, max_depth)]
+
     def store_internal_state(self, agent_id, state):
         self.iface.store_internal_state(str(agent_id), state)
 
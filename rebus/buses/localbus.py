@@ -112,6 +112,27 @@ class LocalBus(Bus):
         log.info("GET: %s %s:%s", agent_id, desc_domain, selector)
         return self.store.get_value(desc_domain, selector)
 
+    def get_many(self, agent_id, desc_domain, selectors):
+        log.debug("GET_MANY: %s %s (%d selectors)", agent_id, desc_domain,
+                  len(selectors))
+        return self.store.get_many(desc_domain, selectors)
+
+    def get_values_many(self, agent_id, desc_domain, selectors):
+        log.debug("GETVALUES_MANY: %s %s (%d selectors)", agent_id,
+                  desc_domain, len(selectors))
+        return self.store.get_values_many(desc_domain, selectors)
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        log.debug("GETVALUERANGE: %s %s:%s [%d:+%d]", agent_id, desc_domain,
+                  selector, offset, length)
+        return self.store.get_value_range(desc_domain, selector, offset,
+                                          length)
+
+    def get_value_size(self, agent_id, desc_domain, selector):
+        log.debug("GETVALUESIZE: %s %s:%s", agent_id, desc_domain, selector)
+        return self.store.get_value_size(desc_domain, selector)
+
     def list_uuids(self, agent_id, desc_domain):
         log.debug("LISTUUIDS: %s %s", agent_id, desc_domain)
         return self.store.list_uuids(desc_domain)
@@ -128,6 +149,20 @@ class LocalBus(Bus):
         return self.store.find_by_selector(desc_domain, selector_prefix, limit,
                                            offset)
 
+    def find_page(self, agent_id, desc_domain, selector_regex, limit,
+                  cursor=''):
+        log.debug("FIND_PAGE: %s %s:%s (max %d after %r)", agent_id,
+                  desc_domain, selector_regex, limit, cursor)
+        return self.store.find_page(desc_domain, selector_regex, limit,
+                                    cursor)
+
+    def find_by_selector_page(self, agent_id, desc_domain, selector_prefix,
+                              limit, cursor=''):
+        log.debug("FINDBYSELECTOR_PAGE: %s %s %s (max %d after %r)",
+                  agent_id, desc_domain, selector_prefix, limit, cursor)
+        return self.store.find_by_selector_page(desc_domain, selector_prefix,
+                                                limit, cursor)
+
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         log.debug("FINDBYUUID: %s %s:%s", agent_id, desc_domain, uuid)
         return self.store.find_by_uuid(desc_domain, uuid)
@@ -172,6 +207,18 @@ class LocalBus(Bus):
         return list(self.store.get_children(desc_domain, selector,
                                             recurse))
 
+    def get_descendants(self, agent_id, desc_domain, selector, max_depth=0):
+        log.debug("GET_DESCENDANTS: %s %s:%s (depth %d)", agent_id,
+                  desc_domain, selector, max_depth)
+        return list(self.store.get_descendants(desc_domain, selector,
+                                               max_depth))
+
+    def get_ancestors(self, agent_id, desc_domain, selector, max_depth=0):
+        log.debug("GET_ANCESTORS: %s %s:%s (depth %d)", agent_id,
+                  desc_domain, selector, max_depth)
+        return list(self.store.get_ancestors(desc_domain, selector,
+                                             max_depth))
+
     def store_internal_state(self, agent_id, state):
         log.debug("STORE_INTSTATE: %s", agent_id)
         if self.store.STORES_INTSTATE:
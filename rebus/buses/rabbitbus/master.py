@@ -13,6 +13,7 @@ import rebus.tools.serializer as serializer
 from rebus.busmaster import BusMaster
 from rebus.tools.sched import Sched
 from rebus.tools import format_check
+from rebus.tools.chunks import CHUNK_SELECTORS, bounded_results
 
 log = logging.getLogger("rebus.bus")
 
@@ -141,10 +142,16 @@ class RabbitBusMaster(BusMaster):
              'push': self.push,
              'get': self.get,
              'get_value': self.get_value,
+             'get_value_range': self.get_value_range,
+             'get_value_size': self.get_value_size,
              'list_uuids': self.list_uuids,
              'find': self.find,
              'find_by_uuid': self.find_by_uuid,
              'find_by_selector': self.find_by_selector,
+             'get_many': self.get_many,
+             'get_values_many': self.get_values_many,
+             'find_page': self.find_page,
+             'find_by_selector_page': self.find_by_selector_page,
              'find_by_value': self.find_by_value,
              'mark_processed': self.mark_processed,
              'mark_processable': self.mark_processable,
@@ -152,6 +159,8 @@ class RabbitBusMaster(BusMaster):
              'list_agents': self.list_agents,
              'processed_stats': self.processed_stats,
              'get_children': self.get_children,
+             'get_descendants': self.get_descendants,
+             'get_ancestors': self.get_ancestors,
              'store_internal_state': self.store_internal_state,
              'load_internal_state': self.load_internal_state,
              'request_processing': self.request_processing,
@@ -370,6 +379,73 @@ class RabbitBusMaster(BusMaster):
             return ""
         return serializer.dumps(value)
 
+    def get_many(self, agent_id, desc_domain, selectors):
+        log.debug("GET_MANY: %s %s (%d selectors)", agent_id, desc_domain,
+                  len(selectors))
+        if not self._check_agent_id(agent_id):
+            return []
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        selectors = [str(selector) for selector in selectors[:CHUNK_SELECTORS]]
+        valid = [selector for selector in selectors
+                 if format_check.is_valid_selector(selector)]
+        descs = dict(zip(valid, self.store.get_many(str(desc_domain), valid)))
+
+        def serialize(selector):
+            desc = descs.get(selector)
+            if desc is None:
+                return ""
+            return desc.serialize_meta(serializer)
+        return bounded_results(selectors, serialize)
+
+    def get_values_many(self, agent_id, desc_domain, selectors):
+        log.debug("GETVALUES_MANY: %s %s (%d selectors)", agent_id,
+                  desc_domain, len(selectors))
+        if not self._check_agent_id(agent_id):
+            return []
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+
+        def serialize(selector):
+            if not format_check.is_valid_selector(selector):
+                return ""
+            value = self.store.get_value(str(desc_domain), str(selector))
+            if value is None:
+                return ""
+            return serializer.dumps(value)
+        # values are read one at a time, so that values that do not fit in
+        # the reply are not read
+        return bounded_results(selectors[:CHUNK_SELECTORS], serialize)
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        log.debug("GETVALUERANGE: %s %s:%s [%d:+%d]", agent_id, desc_domain,
+                  selector, offset, length)
+        if not self._check_agent_id(agent_id):
+            return None
+        if not format_check.is_valid_domain(desc_domain):
+            return None
+        if not format_check.is_valid_selector(selector):
+            return None
+        value = self.store.get_value_range(str(desc_domain), str(selector),
+                                           offset, length)
+        if value is None:
+            return ""
+        return serializer.dumps(value)
+
+    def get_value_size(self, agent_id, desc_domain, selector):
+        log.debug("GETVALUESIZE: %s %s:%s", agent_id, desc_domain, selector)
+        if not self._check_agent_id(agent_id):
+            return -1
+        if not format_check.is_valid_domain(desc_domain):
+            return -1
+        if not format_check.is_valid_selector(selector):
+            return -1
+        size = self.store.get_value_size(str(desc_domain), str(selector))
+        if size is None:
+            return -1
+        return size
+
     def list_uuids(self, agent_id, desc_domain):
         log.debug("LISTUUIDS: %s %s", agent_id, desc_domain)
         if not self._check_agent_id(agent_id):
@@ -400,6 +476,33 @@ class RabbitBusMaster(BusMaster):
             str(desc_domain), str(selector_prefix), int(limit), int(offset))
         return [desc.serialize_meta(serializer) for desc in descs]
 
+    def find_page(self, agent_id, desc_domain, selector_regex, limit,
+                  cursor=''):
+        log.debug("FIND_PAGE: %s %s:%s (max %d after %r)", agent_id,
+                  desc_domain, selector_regex, limit, cursor)
+        if not self._check_agent_id(agent_id):
+            return [], ''
+        if not format_check.is_valid_domain(desc_domain):
+            return [], ''
+        if not format_check.is_valid_cursor(cursor):
+            return [], ''
+        return self.store.find_page(
+            str(desc_domain), str(selector_regex), int(limit), str(cursor))
+
+    def find_by_selector_page(self, agent_id, desc_domain, selector_prefix,
+                              limit, cursor=''):
+        log.debug("FINDBYSELECTOR_PAGE: %s %s %s (max %d after %r)",
+                  agent_id, desc_domain, selector_prefix, limit, cursor)
+        if not self._check_agent_id(agent_id):
+            return [], ''
+        if not format_check.is_valid_domain(desc_domain):
+            return [], ''
+        if not format_check.is_valid_cursor(cursor):
+            return [], ''
+        descs, cursor = self.store.find_by_selector_page(
+            str(desc_domain), str(selector_prefix), int(limit), str(cursor))
+        return [desc.serialize_meta(serializer) for desc in descs], cursor
+
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         log.debug("FINDBYUUID: %s %s:%s", agent_id, desc_domain, uuid)
         if not self._check_agent_id(agent_id):
@@ -489,9 +592,33 @@ class RabbitBusMaster(BusMaster):
             return []
         if not format_check.is_valid_fullselector(selector):
             return []
-        return list(self.store.get_children(str(desc_domain), str(selector),
-                                            serializer=serializer,
-                                            recurse=bool(recurse)))
+        descs = self.store.get_children(str(desc_domain), str(selector),
+                                        recurse=bool(recurse))
+        return [desc.serialize_meta(serializer) for desc in descs]
+
+    def get_descendants(self, agent_id, desc_domain, selector, max_depth):
+        log.debug("GET_DESCENDANTS: %s %s:%s (depth %d)", agent_id,
+                  desc_domain, selector, max_depth)
+        if not self._check_agent_id(agent_id):
+            return []
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        if not format_check.is_valid_fullselector(selector):
+            return []
+        return list(self.store.get_descendants(str(desc_domain),
+                                               str(selector), max_depth))
+
+    def get_ancestors(self, agent_id, desc_domain, selector, max_depth):
+        log.debug("GET_ANCESTORS: %s %s:%s (depth %d)", agent_id,
+                  desc_domain, selector, max_depth)
+        if not self._check_agent_id(agent_id):
+            return []
+        if not format_check.is_valid_domain(desc_domain):
+            return []
+        if not format_check.is_valid_fullselector(selector):
+            return []
+        return list(self.store.get_ancestors(str(desc_domain), str(selector),
+                                             max_depth))
 
     def store_internal_state(self, agent_id, state):
         if not self._check_agent_id(agent_id):
@@ -10,6 +10,7 @@ from rebus.agent import Agent
 from rebus.bus import Bus, DEFAULT_DOMAIN
 from rebus.descriptor import Descriptor
 import rebus.tools.serializer as serializer
+from rebus.tools.chunks import fetch_in_chunks
 
 
 log = logging.getLogger("rebus.bus.rabbitbus")
@@ -172,6 +173,17 @@ class RabbitBus(Bus):
                 'selector': selector}
         return self.send_rpc("get_value", args)
 
+    def rpc_get_value_range(self, agent_id, desc_domain, selector, offset,
+                            length):
+        args = {'agent_id': self.agent.id, 'desc_domain': desc_domain,
+                'selector': selector, 'offset': offset, 'length': length}
+        return self.send_rpc("get_value_range", args)
+
+    def rpc_get_value_size(self, agent_id, desc_domain, selector):
+        args = {'agent_id': self.agent.id, 'desc_domain': desc_domain,
+                'selector': selector}
+        return self.send_rpc("get_value_size", args)
+
     def rpc_list_uuids(self, agent_id, desc_domain):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain}
         return self.send_rpc("list_uuids", args)
@@ -190,6 +202,28 @@ class RabbitBus(Bus):
                 offset}
         return self.send_rpc("find_by_selector", args)
 
+    def rpc_find_page(self, agent_id, desc_domain, selector_regex, limit,
+                      cursor):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("find_page", args)
+
+    def rpc_find_by_selector_page(self, agent_id, desc_domain,
+                                  selector_prefix, limit, cursor):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("find_by_selector_page", args)
+
+    def rpc_get_many(self, agent_id, desc_domain, selectors):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("get_many", args)
+
+    def rpc_get_values_many(self, agent_id, desc_domain, selectors):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("get_values_many", args)
+
     def rpc_find_by_uuid(self, agent_id, desc_domain, uuid):
         args = {'agent_id': agent_id, 'desc_domain': desc_domain,
                 'uuid': uuid}
@@ -229,6 +263,17 @@ class RabbitBus(Bus):
         args.pop('self', None)
         return self.send_rpc("get_children", args)
 
+    def rpc_get_descendants(self, agent_id, desc_domain, selector,
+                            max_depth):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("get_descendants", args)
+
+    def rpc_get_ancestors(self, agent_id, desc_domain, selector, max_depth):
+        args = locals()
+        args.pop('self', None)
+        return self.send_rpc("get_ancestors", args)
+
     def rpc_store_internal_state(self, agent_id, state):
         args = locals()
         args.pop('self', None)
@@ -326,6 +371,35 @@ class RabbitBus(Bus):
             return None
         return Descriptor.unserialize_value(serializer, result)
 
+    def get_many(self, agent_id, desc_domain, selectors):
+        def fetch(chunk):
+            return [Descriptor.unserialize(serializer, str(s), bus=self)
+                    if str(s) else None for s in
+                    self.rpc_get_many(str(agent_id), desc_domain, chunk)]
+        return fetch_in_chunks(selectors, fetch)
+
+    def get_values_many(self, agent_id, desc_domain, selectors):
+        def fetch(chunk):
+            values = self.rpc_get_values_many(str(agent_id), desc_domain,
+                                              chunk)
+            return [Descriptor.unserialize_value(serializer, str(s))
+                    if str(s) else None for s in values]
+        return fetch_in_chunks(selectors, fetch)
+
+    def get_value_range(self, agent_id, desc_domain, selector, offset,
+                        length):
+        result = str(self.rpc_get_value_range(str(agent_id), desc_domain,
+                                              selector, offset, length))
+        if result == "":
+            return None
+        return Descriptor.unserialize_value(serializer, result)
+
+    def get_value_size(self, agent_id, desc_domain, selector):
+        size = self.rpc_get_value_size(str(agent_id), desc_domain, selector)
+        if size < 0:
+            return None
+        return size
+
     def list_uuids(self, agent_id, desc_domain):
         return {str(k): v.encode('utf-8') for k, v in
                 self.rpc_list_uuids(str(agent_id), desc_domain).items()}
@@ -342,6 +416,19 @@ class RabbitBus(Bus):
         return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
                 dlist]
 
+    def find_page(self, agent_id, desc_domain, selector_regex, limit,
+                  cursor=''):
+        slist, cursor = self.rpc_find_page(str(agent_id), desc_domain,
+                                           selector_regex, limit, cursor)
+        return [str(i) for i in slist], str(cursor)
+
+    def find_by_selector_page(self, agent_id, desc_domain, selector_prefix,
+                              limit, cursor=''):
+        dlist, cursor = self.rpc_find_by_selector_page(
+            str(agent_id), desc_domain, selector_prefix, limit, cursor)
+        return ([Descriptor.unserialize(serializer, str(s), bus=self) for s in
+                 dlist], str(cursor))
+
     def find_by_uuid(self, agent_id, desc_domain, uuid):
         dlist = self.rpc_find_by_uuid(str(agent_id), desc_domain, uuid)
         return [Descriptor.unserialize(serializer, str(s), bus=self) for s in
@@ -378,6 +465,16 @@ class RabbitBus(Bus):
                 self.rpc_get_children(str(agent_id), desc_domain, selector,
                                       recurse)]
 
+    def get_descendants(self, agent_id, desc_domain, selector, max_depth=0):
+        return [(str(sel), int(depth)) for sel, depth in
+                self.rpc_get_descendants(str(agent_id), desc_domain,
+                                         selector, max_depth)]
+
+    def get_ancestors(self, agent_id, desc_domain, selector, max_depth=0):
+        return [(str(sel), int(depth)) for sel, depth in
+                self.rpc_get_ancestors(str(agent_id), desc_domain, selector,
+                                       max_depth)]
+
     def store_internal_state(self, agent_id, state):
         self.rpc_store_internal_state(str(agent_id), state)
 
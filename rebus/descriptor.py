@@ -181,6 +181,15 @@ class Descriptor(object):
              if k in ["label", "selector", "value", "domain", "agent",
                       "precursors", "version", "processing_time", "uuid"]})
 
+    def meta_dict(self):
+        """
+        Returns a dictionary of descriptor attributes, without its value.
+        Descriptor(**desc.meta_dict()) is a copy of desc, without its value.
+        """
+        return {k: getattr(self, k) for k in dir(self)
+                if k in ["label", "selector", "domain", "agent", "precursors",
+                         "version", "processing_time", "uuid"]}
+
     def serialize_meta(self, serializer):
         """
         Serialize descriptor, without its value.
@@ -188,10 +197,7 @@ class Descriptor(object):
         # FIXME dumps may return non-ascii characters ("extended" ascii, "8-bit
         # ascii") which may result in invalid UTF-8, thus causing errors when
         # using dbus
-        return serializer.dumps(
-            {k: getattr(self, k) for k in dir(self)
-             if k in ["label", "selector", "domain", "agent", "precursors",
-                      "version", "processing_time", "uuid"]})
+        return serializer.dumps(self.meta_dict())
 
     def serialize_value(self, serializer):
         """
@@ -1,14 +1,44 @@
 #!/usr/bin/env python2
+from rebus.tools.lineage import breadth_first, summarize
 from rebus.tools.registry import Registry
+from rebus.tools.selector_index import literal_prefix, prefix_upper_bound
+import os
 import threading
 import re
 import sqlite3
+import time
+from contextlib import contextmanager
+from Queue import Queue
 
 
 class StorageRegistry(Registry):
     pass
 
 
+def parse_cursor(cursor):
+    """
+    Returns the integer position encoded in a pagination cursor, None if
+    cursor is empty (first page).
+
+    Raises ValueError if cursor is invalid.
+    """
+    if not cursor:
+        return None
+    if not cursor.isdigit():
+        raise ValueError("Invalid cursor %r" % cursor)
+    return int(cursor)
+
+
+def make_cursor(position):
+    """
+    Returns a pagination cursor encoding an integer position. Returns '' if
+    position is None (no more results).
+    """
+    if position is None:
+        return ''
+    return str(position)
+
+
 class Storage(object):
     _name_ = "Storage"
     _desc_ = "N/A"
@@ -56,6 +86,48 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def find_page(self, domain, selector_regex, limit, cursor=''):
+        """
+        Return (selectors, cursor): a page of at most *limit* selectors, as
+        returned by find(), and an opaque cursor from which the next page may
+        be requested. The returned cursor is '' if there are no more results.
+
+        :param domain: string, domain in which the search is performed
+        :param selector_regex: string, regex
+        :param limit: int, max number of selectors to return. Unlimited if 0.
+        :param cursor: string, cursor returned along the previous page, or ''
+            for the first page
+
+        This implementation relies on find()'s offset; backends override it
+        so that the cost of fetching a page does not depend on its position.
+        """
+        offset = parse_cursor(cursor) or 0
+        selectors = self.find(domain, selector_regex, limit, offset)
+        if limit == 0 or len(selectors) < limit:
+            return selectors, ''
+        return selectors, make_cursor(offset + len(selectors))
+
+    def find_by_selector_page(self, domain, selector_prefix, limit,
+                              cursor=''):
+        """
+        Return (descriptors, cursor): a page of at most *limit* descriptors,
+        as returned by find_by_selector(), and an opaque cursor from which the
+        next page may be requested. The returned cursor is '' if there are no
+        more results.
+
+        :param domain: string, domain in which the search is performed
+        :param selector_prefix: string
+        :param limit: int, max number of descriptors to return. Unlimited if
+            0.
+        :param cursor: string, cursor returned along the previous page, or ''
+            for the first page
+        """
+        offset = parse_cursor(cursor) or 0
+        descs = self.find_by_selector(domain, selector_prefix, limit, offset)
+        if limit == 0 or len(descs) < limit:
+            return descs, ''
+        return descs, make_cursor(offset + len(descs))
+
     def find_by_uuid(self, domain, uuid):
         """
         Return a list of descriptors whose uuid match given parameter.
@@ -97,6 +169,20 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def list_selectors(self):
+        """
+        Return the list of (domain, selector) of all stored descriptors, in
+        insertion order within each domain (or within each shard, for
+        sharded backends).
+        """
+        raise NotImplementedError
+
+    def list_agent_states(self):
+        """
+        Return the list of names of agents whose internal state is stored.
+        """
+        raise NotImplementedError
+
     def get_descriptor(self, domain, selector):
         """
         Get a single descriptor.
@@ -123,6 +209,71 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def get_many(self, domain, selectors):
+        """
+        Get several descriptors. Return a list containing, for each selector,
+        the descriptor as returned by get_descriptor(), or None if it could
+        not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selectors: list of strings
+        """
+        return [self.get_descriptor(domain, selector) for selector in
+                selectors]
+
+    def get_values_many(self, domain, selectors):
+        """
+        Get several selectors' values. Return a list containing, for each
+        selector, its value, or None if it could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selectors: list of strings, selectors containing a hash
+        """
+        return [self.get_value(domain, selector) for selector in selectors]
+
+    def get_value_buffer(self, domain, selector):
+        """
+        Get a selector's value, as an object supporting len() and slicing
+        (ex. a str, or a read-only mmap) - backends may avoid reading or
+        copying the whole value.
+
+        Returns None if descriptor could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        """
+        return self.get_value(domain, selector)
+
+    def get_value_range(self, domain, selector, offset, length):
+        """
+        Get part of a selector's value: value[offset:offset+length].
+
+        Returns None if descriptor could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        :param offset: int, position of the first byte to return
+        :param length: int, max number of bytes to return
+        """
+        value = self.get_value_buffer(domain, selector)
+        if value is None:
+            return None
+        return value[offset:offset+length]
+
+    def get_value_size(self, domain, selector):
+        """
+        Get the length of a selector's value.
+
+        Returns None if descriptor could not be found.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string
+        """
+        value = self.get_value_buffer(domain, selector)
+        if value is None:
+            return None
+        return len(value)
+
     def get_children(self, domain, selector, recurse=True):
         """
         Return a set of children descriptors from given selector.
@@ -133,6 +284,56 @@ class Storage(object):
         """
         raise NotImplementedError
 
+    def get_descendants(self, domain, selector, max_depth=0):
+        """
+        Yield (selector, depth) of descriptors that have been spawned from
+        given selector, directly (depth 1) or not, in breadth-first order.
+        Descriptors are not unserialized by backends that maintain a lineage
+        index.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string, selector containing a hash
+        :param max_depth: int, max depth of returned descendants. Unlimited
+            if 0.
+        """
+        def children(sel):
+            return [desc.selector for desc in
+                    self.get_children(domain, sel, recurse=False)]
+        return breadth_first(selector, children, max_depth)
+
+    def get_ancestors(self, domain, selector, max_depth=0):
+        """
+        Yield (selector, depth) of precursors of given selector (depth 1),
+        their precursors (depth 2), etc., in breadth-first order.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string, selector containing a hash
+        :param max_depth: int, max depth of returned ancestors. Unlimited if
+            0.
+        """
+        def precursors(sel):
+            desc = self.get_descriptor(domain, sel)
+            return desc.precursors if desc else ()
+        return breadth_first(selector, precursors, max_depth)
+
+    def ancestry_summary(self, domain, selector):
+        """
+        Return the ancestry summary of a stored descriptor, as described in
+        rebus.tools.lineage: for each selector prefix, the set of depths at
+        which it occurs among the descriptor and its ancestors. Return None
+        if the descriptor or one of its ancestors is not stored.
+
+        Backends that maintain a lineage index compute summaries when
+        descriptors are added; this implementation walks all ancestors.
+
+        :param domain: string, domain on which operations are performed
+        :param selector: string, selector containing a hash
+        """
+        def precursors_of(sel):
+            desc = self.get_descriptor(domain, sel)
+            return desc.precursors if desc else None
+        return summarize(selector, precursors_of, lambda sel: sel, {})
+
     def add(self, descriptor):
         """
         Add new descriptor to storage. Return False if descriptor was already
@@ -225,6 +426,44 @@ class Storage(object):
         """
         pass
 
+    def close(self):
+        """
+        May be used to release files, databases and background threads once
+        the storage is no longer used. Storing state is up to the caller.
+        """
+        pass
+
+    def collect_garbage(self, limit=0, resume=False):
+        """
+        Remove descriptors that have expired according to the backend's
+        retention rules, along with their index entries and processed state.
+        Returns the number of removed descriptors.
+
+        :param limit: int, max number of descriptors to remove. Unlimited if
+            0.
+        :param resume: if True, resume the scan of stored descriptors where
+            the previous call stopped, instead of starting a new one. Returns
+            0 if that scan has ended.
+        """
+        return 0
+
+    def cache_stats(self):
+        """
+        Return a dictionary of counters describing the backend's in-memory
+        cache (entries, size, hits, misses, evictions, hit_ratio...), or an
+        empty dictionary if it has none.
+        """
+        return {}
+
+    def dedup_stats(self):
+        """
+        Return a dictionary of counters describing deduplication of stored
+        values (references, unique_values, logical_bytes, stored_bytes,
+        ratio), or an empty dictionary if the backend does not deduplicate
+        values. get_value() is not affected by deduplication.
+        """
+        return {}
+
     def list_unprocessed_by_agent(self, agent_name, config_txt):
         """
         Return a list of (domain, uuid, selector) that have not been processed
@@ -244,11 +483,104 @@ class Storage(object):
         pass
 
 
+def _regexp(pattern, string):
+    return re.match(pattern, string) is not None
+
+
 class MetadataDB(object):
-    def __init__(self, db_path):
+    def __init__(self, db_path, commit_batch=1, commit_interval=1.0,
+                 readers=4, read_only=False):
+        """
+        :param db_path: path to the sqlite3 database file
+        :param commit_batch: max number of inserts grouped in a transaction.
+            If > 1, inserts are written behind: they are committed once
+            commit_batch inserts are pending, or when the oldest pending insert
+            is older than commit_interval seconds, whichever comes first.
+        :param commit_interval: max age in seconds of uncommitted inserts, in
+            write-behind mode.
+        :param readers: number of read-only connections used by queries, so
+            that they neither wait for nor block inserts. If 0, queries use
+            the writer connection.
+        :param read_only: if True, the database, which must have been created
+            by a writer, is only queried: its schema is neither created nor
+            migrated, and inserts fail.
+        """
+        self.read_only = read_only
+        if read_only and not os.path.isfile(db_path):
+            raise IOError('Database %s does not exist' % db_path)
         self._dblock = threading.RLock()
-        self._db = sqlite3.connect(db_path)
+        # The connection is shared with the flushing thread, and always used
+        # while holding self._dblock
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
         self._cursor = self._db.cursor()
+        if read_only:
+            # before any other statement, so that nothing is written
+            self._cursor.execute('PRAGMA query_only=1')
+        else:
+            self._cursor.execute('PRAGMA journal_mode=WAL')
+        self.commit_batch = max(1, commit_batch)
+        self.commit_interval = commit_interval
+        #: Number of inserts that have not been committed yet
+        self._pending = 0
+        #: Time at which the oldest uncommitted insert has been performed
+        self._pending_since = 0
+        self._flusher = None
+        if self.commit_batch > 1 and not read_only:
+            # Durability is ensured by explicit flushes; WAL checkpoints still
+            # keep the database consistent
+            self._cursor.execute('PRAGMA synchronous=NORMAL')
+            self._closing = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_loop)
+            self._flusher.daemon = True
+            self._flusher.start()
+        if not read_only:
+            self._create_tables()
+        self._db.create_function('REGEXP', 2, _regexp)
+
+        #: Pool of read-only connections. Thanks to write-ahead logging,
+        #: they see committed data while inserts are being performed.
+        self._readers = None
+        if readers > 0:
+            self._readers = Queue()
+            for _ in range(readers):
+                db = sqlite3.connect(db_path, check_same_thread=False)
+                db.execute('PRAGMA query_only=1')
+                db.create_function('REGEXP', 2, _regexp)
+                self._readers.put(db)
+
+    @contextmanager
+    def _reading(self, commit_pending=False):
+        """
+        Yields a cursor for read-only queries, on a pooled read-only
+        connection. Inserts that have not been committed yet are only seen by
+        the writer connection, which is used instead (holding self._dblock)
+        while some are pending.
+
+        :param commit_pending: commit pending inserts first, so that a long
+            query does not hold self._dblock
+        """
+        if commit_pending and self._pending:
+            self.flush()
+        # inserts performed by other threads once _pending has been read
+        # are concurrent with this query, which may not see them
+        if self._pending or self._readers is None:
+            with self._dblock:
+                cursor = self._db.cursor()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+            return
+        db = self._readers.get()
+        cursor = db.cursor()
+        try:
+            yield cursor
+        finally:
+            # ends the read transaction, which would prevent checkpoints
+            cursor.close()
+            self._readers.put(db)
+
+    def _create_tables(self):
         self._cursor.execute(
             'CREATE TABLE IF NOT EXISTS processed(domain TEXT, selector TEXT, '
             'agent_name TEXT, config_txt TEXT)')
@@ -260,20 +592,150 @@ class MetadataDB(object):
         self._cursor.execute(
             'CREATE UNIQUE INDEX IF NOT EXISTS no_selector_dups ON '
             'selectors(domain, selector)')
+        # Counters used by processed_stats, kept up to date by inserts and
+        # removals
+        counted = self._cursor.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND "
+            "name='processed_counts'").fetchone()[0]
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS selector_counts(domain TEXT PRIMARY '
+            'KEY, count INTEGER)')
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS processed_counts(domain TEXT, '
+            'agent_name TEXT, count INTEGER, PRIMARY KEY(domain, agent_name))')
+        if not counted:
+            # database created by a former version
+            self._count_selectors_by_domain()
+            self._cursor.execute(
+                'INSERT INTO processed_counts(domain, agent_name, count) '
+                'SELECT domain, agent_name, COUNT(DISTINCT selector) FROM '
+                'processed GROUP BY domain, agent_name')
         self._db.commit()
 
-        def regex_function(pattern, string):
-            return re.match(pattern, string) is None
+    def _inserted(self):
+        """
+        Called after each insert, while holding self._dblock. Commits
+        pending inserts if the current transaction is full.
+        """
+        if self._pending == 0:
+            self._pending_since = time.time()
+        self._pending += 1
+        if self._pending >= self.commit_batch:
+            self.flush()
+
+    def _flush_loop(self):
+        """
+        Commits inserts that have been pending for more than
+        self.commit_interval seconds. Runs in a separate thread.
+        """
+        while not self._closing.wait(self.commit_interval / 2.):
+            with self._dblock:
+                if self._pending and time.time() - self._pending_since >= \
+                        self.commit_interval:
+                    self.flush()
+
+    def flush(self):
+        """
+        Commit pending inserts.
+        """
+        with self._dblock:
+            if self._pending:
+                self._db.commit()
+                self._pending = 0
+
+    def close(self):
+        if self._flusher:
+            self._closing.set()
+            self._flusher.join()
+        with self._dblock:
+            self.flush()
+            self._db.close()
+        while self._readers is not None and not self._readers.empty():
+            self._readers.get().close()
 
-        self._db.create_function('REGEXP', 2, regex_function)
+    def _count_selectors_by_domain(self):
+        """
+        Recompute the number of selectors of each domain.
+        """
+        self._cursor.execute('DELETE FROM selector_counts')
+        self._cursor.execute(
+            'INSERT INTO selector_counts(domain, count) SELECT domain, '
+            'COUNT(*) FROM selectors GROUP BY domain')
+
+    def _add_count(self, table, key_columns, key, delta):
+        """
+        Add delta to the counter identified by key in table.
+        """
+        where = ' AND '.join(column + '=?' for column in key_columns)
+        self._cursor.execute(
+            'INSERT OR IGNORE INTO %s(%s, count) VALUES (%s, 0)' %
+            (table, ', '.join(key_columns), ', '.join('?' * len(key))), key)
+        self._cursor.execute(
+            'UPDATE %s SET count=count+? WHERE %s' % (table, where),
+            (delta,) + key)
+
+    def _insert_selector(self, domain, selector):
+        """
+        Insert a selector, and count it. Must be called while holding
+        self._dblock.
+        """
+        self._cursor.execute(
+            'INSERT OR IGNORE INTO selectors(domain, selector) '
+            'VALUES (?, ?)',
+            (domain, selector))
+        if self._cursor.rowcount == 1:
+            self._add_count('selector_counts', ('domain',), (domain,), 1)
 
     def add_selector(self, domain, selector):
+        with self._dblock:
+            self._insert_selector(domain, selector)
+            self._inserted()
+
+    def count_selectors(self):
+        with self._reading() as cursor:
+            return cursor.execute(
+                'SELECT COUNT(*) FROM selectors').fetchone()[0]
+
+    def remove_selectors_except(self, known):
+        """
+        Remove selectors that are not in known from the database. Returns the
+        number of removed selectors.
+
+        :param known: set of (domain, selector)
+        """
+        with self._dblock:
+            rows = self._cursor.execute(
+                'SELECT domain, selector FROM selectors').fetchall()
+            removed = [(domain, selector) for domain, selector in rows
+                       if (str(domain), str(selector)) not in known]
+            self._cursor.executemany(
+                'DELETE FROM selectors WHERE domain=? AND selector=?',
+                removed)
+            self._count_selectors_by_domain()
+            self._db.commit()
+            self._pending = 0
+        return len(removed)
+
+    def remove_selector(self, domain, selector):
+        """
+        Remove a selector and its processed state from the database.
+        """
         with self._dblock:
             self._cursor.execute(
-                'INSERT OR IGNORE INTO selectors(domain, selector) '
-                'VALUES (?, ?)',
+                'DELETE FROM selectors WHERE domain=? AND selector=?',
                 (domain, selector))
-            self._db.commit()
+            if self._cursor.rowcount == 1:
+                self._add_count('selector_counts', ('domain',), (domain,), -1)
+            agent_names = self._cursor.execute(
+                'SELECT DISTINCT agent_name FROM processed WHERE domain=? AND '
+                'selector=?', (domain, selector)).fetchall()
+            for agent_name, in agent_names:
+                self._add_count('processed_counts', ('domain', 'agent_name'),
+                                (domain, agent_name), -1)
+            self._cursor.execute(
+                'DELETE FROM processed WHERE domain=? AND selector=?',
+                (domain, selector))
+            self._inserted()
 
     def add_processed(self, domain, selector, agent_name, config_txt):
         """
@@ -286,14 +748,22 @@ class MetadataDB(object):
                     'INSERT OR ABORT INTO processed(domain, selector, '
                     'agent_name, config_txt) VALUES (?, ?, ?, ?)',
                     (domain, selector, agent_name, config_txt))
-                self._db.commit()
-                return True
             except sqlite3.IntegrityError:
                 return False
+            configs = self._cursor.execute(
+                'SELECT COUNT(*) FROM processed WHERE domain=? AND '
+                'selector=? AND agent_name=?',
+                (domain, selector, agent_name)).fetchone()[0]
+            if configs == 1:
+                # first configuration of this agent to process selector
+                self._add_count('processed_counts', ('domain', 'agent_name'),
+                                (domain, agent_name), 1)
+            self._inserted()
+            return True
 
     def is_processed(self, domain, selector, agent_name, config_txt):
-        with self._dblock:
-            res = self._cursor.execute(
+        with self._reading() as cursor:
+            res = cursor.execute(
                 'SELECT COUNT(1) FROM PROCESSED WHERE domain=? AND selector=? '
                 'AND agent_name=? AND config_txt=?',
                 (domain, selector, agent_name, config_txt)
@@ -301,30 +771,32 @@ class MetadataDB(object):
             return res == 1
 
     def list_processed(self, domain, selector):
-        with self._dblock:
-            res = self._cursor.execute(
+        with self._reading() as cursor:
+            res = cursor.execute(
                 'SELECT agent_name, config_txt FROM processed WHERE '
                 'domain=? AND selector=?', (domain, selector)).fetchall()
             return {(str(agent_name), str(config_txt)) for
                     (agent_name, config_txt) in res}
 
     def processed_stats(self, domain):
-        # FIXME take domain into account
-        with self._dblock:
-            by_agent = self._cursor.execute(
-                'SELECT agent_name, COUNT(DISTINCT selector) FROM processed '
-                'WHERE domain=? GROUP BY agent_name',
-                (domain,)).fetchall()
-            total = self._cursor.execute(
-                'SELECT COUNT(DISTINCT selector) FROM processed '
-                'WHERE domain=?',
-                (domain,)).fetchone()[0]
+        """
+        Returns a list of (agent name, number of selectors processed by this
+        agent), and the number of selectors of this domain. Reads counters,
+        whose number does not depend on the number of selectors.
+        """
+        with self._reading() as cursor:
+            by_agent = cursor.execute(
+                'SELECT agent_name, count FROM processed_counts '
+                'WHERE domain=? AND count>0', (domain,)).fetchall()
+            total = cursor.execute(
+                'SELECT count FROM selector_counts WHERE domain=?',
+                (domain,)).fetchone()
         return ([(str(agent_name), count) for agent_name, count in by_agent],
-                total)
+                total[0] if total else 0)
 
     def list_unprocessed_by_agent(self, agent_name, config_txt):
-        with self._dblock:
-            unprocessed = self._cursor.execute(
+        with self._reading(commit_pending=True) as cursor:
+            unprocessed = cursor.execute(
                 'SELECT domain, selector FROM selectors '
                 'GROUP BY domain, selector EXCEPT '
                 'SELECT domain, selector FROM processed '
@@ -334,29 +806,92 @@ class MetadataDB(object):
         return [(str(domain), str(selector)) for domain, selector in
                 unprocessed]
 
-    def find(self, domain, selector_regex, limit, offset):
+    def list_selectors(self):
+        """
+        Returns the list of known (domain, selector), in insertion order.
+        """
+        with self._reading(commit_pending=True) as cursor:
+            res = cursor.execute(
+                'SELECT domain, selector FROM selectors ORDER BY _rowid_'
+            ).fetchall()
+        return [(str(domain), str(selector)) for domain, selector in res]
+
+    def _prefix_query(self, domain, prefix, condition, args, order, limit,
+                      offset, after=None):
+        """
+        Returns (rowid, selector) for selectors starting with prefix and
+        satisfying condition. Uses the (domain, selector) index to restrict
+        the scanned range.
+
+        :param after: if set, only rows that come after the row having this
+            rowid, in the requested order, are returned
+        """
         if limit == 0:
             # no limit
             limit = -1
-        with self._dblock:
-            res = self._cursor.execute(
-                'SELECT selector FROM processed '
-                'WHERE selector REGEXP ? AND DOMAIN=? '
-                'ORDER BY _rowid_ DESC '
-                'LIMIT ? OFFSET ?',
-                (domain, selector_regex, limit, offset)
-            ).fetchall()
-        return [str(selector) for selector in res]
+        query = 'SELECT _rowid_, selector FROM selectors WHERE domain=? '
+        params = [domain]
+        if prefix:
+            query += 'AND selector>=? '
+            params.append(prefix)
+            upper = prefix_upper_bound(prefix)
+            if upper is not None:
+                query += 'AND selector<? '
+                params.append(upper)
+        if after is not None:
+            query += 'AND _rowid_' + ('<' if order == 'DESC' else '>') + '? '
+            params.append(after)
+        query += condition + ' ORDER BY _rowid_ ' + order + \
+            ' LIMIT ? OFFSET ?'
+        params.extend(args)
+        params.extend((limit, offset))
+        with self._reading() as cursor:
+            res = cursor.execute(query, params).fetchall()
+        return [(rowid, str(selector)) for rowid, selector in res]
 
-    def find_by_selector(self, domain, selector_prefix, limit, offset):
-        with self._dblock:
-            selector_prefix.replace('%', '_')  # matches 1 character
-            selector_prefix += '%'
-            res = self._cursor.execute(
-                'SELECT selector FROM processed '
-                'WHERE selector LIKE ? AND DOMAIN=? '
-                'ORDER BY _rowid_ DESC '
-                'LIMIT ? OFFSET ?',
-                (domain, selector_prefix, limit, offset)
-            ).fetchall()
-        return [str(selector) for selector in res]
+    @staticmethod
+    def _page(rows, limit):
+        """
+        Returns (selectors, rowid from which the next page may be requested,
+        or None if there are no more results).
+        """
+        selectors = [selector for _, selector in rows]
+        if limit == 0 or len(rows) < limit:
+            return selectors, None
+        return selectors, rows[-1][0]
+
+    def find(self, domain, selector_regex, limit, offset):
+        return [selector for _, selector in self._prefix_query(
+            domain, literal_prefix(selector_regex), 'AND selector REGEXP ?',
+            [selector_regex], 'DESC', limit, offset)]
+
+    def find_by_selector(self, domain, selector_prefix, limit, offset,
+                         oldest_first=False):
+        """
+        Returns selectors starting with selector_prefix, from most recent to
+        oldest, or from oldest to most recent if oldest_first is True (order
+        of Storage.find_by_selector).
+        """
+        return [selector for _, selector in self._prefix_query(
+            domain, selector_prefix, '', [], 'ASC' if oldest_first else 'DESC',
+            limit, offset)]
+
+    def find_page(self, domain, selector_regex, limit, after=None):
+        """
+        Returns (selectors, rowid): a page of find() results starting after
+        the row having this rowid, and the rowid from which the next page may
+        be requested, or None if there are no more results.
+        """
+        return self._page(self._prefix_query(
+            domain, literal_prefix(selector_regex), 'AND selector REGEXP ?',
+            [selector_regex], 'DESC', limit, 0, after), limit)
+
+    def find_by_selector_page(self, domain, selector_prefix, limit,
+                              after=None):
+        """
+        Returns (selectors, rowid): a page of find_by_selector() results
+        starting after the row having this rowid, and the rowid from which the
+        next page may be requested, or None if there are no more results.
+        """
+        return self._page(self._prefix_query(
+            domain, selector_prefix, '', [], 'ASC', limit, 0, after), limit)
@@ -1,15 +1,279 @@
+import copy
 import logging
+import mmap
+import multiprocessing
 import os
 import re
+import struct
+import threading
+import time
+import zlib
 from collections import defaultdict
 from collections import OrderedDict
 from collections import Counter
-from rebus.storage import Storage, MetadataDB
+from collections import namedtuple
+from rebus.storage import Storage, MetadataDB, parse_cursor, make_cursor
 from rebus.tools import format_check
+from rebus.tools.compression import CompressionPolicy, parse_rule
+from rebus.tools.dedup import dedup_stats, value_digest
+from rebus.tools.lineage import LineageIndex
+from rebus.tools.locking import synchronized
+from rebus.tools.lru import ByteLRU
+from rebus.tools.ngram_index import NgramIndex, add_ngram_arguments
+from rebus.tools.retention import RetentionPolicy, add_retention_arguments, \
+    start_collector
+from rebus.tools.selector_index import SelectorIndex
 from rebus.descriptor import Descriptor
 from rebus.tools.serializer import picklev2 as store_serializer
 log = logging.getLogger("rebus.storage.diskstorage")
 
+#: Version of the catalog snapshot format. Snapshots having another version
+#: are ignored, and the store is discovered again.
+CATALOG_VERSION = 3
+
+#: Files living at the root of the storage directory, which do not contain
+#: descriptors
+_ROOT_FILES = ('diskstorage.sqlite3', 'diskstorage.sqlite3-wal',
+               'diskstorage.sqlite3-shm', 'catalog.snapshot', 'catalog.delta',
+               'journal', 'ngram.index', 'shards', 'layout')
+
+#: Directory of each shard holding deduplicated values, named after the
+#: digest of their contents. .value files are hard links to these files, whose
+#: link count minus one is the number of descriptors referring to them. Not a
+#: valid domain name.
+_VALUES_DIR = '_values'
+
+#: Version of the directory layout recorded in the 'layout' file. Storages
+#: created by former versions have no layout file, and a fan-out of 0.
+LAYOUT_VERSION = 2
+#: Number of fan-out directory levels of new storages
+_DEFAULT_FANOUT = 1
+
+#: Ways of choosing the shard that holds a descriptor
+_SHARD_BY = ('hash', 'domain')
+
+#: Number of descriptors between two journal truncations when fsync batching
+#: is disabled
+_JOURNAL_CHECKPOINT = 64
+
+#: Seconds subtracted from the time at which a batch of writes has begun,
+#: when looking for files it may have written (coarse file times)
+_MTIME_MARGIN = 2
+
+#: Subset of descriptor metadata that is needed to rebuild in-memory indexes.
+#: Quacks like a Descriptor as far as _register_meta is concerned.
+CatalogEntry = namedtuple("CatalogEntry", ("domain", "selector", "version",
+                                           "precursors", "uuid", "label"))
+
+
+def _write_record(fp, obj, sync=False):
+    """
+    Append a length-prefixed serialized object to an open log file.
+
+    :param sync: if True, flush the file to disk
+    """
+    record = store_serializer.dumps(obj)
+    fp.write(struct.pack('<I', len(record)) + record)
+    fp.flush()
+    if sync:
+        os.fsync(fp.fileno())
+
+
+def _read_records(path):
+    """
+    Yields objects that have been written to path by _write_record. A
+    truncated record at the end of the file (interrupted write) is ignored.
+    """
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb') as fp:
+        while True:
+            header = fp.read(4)
+            if len(header) < 4:
+                break
+            length, = struct.unpack('<I', header)
+            record = fp.read(length)
+            if len(record) < length:
+                log.warning("Ignoring truncated record at the end of %s",
+                            path)
+                break
+            yield store_serializer.loads(record)
+
+
+#: Storage-private .meta key describing how the .value file is encoded. It is
+#: absent from .meta files written by former versions, which always contain
+#: pickled values.
+_VALUE_FORMAT_KEY = 'value_format'
+#: .value file contains the serialized value
+_VALUE_PICKLE = 'pickle'
+#: .value file contains the value itself, which is a byte string
+_VALUE_RAW = 'raw'
+#: Storage-private .meta key, present if the .value file is compressed. Its
+#: value is the name of the compression algorithm.
+_VALUE_COMPRESSION_KEY = 'value_compression'
+#: Storage-private .meta key, present if the .value file is a link to a
+#: deduplicated value. Its value is the digest of the .value file.
+_VALUE_DIGEST_KEY = 'value_digest'
+#: Storage-private .meta key, size of the .value file. Absent from .meta files
+#: written by former versions.
+_VALUE_SIZE_KEY = 'value_size'
+
+
+def _serialize_meta(desc, value_format, compression=None, digest=None,
+                    size=None):
+    meta = desc.meta_dict()
+    if value_format != _VALUE_PICKLE:
+        meta[_VALUE_FORMAT_KEY] = value_format
+    if compression:
+        meta[_VALUE_COMPRESSION_KEY] = compression
+    if digest:
+        meta[_VALUE_DIGEST_KEY] = digest
+    if size is not None:
+        meta[_VALUE_SIZE_KEY] = size
+    return store_serializer.dumps(meta)
+
+
+def _unserialize_meta(serialized):
+    """
+    Returns (Descriptor having no value, value format, compression, digest of
+    the deduplicated value). The descriptor is None if it could not be
+    unserialized.
+    """
+    meta = store_serializer.loads(serialized)
+    value_format = meta.pop(_VALUE_FORMAT_KEY, _VALUE_PICKLE)
+    compression = meta.pop(_VALUE_COMPRESSION_KEY, None)
+    digest = meta.pop(_VALUE_DIGEST_KEY, None)
+    meta.pop(_VALUE_SIZE_KEY, None)
+    try:
+        desc = Descriptor(**meta)
+    except ValueError:
+        log.warning("Invalid selector or domain encountered while "
+                    "unserializing a descriptor", exc_info=1)
+        desc = None
+    return desc, value_format, compression, digest
+
+
+def _fsync_path(path):
+    """
+    Flush a file or directory to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ShardedMetadataDB(object):
+    """
+    Metadata databases of DiskStorage shards. Operations on a selector are
+    run on the database of the shard holding it; other queries are run on
+    every database, and their results merged.
+    """
+
+    def __init__(self, dbs, shard_of):
+        """
+        :param dbs: list of MetadataDB, one per shard
+        :param shard_of: function(domain, selector) returning the index of
+            the shard holding selector
+        """
+        self.dbs = dbs
+        self._shard_of = shard_of
+
+    def _db(self, domain, selector):
+        return self.dbs[self._shard_of(domain, selector)]
+
+    def flush(self):
+        for db in self.dbs:
+            db.flush()
+
+    def close(self):
+        for db in self.dbs:
+            db.close()
+
+    def add_selector(self, domain, selector):
+        self._db(domain, selector).add_selector(domain, selector)
+
+    def remove_selector(self, domain, selector):
+        self._db(domain, selector).remove_selector(domain, selector)
+
+    def add_processed(self, domain, selector, agent_name, config_txt):
+        return self._db(domain, selector).add_processed(
+            domain, selector, agent_name, config_txt)
+
+    def is_processed(self, domain, selector, agent_name, config_txt):
+        return self._db(domain, selector).is_processed(
+            domain, selector, agent_name, config_txt)
+
+    def list_processed(self, domain, selector):
+        return self._db(domain, selector).list_processed(domain, selector)
+
+    def count_selectors(self):
+        return sum(db.count_selectors() for db in self.dbs)
+
+    def remove_selectors_except(self, known):
+        return sum(db.remove_selectors_except(known) for db in self.dbs)
+
+    def list_selectors(self):
+        """
+        Returns the list of known (domain, selector), in insertion order
+        within each shard.
+        """
+        result = []
+        for db in self.dbs:
+            result.extend(db.list_selectors())
+        return result
+
+    def list_unprocessed_by_agent(self, agent_name, config_txt):
+        result = []
+        for db in self.dbs:
+            result.extend(db.list_unprocessed_by_agent(agent_name,
+                                                       config_txt))
+        return result
+
+    def processed_stats(self, domain):
+        # a selector is only recorded by one shard: counts add up
+        by_agent = Counter()
+        total = 0
+        for db in self.dbs:
+            stats, count = db.processed_stats(domain)
+            for agent_name, processed in stats:
+                by_agent[agent_name] += processed
+            total += count
+        return by_agent.items(), total
+
+
+def _read_catalog_entry(args):
+    """
+    Unserialize a .meta file and check its consistency with its file name.
+    Returns a CatalogEntry.
+
+    Run in worker processes by DiskStorage._discover.
+
+    :param args: (full path to .meta file, path relative to storage root)
+    """
+    name, relname = args
+    with open(name, 'rb') as fp:
+        try:
+            desc = _unserialize_meta(fp.read())[0]
+        except:
+            log.error("Could not unserialize metadata from file %s", name)
+            raise
+    fname_selector = relname.rsplit('.')[0]
+    # check consistency between file name and serialized metadata
+    fname_domain = fname_selector.split('/')[1]
+    if fname_domain != desc.domain:
+        raise Exception(
+            'Filename domain %s does not match metadata domain %s for '
+            'descriptor %s' % (fname_domain, desc.domain, fname_selector))
+    fname_hash = fname_selector.rsplit('%', 1)[1]
+    if fname_hash != desc.hash:
+        raise Exception(
+            'Filename hash %s does not match metadata hash %s for descriptor '
+            '%s' % (fname_hash, desc.domain, fname_selector))
+    return CatalogEntry(desc.domain, desc.selector, desc.version,
+                        desc.precursors, desc.uuid, desc.label)
+
 
 @Storage.register
 class DiskStorage(Storage):
@@ -22,24 +286,59 @@ class DiskStorage(Storage):
 
     def __init__(self, options):
         self.basepath = options.path.rstrip('/')
+        #: If True, the storage must exist. Its files are only read: the
+        #: catalog and the intent journal are neither loaded nor written, and
+        #: no background thread is started. Only descriptors, values,
+        #: processed and agent states may be read.
+        self.read_only = options.read_only
 
         if not os.path.isdir(self.basepath):
             raise IOError('Directory %s does not exist' % self.basepath)
-        if not os.path.isdir(self.basepath + '/agent_intstate'):
+        if self.read_only:
+            if not os.path.isfile(os.path.join(self.basepath,
+                                               'diskstorage.sqlite3')):
+                raise IOError('Directory %s does not contain a storage' %
+                              self.basepath)
+        elif not os.path.isdir(self.basepath + '/agent_intstate'):
             os.makedirs(self.basepath + '/agent_intstate')
 
+        #: Held while expired descriptors are being removed
+        self._lock = threading.RLock()
+
+        #: Base paths of shards, the first one being self.basepath. Each
+        #: shard holds the files of some descriptors, and a metadata
+        #: database. Catalog, journal, n-gram index and agent states are
+        #: stored in self.basepath.
+        self.shard_paths = [self.basepath]
+        #: Chooses the shard of a descriptor, 'hash' or 'domain'
+        self.shard_by = None
+        self._load_shards(options.shard_path, options.shard_by)
+
+        #: Number of directory levels between a selector's directory and its
+        #: files, each named after 2 characters of the hash:
+        #: /sel/ector/ab/cd/%abcd... if fanout is 2
+        self.fanout = 0
+        #: Former fan-out while descriptors are being moved to the current
+        #: directory layout, else None
+        self.migrating_from = None
+        self._load_layout(None if self.read_only else options.fanout)
+        #: self._migration_cursor['domain'] is the sequence number of the last
+        #: selector of this domain visited by migrate_layout
+        self._migration_cursor = {}
+        #: domains whose descriptors have all been visited by migrate_layout
+        self._migrated_domains = set()
+
         #: Set of existing descriptor storage directories, all starting and
         #: ending with '/'
-        self.existing_paths = set((self.basepath + '/',))
+        self.existing_paths = set(path + '/' for path in self.shard_paths)
 
         #: self.version_cache['domain']['/selector/'][version] = /selector/%123
         #: where 1234 is the hash of this selector's version 42
         #: Mostly useful for descriptors that have several versions
         self.version_cache = defaultdict(lambda: defaultdict(dict))
 
-        #: self.edges['domain']['selectorA'] is a set of selectors of
-        #: descriptors that were spawned from selectorA.
-        self.edges = defaultdict(lambda: defaultdict(set))
+        #: precursors and children of stored descriptors
+        self.lineage = LineageIndex()
 
         #: self.processable['domain']['/selector/%hash'] is a set of (agent
         #: name, configuration text) that are running in interactive mode, and
@@ -55,38 +354,604 @@ class DiskStorage(Storage):
         #: this UUID
         self.labels = defaultdict(lambda: defaultdict(str))
 
+        #: index of selectors, ordered by insertion. Used by find and
+        #: find_by_selector
+        self.selindex = SelectorIndex()
+
         # A sqlite3 database records which (agent name, configuration text)
         # have finished processing each (domain, /selector/%hash). This allows
         # stopping and resuming the bus when some of the descriptors have not
         # been processed by all agents.
         # TODO maybe also store processable?
-        self.db = MetadataDB(
-            os.path.join(self.basepath, 'diskstorage.sqlite3'))
+        self.db = ShardedMetadataDB(
+            [MetadataDB(os.path.join(path, 'diskstorage.sqlite3'),
+                        options.db_commit_batch, options.db_commit_interval,
+                        options.db_readers, self.read_only)
+             for path in self.shard_paths], self._shard_of)
+
+        #: Number of descriptors known to the in-memory indexes
+        self.descriptor_count = 0
+
+        self.discover_processes = options.discover_processes
+        self.snapshot_path = os.path.join(self.basepath, 'catalog.snapshot')
+        self.delta_path = os.path.join(self.basepath, 'catalog.delta')
+
+        #: Number of descriptors written between two fsync calls. 0 lets the
+        #: operating system decide when data is written to disk.
+        self.fsync_batch = options.fsync_batch
+        #: Paths of files that have been written since the last checkpoint
+        self._unsynced_files = []
+        #: Number of descriptors written since the last checkpoint
+        self._unsynced_count = 0
+        #: True once the current batch of writes has been recorded to the
+        #: journal
+        self._batch_started = False
+        #: True if recovery has rolled back writes that may have been
+        #: recorded to the metadata database or catalog
+        self._lost_writes = False
+        self.journal_path = os.path.join(self.basepath, 'journal')
+        #: Paths (without extension) of descriptors whose write has been
+        #: finished while recovering the journal
+        self._recovered = []
+        self._delta = None
+        #: Intent journal: records the beginning and the end of each
+        #: descriptor write. Truncated at every checkpoint.
+        self._journal = None
+        if self.read_only:
+            if os.path.isfile(self.journal_path) and \
+                    os.path.getsize(self.journal_path):
+                log.warning("Storage %s has unfinished writes, which are "
+                            "recovered when it is opened for writing",
+                            self.basepath)
+        else:
+            self._delta = open(self.delta_path, 'ab')
+            self._recover_journal()
+
+            # Restore in-memory indexes from the catalog snapshot and its
+            # delta, or enumerate existing files & dirs if they are missing
+            # or stale
+            if options.rediscover or self._lost_writes or \
+                    not self._load_catalog():
+                self._recovered = []
+                self._reset_catalog()
+                self._discover()
+                self._write_catalog()
+            self._journal = open(self.journal_path, 'ab')
+
+        #: Decoded descriptor metadata and values, indexed by ('meta' or
+        #: 'value', domain, selector). Selectors having a hash are immutable,
+        #: hence entries never have to be invalidated.
+        self.cache = ByteLRU(options.cache_size)
+
+        #: chooses how values are compressed, depending on their selector
+        self.compression = CompressionPolicy(options.compress)
+
+        #: Identical stored values are written once per shard
+        self.dedup = not options.no_dedup
+
+        #: optional trigram index of values, used by find_by_value. Written
+        #: next to the metadata database by store_state.
+        self.ngram = None
+        self.ngram_path = os.path.join(self.basepath, 'ngram.index')
+        if options.ngram_index and not self.read_only:
+            self._load_ngram_index(options.ngram_max_value_size)
+
+        #: chooses which descriptors may be removed by collect_garbage
+        self.retention = RetentionPolicy(options.retention)
+        #: scan of stored descriptors resumed by collect_garbage, None if no
+        #: scan is in progress
+        self._gc_scan = None
+        #: True if the current scan has removed descriptors
+        self._gc_removed = False
+        self.collector = None
+        if self.read_only:
+            return
+        self.collector = start_collector(self, options)
+
+        if self.migrating_from is not None and options.migrate_batch > 0:
+            thread = threading.Thread(target=self._migrate_loop, args=(
+                options.migrate_batch, options.migrate_pause))
+            thread.daemon = True
+            thread.start()
+
+    def _load_shards(self, shard_paths, shard_by):
+        """
+        Set self.shard_paths and self.shard_by from the shard layout recorded
+        in the storage directory, or record the requested layout if the
+        storage is new.
+
+        Shard paths may differ from the recorded ones (moved shards), but
+        their number and the way descriptors are spread across them cannot
+        change once descriptors have been stored.
+
+        :param shard_paths: list of additional shard paths. If empty, recorded
+            shard paths are used.
+        :param shard_by: 'hash', 'domain', or None to use the recorded value
+        """
+        layout_path = os.path.join(self.basepath, 'shards')
+        shard_paths = [path.rstrip('/') for path in shard_paths]
+        if os.path.isfile(layout_path):
+            with open(layout_path, 'rb') as fp:
+                layout = store_serializer.load(fp)
+            if shard_paths and len(shard_paths) != len(layout['paths']):
+                raise IOError('Storage %s has %d shard paths, %d given' %
+                              (self.basepath, len(layout['paths']),
+                               len(shard_paths)))
+            if shard_by and shard_by != layout['shard_by']:
+                raise IOError('Storage %s is sharded by %s' %
+                              (self.basepath, layout['shard_by']))
+            shard_paths = shard_paths or layout['paths']
+            shard_by = layout['shard_by']
+        elif shard_paths:
+            if os.path.isfile(os.path.join(self.basepath,
+                                           'diskstorage.sqlite3')):
+                raise IOError('Storage %s already contains descriptors, it '
+                              'cannot be sharded' % self.basepath)
+            shard_by = shard_by or _SHARD_BY[0]
+            with open(layout_path, 'wb') as fp:
+                store_serializer.dump({'paths': shard_paths,
+                                       'shard_by': shard_by}, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+        for path in shard_paths:
+            if not os.path.isdir(path):
+                raise IOError('Directory %s does not exist' % path)
+        self.shard_paths = [self.basepath] + shard_paths
+        self.shard_by = shard_by
 
-        # Enumerate existing files & dirs
-        self._discover('/')
+    def _shard_of(self, domain, selector):
+        """
+        Returns the index of the shard holding a selector containing a hash.
+        Selectors having no hash (prefixes, versions such as /sel/~-1) are
+        never stored, but are given a stable shard nonetheless.
+        """
+        if len(self.shard_paths) == 1:
+            return 0
+        if self.shard_by == 'domain':
+            key = zlib.crc32(domain) & 0xffffffff
+        else:
+            prefix, _, digest = selector.partition('%')
+            try:
+                key = int(digest[:8], 16)
+            except ValueError:
+                key = zlib.crc32(prefix.split('~', 1)[0]) & 0xffffffff
+        return key % len(self.shard_paths)
 
-    def _discover(self, relpath):
+    def _load_layout(self, fanout):
         """
-        Recursively add existing files to storage.
+        Set self.fanout and self.migrating_from from the directory layout
+        recorded in the storage directory, or record the requested layout if
+        the storage is new.
 
-        :param relpath: starts and ends with a '/', relative to self.basepath
+        :param fanout: requested number of fan-out levels, or None to use the
+            recorded value. If it differs from the recorded value, existing
+            descriptors are moved to the new layout by migrate_layout.
         """
-        if relpath == '/agent_intstate/':
-            # Ignore internal state of agents
+        layout_path = os.path.join(self.basepath, 'layout')
+        if os.path.isfile(layout_path):
+            with open(layout_path, 'rb') as fp:
+                layout = store_serializer.load(fp)
+            if layout['version'] != LAYOUT_VERSION:
+                raise IOError('Storage %s has unsupported layout version %s' %
+                              (self.basepath, layout['version']))
+            self.fanout = layout['fanout']
+            self.migrating_from = layout['migrating_from']
+        elif os.path.isfile(os.path.join(self.basepath,
+                                         'diskstorage.sqlite3')):
+            # created by a former version
+            self.fanout = 0
+        else:
+            self.fanout = _DEFAULT_FANOUT if fanout is None else fanout
+            self._write_layout()
+        if fanout is None or fanout == self.fanout:
             return
+        if fanout < 0:
+            raise IOError('Invalid fan-out %d' % fanout)
+        if self.migrating_from is not None:
+            raise IOError('Storage %s is being migrated to fan-out %d, which '
+                          'cannot be changed until migration has finished' %
+                          (self.basepath, self.fanout))
+        log.info("Migrating %s from fan-out %d to %d", self.basepath,
+                 self.fanout, fanout)
+        self.migrating_from, self.fanout = self.fanout, fanout
+        self._write_layout()
+
+    def _write_layout(self):
+        layout_path = os.path.join(self.basepath, 'layout')
+        with open(layout_path + '.tmp', 'wb') as fp:
+            store_serializer.dump({'version': LAYOUT_VERSION,
+                                   'fanout': self.fanout,
+                                   'migrating_from': self.migrating_from},
+                                  fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(layout_path + '.tmp', layout_path)
+
+    def _load_ngram_index(self, max_value_size):
+        """
+        Load the n-gram index, then index values of descriptors that are
+        missing from it.
+        """
+        if os.path.isfile(self.ngram_path):
+            try:
+                with open(self.ngram_path, 'rb') as fp:
+                    self.ngram = NgramIndex.load(store_serializer.load(fp))
+                if self.ngram.max_value_size != max_value_size:
+                    log.info("N-gram index max value size has changed, "
+                             "rebuilding index")
+                    self.ngram = None
+            except Exception:
+                log.warning("Could not load n-gram index %s, rebuilding it",
+                            self.ngram_path, exc_info=1)
+                self.ngram = None
+        if self.ngram is None:
+            self.ngram = NgramIndex(max_value_size)
+        indexed = 0
+        for domain, selector in self.db.list_selectors():
+            if (domain, selector) not in self.ngram:
+                self.ngram.add(domain, selector,
+                               self.get_value(domain, selector))
+                indexed += 1
+        if indexed:
+            log.info("Indexed values of %d descriptors", indexed)
+
+    def _write_ngram_index(self):
+        tmppath = self.ngram_path + '.tmp'
+        with open(tmppath, 'wb') as fp:
+            store_serializer.dump(self.ngram.dump(), fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmppath, self.ngram_path)
+
+    def _reset_catalog(self):
+        self.existing_paths = set(path + '/' for path in self.shard_paths)
+        self.version_cache.clear()
+        self.lineage = LineageIndex()
+        self.uuids.clear()
+        self.labels.clear()
+        self.selindex = SelectorIndex()
+        self.descriptor_count = 0
+
+    def _load_catalog(self):
+        """
+        Restore in-memory indexes from the catalog snapshot, then replay
+        descriptors that have been added since it was written.
+
+        Returns False if the snapshot is missing, unreadable, has an
+        unsupported version or does not match the metadata database.
+        """
+        if not os.path.isfile(self.snapshot_path):
+            log.info("No catalog snapshot found in %s", self.basepath)
+            return False
+        try:
+            with open(self.snapshot_path, 'rb') as fp:
+                snapshot = store_serializer.load(fp)
+            if snapshot['version'] != CATALOG_VERSION:
+                log.info("Ignoring catalog snapshot having version %s",
+                         snapshot['version'])
+                return False
+            self._restore_catalog(snapshot)
+        except Exception:
+            log.warning("Could not load catalog snapshot %s",
+                        self.snapshot_path, exc_info=1)
+            return False
+        replayed = 0
+        for entry in self._read_delta():
+            self._register_meta(entry, new=False)
+            replayed += 1
+        self._register_recovered()
+        db_count = self.db.count_selectors()
+        if db_count != self.descriptor_count:
+            log.warning("Catalog snapshot is stale (%d descriptors, %d in "
+                        "database)", self.descriptor_count, db_count)
+            return False
+        log.info("Loaded catalog snapshot: %d descriptors, %d replayed from "
+                 "delta", self.descriptor_count, replayed)
+        return True
+
+    def _read_delta(self):
+        """
+        Yields CatalogEntry objects from the delta file.
+        """
+        for record in _read_records(self.delta_path):
+            yield CatalogEntry(*record)
+
+    def _append_delta(self, desc):
+        _write_record(self._delta, (
+            desc.domain, desc.selector, desc.version, desc.precursors,
+            desc.uuid, desc.label))
+
+    def _recover_journal(self):
+        """
+        Finish or roll back descriptor writes that were in flight when the
+        storage was last stopped, and finish interrupted removals, by
+        replaying the tail of the intent journal.
+
+        A write is finished if both its .value and .meta files have been
+        renamed to their final names (.meta is renamed last) and are
+        complete; else, its files are removed. Writes that have ended are
+        checked as well: their files may not have reached the disk yet, as
+        they are only flushed at the next checkpoint, which truncates the
+        journal. Interrupted moves to the current directory layout are
+        finished.
+
+        Only the 'batch' record starting each batch of writes is flushed to
+        disk, and 'begin' records may have been lost: files written since
+        the batch has begun are checked too, see _check_recent_files.
+        """
+        inflight = OrderedDict()
+        batches = []
+        for record in _read_records(self.journal_path):
+            if record[0] == 'batch':
+                batches.append(record[1])
+            elif record[0] in ('begin', 'remove', 'move'):
+                inflight[record[1]] = record
+            elif record[0] == 'end' and \
+                    inflight.get(record[1], ('begin',))[0] != 'begin':
+                del inflight[record[1]]
+        for relname, record in inflight.iteritems():
+            kind, _, domain, selector = record[:4]
+            fname = self._pathFromSelector(domain, selector)
+            if kind == 'remove':
+                log.info("Recovery: finishing removal of %s:%s", domain,
+                         selector)
+                self.db.remove_selector(domain, selector)
+                for path in self._paths(domain, selector):
+                    for ext in ('.meta', '.value'):
+                        if os.path.isfile(path + ext):
+                            os.remove(path + ext)
+            elif kind == 'move':
+                log.info("Recovery: finishing move of %s:%s", domain,
+                         selector)
+                self._move_files(self._pathFromSelector(
+                    domain, selector, self.migrating_from),
+                    self._mkdirs(domain, selector))
+            elif self._is_complete(fname, *record[4:6]):
+                log.info("Recovery: finishing write of %s:%s", domain,
+                         selector)
+                # Make sure the database knows about it. Its catalog entry is
+                # appended to the delta once the catalog has been loaded
+                self.db.add_selector(domain, selector)
+                self._recovered.append((fname, relname))
+            else:
+                log.info("Recovery: rolling back write of %s:%s", domain,
+                         selector)
+                if os.path.isfile(fname + '.meta'):
+                    # renamed, hence possibly registered
+                    self._lost_writes = True
+                for ext in ('.value.tmp', '.meta.tmp', '.value', '.meta'):
+                    if os.path.isfile(fname + ext):
+                        os.remove(fname + ext)
+                if len(record) > 6 and record[6]:
+                    self._check_value(self.shard_paths[self._shard_of(
+                        domain, selector)], record[6])
+        if batches:
+            self._check_recent_files(min(batches) - _MTIME_MARGIN)
+        self._truncate_journal()
+
+    def _check_recent_files(self, since):
+        """
+        Removes descriptor files modified since a batch of writes has begun
+        that are incomplete: their data, or the rename of their .meta file,
+        did not reach the disk. Descriptors are then discovered again, so
+        that the metadata database and catalog forget about them.
+
+        :param since: time at which the batch has begun
+        """
+        for basepath in self.shard_paths:
+            for path, dirs, names in os.walk(basepath):
+                if path == basepath:
+                    dirs[:] = [name for name in dirs if name not in
+                               ('agent_intstate', _VALUES_DIR)]
+                    continue
+                for name in names:
+                    fullname = os.path.join(path, name)
+                    if not os.path.isfile(fullname) or \
+                            os.path.getmtime(fullname) < since:
+                        # removed along with its .meta file, or complete
+                        continue
+                    base, ext = os.path.splitext(fullname)
+                    if ext == '.tmp' or \
+                            ext == '.value' and \
+                            not os.path.isfile(base + '.meta') or \
+                            ext == '.meta' and not self._is_complete(base):
+                        log.info("Recovery: removing incomplete file %s",
+                                 fullname)
+                        os.remove(fullname)
+                        if ext == '.meta' and \
+                                os.path.isfile(base + '.value'):
+                            os.remove(base + '.value')
+                        self._lost_writes = True
+
+    def _check_value(self, basepath, digest):
+        """
+        Removes a deduplicated value written by a rolled back write if it is
+        not referred to anymore, or if its contents have been lost.
+        """
+        path = self._value_path(basepath, digest)
+        if not os.path.isfile(path):
+            return
+        if os.stat(path).st_nlink > 1:
+            with open(path, 'rb') as fp:
+                if value_digest(fp.read()) == digest:
+                    return
+        log.info("Recovery: removing deduplicated value %s", digest)
+        os.remove(path)
+
+    @staticmethod
+    def _is_complete(fname, value_size=None, meta_size=None):
+        """
+        Returns True if a descriptor's .value and .meta files exist, have the
+        sizes recorded in its 'begin' journal record and .meta file (files
+        written by former versions do not record them), and its metadata can
+        be unserialized.
+        """
+        for ext, size in (('.value', value_size), ('.meta', meta_size)):
+            if not os.path.isfile(fname + ext):
+                return False
+            if size is not None and os.path.getsize(fname + ext) != size:
+                return False
+        try:
+            with open(fname + '.meta', 'rb') as fp:
+                serialized = fp.read()
+            size = store_serializer.loads(serialized).get(_VALUE_SIZE_KEY)
+            if size is not None and os.path.getsize(fname + '.value') != size:
+                return False
+            return _unserialize_meta(serialized)[0] is not None
+        except Exception:
+            return False
+
+    def _register_recovered(self):
+        """
+        Add descriptors whose write has been finished by _recover_journal to
+        the in-memory indexes, unless the catalog already knows about them.
+        """
+        for fname, relname in self._recovered:
+            entry = _read_catalog_entry((fname + '.meta', relname + '.meta'))
+            prefix = entry.selector.split('%')[0]
+            if self.version_cache[entry.domain][prefix].get(
+                    entry.version) == entry.selector:
+                continue
+            self._register_meta(entry, new=False)
+            self._append_delta(entry)
+        self._recovered = []
+
+    def _truncate_journal(self):
+        with open(self.journal_path, 'wb'):
+            pass
 
-        path = self.basepath + relpath
+    def _checkpoint(self):
+        """
+        Flush files written since the last checkpoint to disk if fsync
+        batching is enabled, then truncate the journal: completed writes no
+        longer need to be recovered.
+        """
+        if self.fsync_batch:
+            for path in self._unsynced_files:
+                _fsync_path(path)
+            for path in set(os.path.dirname(p) for p in
+                            self._unsynced_files):
+                _fsync_path(path)
+            os.fsync(self._delta.fileno())
+        self._unsynced_files = []
+        self._unsynced_count = 0
+        self._batch_started = False
+        self._journal.seek(0)
+        self._journal.truncate()
+
+    def _restore_catalog(self, snapshot):
+        self._reset_catalog()
+        self.existing_paths.update(snapshot['existing_paths'])
+        for domain, selectors in snapshot['version_cache'].iteritems():
+            for selprefix, versions in selectors.iteritems():
+                self.version_cache[domain][selprefix].update(versions)
+        self.lineage = LineageIndex.load(snapshot['lineage'])
+        for domain, uuids in snapshot['uuids'].iteritems():
+            for uuid, selectors in uuids.iteritems():
+                self.uuids[domain][uuid].update(selectors)
+        for domain, labels in snapshot['labels'].iteritems():
+            self.labels[domain].update(labels)
+        self.selindex = SelectorIndex.load(snapshot['selindex'])
+        self.descriptor_count = snapshot['descriptor_count']
+
+    def _write_catalog(self):
+        """
+        Atomically replace the catalog snapshot with the current in-memory
+        indexes, then truncate the delta.
+        """
+        snapshot = {
+            'version': CATALOG_VERSION,
+            'descriptor_count': self.descriptor_count,
+            'existing_paths': list(self.existing_paths),
+            'version_cache': {d: {p: dict(v) for p, v in s.iteritems()}
+                              for d, s in self.version_cache.iteritems()},
+            'lineage': self.lineage.dump(),
+            'uuids': {d: dict(u) for d, u in self.uuids.iteritems()},
+            'labels': {d: dict(l) for d, l in self.labels.iteritems()},
+            'selindex': self.selindex.dump(),
+        }
+        tmppath = self.snapshot_path + '.tmp'
+        with open(tmppath, 'wb') as fp:
+            store_serializer.dump(snapshot, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmppath, self.snapshot_path)
+        # descriptors from the delta are now part of the snapshot
+        with open(self.delta_path, 'wb'):
+            pass
+        log.info("Wrote catalog snapshot: %d descriptors",
+                 self.descriptor_count)
+
+    def _discover(self):
+        """
+        Add existing files to storage. Metadata files are unserialized by a
+        pool of worker processes.
+        """
+        log.info("Discovering descriptors in %s using %d processes",
+                 ', '.join(self.shard_paths), self.discover_processes)
+        metafiles = []
+        for basepath in self.shard_paths:
+            self._discover_dir(basepath, '/', metafiles)
+            self._remove_orphan_values(basepath)
+        if self.discover_processes > 1 and len(metafiles) > 1:
+            pool = multiprocessing.Pool(self.discover_processes)
+            try:
+                entries = pool.imap_unordered(_read_catalog_entry, metafiles,
+                                              chunksize=256)
+                for entry in entries:
+                    self._register_meta(entry)
+            finally:
+                pool.terminate()
+        else:
+            for args in metafiles:
+                self._register_meta(_read_catalog_entry(args))
+
+        db_count = self.db.count_selectors()
+        if db_count != self.descriptor_count:
+            # Database contains selectors whose files have been removed
+            known = set()
+            for domain, uuids in self.uuids.iteritems():
+                for selectors in uuids.itervalues():
+                    known.update((domain, sel) for sel in selectors)
+            removed = self.db.remove_selectors_except(known)
+            log.warning("Removed %d selectors that have no associated files "
+                        "from the database", removed)
+        # Discovery order is arbitrary: index selectors in the order they
+        # have been added to the database
+        self.selindex = SelectorIndex()
+        for domain, selector in self.db.list_selectors():
+            self.selindex.add(domain, selector)
+        log.info("Discovered %d descriptors", self.descriptor_count)
+
+    def _discover_dir(self, basepath, relpath, metafiles):
+        """
+        Recursively enumerate existing files & dirs. Paths to .meta files are
+        appended to metafiles, as (full path, path relative to basepath)
+        tuples.
+
+        :param basepath: base path of the shard being enumerated
+        :param relpath: starts and ends with a '/', relative to basepath
+        :param metafiles: list
+        """
+        if relpath in ('/agent_intstate/', '/' + _VALUES_DIR + '/'):
+            # Ignore internal state of agents, and deduplicated values
+            return
+
+        path = basepath + relpath
         self.existing_paths.add(path)
 
         for elem in os.listdir(path):
             name = path + elem
             relname = relpath + elem
             if os.path.isdir(name):
-                self._discover(relname + '/')
+                self._discover_dir(basepath, relname + '/', metafiles)
             elif os.path.isfile(name):
                 basename = name.rsplit('.', 1)[0]
-                if name.endswith('.value'):
+                if name.endswith('.tmp'):
+                    # Interrupted write that has not been journaled
+                    log.warning("Removing temporary file %s", relname)
+                    os.remove(name)
+                elif name.endswith('.value'):
                     # Serialized descriptor value
                     if not os.path.isfile(basename + '.meta'):
                         raise Exception(
@@ -96,33 +961,8 @@ class DiskStorage(Storage):
                     if not os.path.isfile(basename + '.value'):
                         raise Exception(
                             'Missing associated value for %s' % relname)
-                    with open(name, 'rb') as fp:
-                        try:
-                            desc = Descriptor.unserialize(store_serializer,
-                                                          fp.read())
-                        except:
-                            log.error(
-                                "Could not unserialize metadata from file %s",
-                                name)
-                            raise
-                        fname_selector = relname.rsplit('.')[0]
-                        # check consistency between file name and serialized
-                        # metadata
-                        fname_domain = fname_selector.split('/')[1]
-                        if fname_domain != desc.domain:
-                            raise Exception(
-                                'Filename domain %s does not match metadata '
-                                'domain %s for descriptor %s' %
-                                (fname_domain, desc.domain, fname_selector))
-                        fname_hash = fname_selector.rsplit('%', 1)[1]
-                        if fname_hash != desc.hash:
-                            raise Exception(
-                                'Filename hash %s does not match metadata hash'
-                                ' %s for descriptor %s' %
-                                (fname_hash, desc.domain, fname_selector))
-
-                        self._register_meta(desc)
-                elif relpath == '/' and elem == 'diskstorage.sqlite3':
+                    metafiles.append((name, relname))
+                elif relpath == '/' and elem in _ROOT_FILES:
                     continue
                 elif relpath == '/' and elem == '_processed.cfg':
                     # Former _processed.cfg storage file
@@ -146,32 +986,72 @@ class DiskStorage(Storage):
                     'Invalid file type - %s is neither a regular file nor a '
                     'directory' % name)
 
-    def _register_meta(self, desc):
+    def _remove_orphan_values(self, basepath):
         """
-        :param desc: Descriptor instance
+        Removes deduplicated values of a shard that are not referred to by
+        any descriptor, because their write or removal has been interrupted.
+        """
+        removed = 0
+        for path, _, names in os.walk(os.path.join(basepath, _VALUES_DIR)):
+            for name in names:
+                if os.stat(os.path.join(path, name)).st_nlink == 1:
+                    os.remove(os.path.join(path, name))
+                    removed += 1
+        if removed:
+            log.info("Removed %d unreferenced values from %s", removed,
+                     basepath)
+
+    def _register_meta(self, desc, new=True):
+        """
+        :param desc: Descriptor or CatalogEntry instance
+        :param new: False if desc is being replayed from the catalog delta,
+            and has already been recorded to the metadata database
         """
 
         domain = desc.domain
         selector = desc.selector
-        self.db.add_selector(domain, selector)
+        if new:
+            self.db.add_selector(domain, selector)
+        self.descriptor_count += 1
         self.version_cache[domain][selector.split('%')[0]][desc.version]\
             = selector
-        for precursor in desc.precursors:
-            self.edges[domain][precursor].add(selector)
+        self.lineage.add(domain, selector, desc.precursors)
         self.uuids[domain][desc.uuid].add(selector)
         if not self.labels[domain][desc.uuid] or not desc.precursors:
             # Heuristic for choosing uuid label : prefer label of a descriptor
             # that has no precursor
             self.labels[domain][desc.uuid] = desc.label
+        self.selindex.add(domain, selector)
 
+    @synchronized
     def find(self, domain, selector_regex, limit=0, offset=0):
-        return self.db.find(domain, selector_regex, limit, offset)
+        return self.selindex.find(domain, selector_regex, limit, offset)
 
+    @synchronized
     def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
-        return self.db.find_by_selector(domain, selector_prefix, limit, offset)
+        return [self.get_descriptor(domain, selector) for selector in
+                self.selindex.find_by_prefix(domain, selector_prefix, limit,
+                                             offset)]
+
+    @synchronized
+    def find_page(self, domain, selector_regex, limit, cursor=''):
+        selectors, position = self.selindex.find_page(
+            domain, selector_regex, limit, parse_cursor(cursor))
+        return selectors, make_cursor(position)
 
+    @synchronized
+    def find_by_selector_page(self, domain, selector_prefix, limit,
+                              cursor=''):
+        selectors, position = self.selindex.find_by_prefix_page(
+            domain, selector_prefix, limit, parse_cursor(cursor))
+        return ([self.get_descriptor(domain, selector)
+                 for selector in selectors], make_cursor(position))
+
+    @synchronized
     def find_by_uuid(self, domain, uuid):
         result = []
+        if uuid not in self.uuids[domain]:
+            return result
         for selector in self.uuids[domain][uuid]:
             desc = self.get_descriptor(domain, selector)
             if desc is None:
@@ -184,32 +1064,53 @@ class DiskStorage(Storage):
         return result
 
     def find_by_value(self, domain, selector_prefix, value_regex):
+        # the lock is only held while reading each value, so that other
+        # requests are served during long scans
+        if self.ngram is not None:
+            with self._lock:
+                candidates = self.ngram.candidates(domain, value_regex)
+            if candidates is not None:
+                result = []
+                for selector in candidates:
+                    if not selector.startswith(selector_prefix):
+                        continue
+                    # get_value and get_descriptor hold the lock
+                    value = self.get_value(domain, selector)
+                    if value is not None and re.match(value_regex, value):
+                        result.append(self.get_descriptor(domain, selector))
+                return result
         result = []
-        # File paths to explore
-        pathprefix = self.basepath + '/' + domain + selector_prefix
-        paths = [path for path in self.existing_paths if
-                 path.startswith(pathprefix)]
-        for path in paths:
-            # open and run re.match() on every file matching *.value
-            for name in os.listdir(path):
-                if os.path.isfile(path + name) and name.endswith('.value'):
-                    contents = Descriptor.unserialize_value(
-                        store_serializer,
-                        open(path + name, 'rb').read())
-                    if re.match(value_regex, contents):
-                        selector = path[len(self.basepath)+len(domain)+1:] +\
-                            name.split('.')[0]
-                        desc = self.get_descriptor(domain, selector)
-                        if desc:
-                            result.append(desc)
+        # run re.match() on the value of every matching selector, without
+        # listing directories
+        with self._lock:
+            selectors = [selector for _, selector in
+                         self.selindex.iter_prefix(domain, selector_prefix)]
+        for selector in selectors:
+            with self._lock:
+                contents = self._read_value(domain, selector, cache=False)
+            if contents is not None and re.match(value_regex, contents):
+                desc = self.get_descriptor(domain, selector)
+                if desc:
+                    result.append(desc)
         return result
 
+    @synchronized
     def list_uuids(self, domain):
         result = dict()
         for uuid in self.uuids[domain].keys():
             result[uuid] = self.labels[domain][uuid]
         return result
 
+    def list_selectors(self):
+        return self.db.list_selectors()
+
+    def list_agent_states(self):
+        path = os.path.join(self.basepath, 'agent_intstate')
+        if not os.path.isdir(path):
+            return []
+        return [name[:-len('.intstate')] for name in os.listdir(path)
+                if name.endswith('.intstate')]
+
     def _version_lookup(self, domain, selector):
         """
         :param selector: selector, containing either a version (/selector/~12)
@@ -232,6 +1133,67 @@ class DiskStorage(Storage):
                 selector = None
         return selector
 
+    def _get_meta(self, domain, selector):
+        """
+        Returns (descriptor having no value, value format, compression,
+        digest) for a selector containing a hash, None if descriptor was not
+        found.
+        """
+        key = ('meta', domain, selector)
+        meta = self.cache.get(key)
+        if meta is None:
+            fullpath = self._locate(domain, selector)
+            if not fullpath or not os.path.isfile(fullpath + ".meta"):
+                return None
+            fullpath += ".meta"
+            with open(fullpath, "rb") as fp:
+                serialized = fp.read()
+            meta = _unserialize_meta(serialized)
+            if meta[0] is None:
+                return None
+            self.cache.put(key, meta, len(serialized))
+        return meta
+
+    def _read_value(self, domain, selector, cache=True):
+        """
+        Returns the value of a selector containing a hash, None if
+        descriptor was not found.
+
+        :param cache: keep the value in cache if it had to be read
+        """
+        key = ('value', domain, selector)
+        cached = self.cache.get(key)
+        if cached is not None:
+            value, = cached
+        else:
+            meta = self._get_meta(domain, selector)
+            if meta is None:
+                return None
+            fullpath = self._locate(domain, selector) + ".value"
+            if not os.path.isfile(fullpath):
+                return None
+            try:
+                with open(fullpath, "rb") as fp:
+                    serialized = fp.read()
+                if meta[2]:
+                    serialized = self.compression.decompress(serialized)
+                if meta[1] == _VALUE_RAW:
+                    value = serialized
+                else:
+                    value = Descriptor.unserialize_value(store_serializer,
+                                                         serialized)
+            except:
+                log.warning("Could not unserialize value from file %s",
+                            fullpath)
+                return
+            if cache:
+                self.cache.put(key, (value,), len(serialized))
+        if isinstance(value, basestring):
+            return value
+        # callers may modify returned lists or dicts
+        return copy.deepcopy(value)
+
+    @synchronized
     def get_descriptor(self, domain, selector):
         """
         Returns descriptor metadata, None if descriptor was not found.
@@ -239,13 +1201,16 @@ class DiskStorage(Storage):
         selector = self._version_lookup(domain, selector)
         if not selector:
             return None
-
-        fullpath = self._pathFromSelector(domain, selector) + ".meta"
-        if not fullpath or not os.path.isfile(fullpath):
+        meta = self._get_meta(domain, selector)
+        if meta is None:
             return None
-        return Descriptor.unserialize(store_serializer,
-                                      open(fullpath, "rb").read())
+        # callers may modify returned descriptors: do not share the cached
+        # precursors list
+        desc = copy.copy(meta[0])
+        desc.precursors = list(desc.precursors)
+        return desc
 
+    @synchronized
     def get_value(self, domain, selector):
         """
         Returns descriptor value, None if descriptor was not found.
@@ -253,32 +1218,65 @@ class DiskStorage(Storage):
         selector = self._version_lookup(domain, selector)
         if not selector:
             return None
+        return self._read_value(domain, selector)
 
-        fullpath = self._pathFromSelector(domain, selector) + ".value"
-        if not fullpath or not os.path.isfile(fullpath):
+    @synchronized
+    def get_value_buffer(self, domain, selector):
+        """
+        Byte string values are memory-mapped: slicing the returned buffer only
+        reads the requested part of the file.
+        """
+        selector = self._version_lookup(domain, selector)
+        if not selector:
             return None
-        try:
-            value = Descriptor.unserialize_value(store_serializer,
-                                                 open(fullpath, "rb").read())
-        except:
-            log.warning("Could not unserialize value from file %s", fullpath)
-            return
-        return value
+        meta = self._get_meta(domain, selector)
+        if meta is None:
+            return None
+        if meta[1] != _VALUE_RAW or meta[2]:
+            return self._read_value(domain, selector)
+        with open(self._locate(domain, selector) + ".value",
+                  "rb") as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                # empty files cannot be mapped
+                return ''
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @synchronized
+    def get_value_size(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        meta = self._get_meta(domain, selector)
+        if meta is None:
+            return None
+        if meta[1] != _VALUE_RAW or meta[2]:
+            return len(self._read_value(domain, selector))
+        return os.path.getsize(self._locate(domain, selector) +
+                               ".value")
 
+    @synchronized
     def get_children(self, domain, selector, recurse=True):
         result = set()
-        if domain not in self.edges:
-            return result
-        if selector not in self.edges[domain]:
-            return result
-        for child in self.edges[domain][selector]:
+        for child, _ in self.lineage.iter_descendants(domain, selector,
+                                                      0 if recurse else 1):
             desc = self.get_descriptor(domain, child)
             if desc:
                 result.add(desc)
-            if recurse:
-                result |= self.get_children(child, domain, recurse)
         return result
 
+    @synchronized
+    def get_descendants(self, domain, selector, max_depth=0):
+        return list(self.lineage.iter_descendants(domain, selector,
+                                                  max_depth))
+
+    @synchronized
+    def get_ancestors(self, domain, selector, max_depth=0):
+        return list(self.lineage.iter_ancestors(domain, selector, max_depth))
+
+    @synchronized
+    def ancestry_summary(self, domain, selector):
+        return self.lineage.ancestry(domain, selector)
+
     def _mkdirs(self, domain, selector):
         """
         :param selector:  /sel/ector/%1234
@@ -300,11 +1298,14 @@ class DiskStorage(Storage):
             self.existing_paths.add(path)
         return path + '%' + fname
 
-    def _pathFromSelector(self, domain, selector):
+    def _pathFromSelector(self, domain, selector, fanout=None):
         """
         Returns full path, from domain and selector
         Checks selector & domain sanity (character whitelist)
         Returns None if parameters were invalid.
+
+        :param fanout: number of fan-out levels, defaults to the current
+            layout's
         """
         if not format_check.is_valid_fullselector(selector):
             log.error("Provided selector (hex: %s) contains forbidden "
@@ -318,36 +1319,225 @@ class DiskStorage(Storage):
         if '/%' not in selector:
             # no trailing '/' before the hash - add it
             selector = selector.replace('%', '/%')
-        path = os.path.join(self.basepath, domain, selector[1:])
+        if fanout is None:
+            fanout = self.fanout
+        if fanout:
+            prefix, digest = selector.rsplit('%', 1)
+            selector = prefix + ''.join(digest[2*i:2*i+2] + '/' for i in
+                                        range(fanout)) + '%' + digest
+        path = os.path.join(self.shard_paths[self._shard_of(domain, selector)],
+                            domain, selector[1:])
         return path
 
+    def _paths(self, domain, selector):
+        """
+        Returns the paths where a selector's files may be found: in the
+        current layout, then in the former one while migrating.
+        """
+        paths = [self._pathFromSelector(domain, selector)]
+        if self.migrating_from is not None:
+            paths.append(self._pathFromSelector(domain, selector,
+                                                self.migrating_from))
+        return paths
+
+    def _locate(self, domain, selector):
+        """
+        Returns the path of a selector's files, which may not have been moved
+        to the current directory layout yet. Returns None if parameters were
+        invalid.
+        """
+        paths = self._paths(domain, selector)
+        for path in paths:
+            if path and os.path.isfile(path + '.meta'):
+                return path
+        return paths[0]
+
+    @staticmethod
+    def _move_files(src, dst):
+        """
+        Renames a selector's files. .meta is renamed last, so that files are
+        found in the former layout until both have been moved.
+        """
+        for ext in ('.value', '.meta'):
+            if os.path.isfile(src + ext):
+                os.rename(src + ext, dst + ext)
+
+    def _move(self, domain, selector):
+        """
+        Moves a selector's files from the former directory layout to the
+        current one, unless this has already been done.
+        """
+        src = self._pathFromSelector(domain, selector, self.migrating_from)
+        if not src or not os.path.isfile(src + '.meta'):
+            return
+        dst = self._mkdirs(domain, selector)
+        basepath = self.shard_paths[self._shard_of(domain, selector)]
+        relname = src[len(basepath):]
+        _write_record(self._journal, ('move', relname, domain, selector))
+        self._move_files(src, dst)
+        _write_record(self._journal, ('end', relname))
+        self._remove_empty_dirs(os.path.dirname(src), basepath)
+        self._unsynced_files.extend((dst + '.value', dst + '.meta'))
+        self._unsynced_count += 1
+        if self._unsynced_count >= (self.fsync_batch or _JOURNAL_CHECKPOINT):
+            self._checkpoint()
+
+    @synchronized
+    def migrate_layout(self, limit=0):
+        """
+        Moves descriptors stored using the former directory layout to the
+        current one, in insertion order. The end of the migration is recorded
+        once all descriptors have been visited. Returns the number of visited
+        descriptors, 0 if migration has finished.
+
+        :param limit: max number of descriptors to visit. Unlimited if 0.
+        """
+        self._check_writable()
+        if self.migrating_from is None:
+            return 0
+        visited = 0
+        for domain in sorted(self.selindex.roots):
+            if domain in self._migrated_domains:
+                continue
+            selectors, after = self.selindex.find_by_prefix_page(
+                domain, '', limit - visited if limit else 0,
+                self._migration_cursor.get(domain))
+            for selector in selectors:
+                self._move(domain, selector)
+            visited += len(selectors)
+            if after is None:
+                self._migrated_domains.add(domain)
+            else:
+                self._migration_cursor[domain] = after
+            if limit and visited >= limit:
+                return visited
+        if visited == 0:
+            self._checkpoint()
+            log.info("Finished migrating %s from fan-out %d to %d",
+                     self.basepath, self.migrating_from, self.fanout)
+            self.migrating_from = None
+            self._write_layout()
+            self._migration_cursor = {}
+            self._migrated_domains = set()
+        return visited
+
+    def _migrate_loop(self, batch_size, pause):
+        try:
+            while self.migrate_layout(batch_size):
+                time.sleep(pause)
+        except Exception:
+            log.error("Directory layout migration failed", exc_info=1)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise IOError('Storage %s has been opened read-only' %
+                          self.basepath)
+
+    @synchronized
     def add(self, descriptor):
+        self._check_writable()
         selector = descriptor.selector
         domain = descriptor.domain
         fname = self._mkdirs(domain, selector)
         if not fname:
             # error occurred while making directories
             return False
-        if os.path.isfile(fname + '.meta'):
+        if os.path.isfile(self._locate(domain, selector) + '.meta'):
             # File already exists
             return False
 
-        self._register_meta(descriptor)
-
-        serialized_meta = descriptor.serialize_meta(store_serializer)
-        serialized_value = descriptor.serialize_value(store_serializer)
+        if isinstance(descriptor.value, str):
+            value_format = _VALUE_RAW
+            serialized_value = descriptor.value
+        else:
+            value_format = _VALUE_PICKLE
+            serialized_value = descriptor.serialize_value(store_serializer)
+        serialized_value, compressed = self.compression.compress(
+            selector, serialized_value)
+        digest = value_digest(serialized_value) if self.dedup else None
+        serialized_meta = _serialize_meta(descriptor, value_format,
+                                          'zlib' if compressed else None,
+                                          digest, len(serialized_value))
 
-        # Write meta
-        with open(fname + '.meta', 'wb') as fp:
+        basepath = self.shard_paths[self._shard_of(domain, selector)]
+        relname = fname[len(basepath):]
+        if self.fsync_batch and not self._batch_started:
+            # Files are flushed to disk at the next checkpoint. Until then,
+            # this record, which must reach the disk before they are renamed,
+            # lets recovery check them even if their 'begin' records are
+            # lost.
+            _write_record(self._journal, ('batch', time.time()), sync=True)
+            self._batch_started = True
+        _write_record(self._journal, ('begin', relname, domain, selector,
+                                      len(serialized_value),
+                                      len(serialized_meta), digest))
+        # Write value, then meta to temporary files, and rename them. The
+        # presence of the .meta file indicates the write has completed.
+        if digest is None:
+            with open(fname + '.value.tmp', 'wb') as fp:
+                fp.write(serialized_value)
+        else:
+            self._link_value(basepath, fname + '.value.tmp', digest,
+                             serialized_value)
+        with open(fname + '.meta.tmp', 'wb') as fp:
             fp.write(serialized_meta)
+        os.rename(fname + '.value.tmp', fname + '.value')
+        os.rename(fname + '.meta.tmp', fname + '.meta')
+
+        self._register_meta(descriptor)
+        self._append_delta(descriptor)
+        if self.ngram is not None:
+            self.ngram.add(domain, selector, descriptor.value)
+        _write_record(self._journal, ('end', relname))
 
-        # Write value
-        with open(fname + '.value', 'wb') as fp:
-            fp.write(serialized_value)
+        self._unsynced_files.extend((fname + '.value', fname + '.meta'))
+        self._unsynced_count += 1
+        if self._unsynced_count >= (self.fsync_batch or _JOURNAL_CHECKPOINT):
+            self._checkpoint()
 
         return True
 
+    def _value_path(self, basepath, digest):
+        return os.path.join(basepath, _VALUES_DIR, digest[:2], digest[2:])
+
+    def _link_value(self, basepath, fname, digest, contents):
+        """
+        Creates fname as a hard link to the deduplicated value having this
+        digest, which is written first if the shard does not contain it, or
+        if the stored value has been truncated by a crash.
+        """
+        path = self._value_path(basepath, digest)
+        if os.path.lexists(fname):
+            os.remove(fname)
+        if os.path.isfile(path):
+            if os.path.getsize(path) == len(contents):
+                os.link(path, fname)
+                return
+            log.warning("Replacing truncated deduplicated value %s", digest)
+            os.remove(path)
+        with open(fname, 'wb') as fp:
+            fp.write(contents)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # if this link is lost, the value is written again when needed
+        os.link(fname, path)
+
+    def _unlink_value(self, basepath, fname, digest):
+        """
+        Removes a descriptor's .value file, and the deduplicated value it
+        refers to if no other descriptor does.
+        """
+        os.remove(fname + '.value')
+        if digest is None:
+            return
+        path = self._value_path(basepath, digest)
+        if os.path.isfile(path) and os.stat(path).st_nlink == 1:
+            os.remove(path)
+            self._remove_empty_dirs(os.path.dirname(path), basepath)
+
+    @synchronized
     def mark_processed(self, domain, selector, agent_name, config_txt):
+        self._check_writable()
         result = self.db.add_processed(domain, selector, agent_name,
                                        config_txt)
         # Remove from processable
@@ -358,6 +1548,7 @@ class DiskStorage(Storage):
                 self.processable[domain][selector].discard(key)
         return result
 
+    @synchronized
     def mark_processable(self, domain, selector, agent_name, config_txt):
         result = False
         key = (agent_name, config_txt)
@@ -370,9 +1561,11 @@ class DiskStorage(Storage):
                 result = True
         return result
 
+    @synchronized
     def get_processed(self, domain, selector):
         return self.db.list_processed(domain, selector)
 
+    @synchronized
     def get_processable(self, domain, selector):
         return self.processable[domain][selector]
 
@@ -384,6 +1577,7 @@ class DiskStorage(Storage):
         return self.db.processed_stats(domain)
 
     def store_agent_state(self, agent_name, state):
+        self._check_writable()
         fname = os.path.join(self.basepath, 'agent_intstate', agent_name +
                              '.intstate')
         with open(fname, 'wb') as fp:
@@ -397,6 +1591,176 @@ class DiskStorage(Storage):
         with open(fname, 'rb') as fp:
             return fp.read()
 
+    @synchronized
+    def store_state(self):
+        if self.read_only:
+            return
+        self.db.flush()
+        self._checkpoint()
+        self._write_catalog()
+        if self.ngram is not None:
+            self._write_ngram_index()
+        log.info("Descriptor cache: %(entries)d entries (%(size)d bytes), "
+                 "hit ratio %(hit_ratio).2f, %(evictions)d evictions",
+                 self.cache_stats())
+        for prefix, stats in sorted(self.compression_stats().items()):
+            log.info("Compression of %s* values: %d/%d compressed, %d bytes "
+                     "stored for %d bytes", prefix, stats['compressed'],
+                     stats['values'], stats['stored_bytes'],
+                     stats['original_bytes'])
+        if self.dedup:
+            log.info("Value deduplication: %(references)d values, "
+                     "%(unique_values)d distinct, %(logical_bytes)d bytes "
+                     "stored in %(stored_bytes)d bytes (ratio %(ratio).2f)",
+                     self.dedup_stats())
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        """
+        Stops background removals, then closes files and databases. Storing
+        state is up to the caller.
+        """
+        if self.collector is not None:
+            self.collector.stop()
+        with self._lock:
+            for fp in (self._journal, self._delta):
+                if fp is not None:
+                    fp.close()
+            self._journal = self._delta = None
+            self.db.close()
+
+    def collect_garbage(self, limit=0, resume=False):
+        if not self.retention:
+            return 0
+        self._check_writable()
+        with self._lock:
+            if not resume:
+                # most recent first, in each domain. The metadata database
+                # only knows the insertion order within each shard.
+                selectors = [(domain, selector)
+                             for domain in self.selindex.roots
+                             for _, selector in self.selindex.iter_prefix(
+                                 domain, '', reverse=True)]
+                self._gc_scan = self.retention.scan(
+                    selectors, self._describe, self.lineage.children_of)
+        removed = 0
+        # the lock is released between scanned descriptors
+        while not limit or removed < limit:
+            with self._lock:
+                step = next(self._gc_scan, None) if self._gc_scan else None
+                if step is None:
+                    self._gc_scan = None
+                    break
+                domain, selector, expired = step
+                if expired:
+                    self._remove(domain, selector)
+                    removed += 1
+                    self._gc_removed = True
+        with self._lock:
+            if removed:
+                self.db.flush()
+                self._checkpoint()
+            if self._gc_scan is None and self._gc_removed:
+                # the catalog delta only records added descriptors: write
+                # the catalog once the scan has ended
+                self._write_catalog()
+                self._gc_removed = False
+        return removed
+
+    def _describe(self, domain, selector):
+        """
+        Returns (uuid, time added) of a selector, None if its metadata could
+        not be read.
+        """
+        meta = self._get_meta(domain, selector)
+        if meta is None:
+            return None
+        return meta[0].uuid, os.path.getmtime(
+            self._locate(domain, selector) + '.meta')
+
+    def _remove(self, domain, selector):
+        """
+        Removes a stored descriptor's files, database rows and index
+        entries. Removal is journaled, and finished by _recover_journal if it
+        is interrupted.
+        """
+        desc, _, _, digest = self._get_meta(domain, selector)
+        fname = self._locate(domain, selector)
+        basepath = self.shard_paths[self._shard_of(domain, selector)]
+        relname = fname[len(basepath):]
+        _write_record(self._journal, ('remove', relname, domain, selector))
+        self.db.remove_selector(domain, selector)
+        os.remove(fname + '.meta')
+        self._unlink_value(basepath, fname, digest)
+        _write_record(self._journal, ('end', relname))
+        self._unsynced_files = [path for path in self._unsynced_files
+                                if path.rsplit('.', 1)[0] != fname]
+        self._remove_empty_dirs(os.path.dirname(fname), basepath)
+
+        self.descriptor_count -= 1
+        selprefix = selector.split('%')[0]
+        versions = self.version_cache[domain][selprefix]
+        if versions.get(desc.version) == selector:
+            del versions[desc.version]
+        if not versions:
+            del self.version_cache[domain][selprefix]
+        self.lineage.remove(domain, selector)
+        uuid_selectors = self.uuids[domain][desc.uuid]
+        uuid_selectors.discard(selector)
+        if not uuid_selectors:
+            del self.uuids[domain][desc.uuid]
+            self.labels[domain].pop(desc.uuid, None)
+        self.processable[domain].pop(selector, None)
+        self.selindex.remove(domain, selector)
+        if self.ngram is not None:
+            self.ngram.remove(domain, selector)
+        self.cache.pop(('meta', domain, selector))
+        self.cache.pop(('value', domain, selector))
+
+    def _remove_empty_dirs(self, path, basepath):
+        """
+        Removes path and its parent directories, up to the shard's base path,
+        as long as they are empty.
+        """
+        while len(path) > len(basepath):
+            try:
+                os.rmdir(path)
+            except OSError:
+                # not empty
+                break
+            self.existing_paths.discard(path + '/')
+            path = os.path.dirname(path)
+
+    def compression_stats(self):
+        """
+        Returns a dictionary mapping compression rule prefixes to counters
+        of values added since startup: values, compressed, original_bytes,
+        stored_bytes.
+        """
+        return dict(self.compression.stats)
+
+    @synchronized
+    def dedup_stats(self):
+        """
+        Counts deduplicated values by walking the values directory of each
+        shard. Values written without deduplication are not counted.
+        """
+        references = unique_values = logical_bytes = stored_bytes = 0
+        for basepath in self.shard_paths:
+            for path, _, names in os.walk(os.path.join(basepath,
+                                                       _VALUES_DIR)):
+                for name in names:
+                    stat = os.stat(os.path.join(path, name))
+                    references += stat.st_nlink - 1
+                    unique_values += 1
+                    logical_bytes += stat.st_size * (stat.st_nlink - 1)
+                    stored_bytes += stat.st_size
+        return dedup_stats(references, unique_values, logical_bytes,
+                           stored_bytes)
+
+    @synchronized
     def list_unprocessed_by_agent(self, agent_name, config_txt):
         dom_sel = self.db.list_unprocessed_by_agent(agent_name, config_txt)
         res = []
@@ -416,3 +1780,79 @@ class DiskStorage(Storage):
         subparser.add_argument(
             "--path", help="Disk storage path (defaults to /tmp/rebus)",
             default="/tmp/rebus")
+        subparser.add_argument(
+            "--shard-path", action="append", default=[], metavar="PATH",
+            help="Additional directory holding descriptors, typically on "
+            "another disk. Each shard has its own metadata database. May be "
+            "used several times when the storage is created; shard paths are "
+            "then recorded in --path, and only have to be given again if "
+            "shards have been moved.")
+        subparser.add_argument(
+            "--shard-by", choices=_SHARD_BY, default=None,
+            help="Spread descriptors across shards by hash (default) or by "
+            "domain")
+        subparser.add_argument(
+            "--fsync-batch", type=int, default=_JOURNAL_CHECKPOINT,
+            help="Flush written descriptors to disk every FSYNC_BATCH "
+            "descriptors; the intent journal is flushed once per batch. "
+            "0 disables fsync calls.")
+        subparser.add_argument(
+            "--read-only", action="store_true",
+            help="Open an existing storage without modifying it, e.g. to copy "
+            "its descriptors to another storage. Only descriptors, values, "
+            "processed and agent states may be read.")
+        subparser.add_argument(
+            "--db-commit-batch", type=int, default=1,
+            help="Max number of metadata database inserts grouped in a "
+            "transaction. Values > 1 enable write-behind mode.")
+        subparser.add_argument(
+            "--db-commit-interval", type=float, default=1.0,
+            help="In write-behind mode, max age (seconds) of metadata "
+            "database inserts that have not been committed")
+        subparser.add_argument(
+            "--db-readers", type=int, default=4,
+            help="Number of read-only metadata database connections used by "
+            "queries, which then do not wait for inserts. 0 runs queries on "
+            "the writer connection.")
+        subparser.add_argument(
+            "--discover-processes", type=int,
+            default=multiprocessing.cpu_count(),
+            help="Number of processes used to read descriptor metadata when "
+            "the catalog snapshot is missing or stale")
+        subparser.add_argument(
+            "--rediscover", action="store_true",
+            help="Ignore the catalog snapshot, enumerate existing descriptor "
+            "files")
+        subparser.add_argument(
+            "--cache-size", type=int, default=64*1024*1024,
+            help="Max size (bytes) of the in-memory cache of decoded "
+            "descriptor metadata and values. 0 disables caching.")
+        subparser.add_argument(
+            "--compress", action="append", default=[], type=parse_rule,
+            metavar="PREFIX=POLICY",
+            help="Compression policy for values whose selector starts with "
+            "PREFIX: none, zlib:N (level 1 to 9), or auto (compress if a "
+            "sample compresses well). May be used several times, the longest "
+            "matching prefix applies. /compressed/ and /archive/ values are "
+            "never compressed.")
+        subparser.add_argument(
+            "--no-dedup", action="store_true",
+            help="Write each value to its own file. By default, identical "
+            "stored values are written once per shard, and hard-linked.")
+        subparser.add_argument(
+            "--fanout", type=int, default=None,
+            help="Number of directory levels, each named after 2 characters "
+            "of the hash, between a selector's directory and its files. "
+            "Recorded when the storage is created (default %d; storages "
+            "created by former versions have 0). If it differs from the "
+            "recorded value, existing descriptors are moved to the new layout "
+            "in the background." % _DEFAULT_FANOUT)
+        subparser.add_argument(
+            "--migrate-batch", type=int, default=1000,
+            help="Max number of descriptors moved at once while migrating to "
+            "a new --fanout. 0 disables background migration.")
+        subparser.add_argument(
+            "--migrate-pause", type=float, default=0.1,
+            help="Pause (seconds) between two batches of moved descriptors")
+        add_ngram_arguments(subparser)
+        add_retention_arguments(subparser)
@@ -1,8 +1,27 @@
-from rebus.storage import Storage
+from rebus.storage import Storage, parse_cursor, make_cursor
+from rebus.tools.bitset import Bitset
+from rebus.tools.dedup import ValueRefs, value_digest
+from rebus.tools.lineage import LineageIndex
+from rebus.tools.locking import synchronized
+from rebus.tools.lru import ByteLRU, SpillFile
+from rebus.tools.ngram_index import NgramIndex, add_ngram_arguments
+from rebus.tools.retention import RetentionPolicy, add_retention_arguments, \
+    start_collector
+from rebus.tools.selector_index import SelectorIndex
+from rebus.tools.serializer import picklev2 as spill_serializer
+import copy
+import logging
 import re
+import threading
+import time
+from array import array
 from collections import defaultdict
 from collections import OrderedDict
 from collections import Counter
+log = logging.getLogger("rebus.storage.ramstorage")
+
+#: returned by ByteLRU.get for uncached values
+_MISSING = object()
 
 
 @Storage.register
@@ -22,76 +41,228 @@ class RAMStorage(Storage):
         #: where 1234 is the hash of this selector's version 42
         self.version_cache = defaultdict(lambda: defaultdict(dict))
 
-        #: self.edges['domain']['selectorA'] is a set of selectors of
-        #: descriptors that were spawned from selectorA.
-        self.edges = defaultdict(lambda: defaultdict(set))
+        #: precursors and children of stored descriptors
+        self.lineage = LineageIndex()
+
+        #: self.selector_ids['domain']['/selector/%hash'] is a dense integer
+        #: id, used as an index in processed state bitsets
+        self.selector_ids = defaultdict(dict)
+
+        #: self.selectors['domain'][selector id] is a selector, or None if it
+        #: has been removed
+        self.selectors = defaultdict(list)
+
+        #: self.added_times['domain'][selector id] is the time at which the
+        #: descriptor has been added
+        self.added_times = defaultdict(lambda: array('d'))
+
+        #: self.agent_ids[(agent name, configuration text)] is a dense integer
+        #: id
+        self.agent_ids = {}
+
+        #: self.agent_keys[agent id] is (agent name, configuration text)
+        self.agent_keys = []
+
+        #: self.agent_name_ids['agent name'] is the list of ids of this
+        #: agent's configurations
+        self.agent_name_ids = defaultdict(list)
+
+        #: self.processed['domain'][agent id] is a Bitset of ids of selectors
+        #: that this (agent name, configuration text) has finished processing,
+        #: or declined to process.
+        self.processed = defaultdict(lambda: defaultdict(Bitset))
+
+        #: self.processed_counts['domain']['agent name'] is the number of
+        #: selectors processed by at least one configuration of this agent.
+        #: Used by processed_stats.
+        self.processed_counts = defaultdict(Counter)
+
+        #: self.processable['domain'][agent id] is a Bitset of ids of
+        #: selectors that this (agent name, configuration text), running in
+        #: interactive mode, is able to process.
+        self.processable = defaultdict(lambda: defaultdict(Bitset))
+
+        #: self.uuids['domain']['uuid'] is the set of selectors that belong to
+        #: descriptors having this uuid
+        self.uuids = defaultdict(lambda: defaultdict(set))
 
-        #: self.processed['domain']['/selector/%hash'] is a set of (agent name,
-        #: configuration text) that have finished processing, or declined to
-        #: process this descriptor.
-        #: Order is kept for find requests & co-maintainability of
-        #: {RAM,Disk}storage implementations.
-        self.processed = defaultdict(OrderedDict)
+        #: self.labels['domain']['uuid'] is the label of descriptors having
+        #: this UUID
+        self.labels = defaultdict(lambda: defaultdict(str))
 
-        #: self.processable['domain']['/selector/%hash'] is a set of (agent
-        #: name, configuration text) that are running in interactive mode, and
-        #: are able to process this descriptor.
-        self.processable = defaultdict(lambda: defaultdict(set))
+        #: self.agents['domain']['agent'] is the set of selectors of
+        #: descriptors produced by this agent
+        self.agents = defaultdict(lambda: defaultdict(set))
 
         #: internal state of agents
         self.internal_state = {}
 
-    def find(self, domain, selector_regex, limit=0, offset=0):
-        regex = re.compile(selector_regex)
-        sel_list = reversed(self.processed[domain].keys())
-        result = []
+        #: index of selectors, used by find and find_by_selector
+        self.selindex = SelectorIndex()
 
-        for k in sel_list:
-            if regex.match(k):
-                if offset > 0:
-                    offset -= 1
-                    continue
-                result.append(k)
-                if limit != 0 and len(result) >= limit:
-                    return result
-        return result
+        #: optional trigram index of values, used by find_by_value
+        self.ngram = None
+        if options is not None and options.ngram_index:
+            self.ngram = NgramIndex(options.ngram_max_value_size)
+
+        #: When a memory budget is set, descriptors in self.dstore have no
+        #: value. Values are kept in self.values, least recently used ones
+        #: being evicted to self.spill.
+        self.values = None
+        self.spill = None
+        #: self.spilled[(domain, selector)] is the (offset, length) of the
+        #: serialized value in self.spill
+        self.spilled = {}
+        if options is not None and options.max_memory:
+            self.values = ByteLRU(options.max_memory)
+            self.spill = SpillFile(options.spill_dir)
 
+        #: Byte string values are stored once. self.value_digests[(domain,
+        #: selector)] is the digest of a selector's byte string value;
+        #: self.value_refs counts selectors referring to each digest. Values
+        #: are kept in self.shared_values[digest], or in self.values if a
+        #: memory budget is set.
+        self.value_digests = {}
+        self.value_refs = ValueRefs()
+        self.shared_values = {}
+
+        #: Held while expired descriptors are being removed
+        self._lock = threading.RLock()
+        #: chooses which descriptors may be removed by collect_garbage
+        self.retention = RetentionPolicy(
+            options.retention if options is not None else [])
+        #: scan of stored descriptors resumed by collect_garbage, None if no
+        #: scan is in progress
+        self._gc_scan = None
+        self.collector = None
+        if options is not None:
+            self.collector = start_collector(self, options)
+
+    @staticmethod
+    def _value_size(value):
+        if isinstance(value, basestring):
+            return len(value)
+        return len(spill_serializer.dumps(value))
+
+    def _cache_value(self, key, value):
+        """
+        Keep value in memory, spill evicted values that have never been
+        spilled before - values of selectors having a hash never change.
+        """
+        for evkey, evvalue in self.values.put(key, value,
+                                              self._value_size(value)):
+            if evkey not in self.spilled:
+                self.spilled[evkey] = self.spill.write(
+                    spill_serializer.dumps(evvalue))
+
+    def _load_value(self, domain, selector, cache=True):
+        """
+        Returns the value of a known selector, reading it from the spill file
+        if needed.
+
+        :param cache: keep the value in memory if it had been spilled
+        """
+        if self.values is None:
+            return self.dstore[domain][selector].value
+        key = self.value_digests.get((domain, selector), (domain, selector))
+        value = self.values.get(key, _MISSING)
+        if value is _MISSING:
+            value = spill_serializer.loads(self.spill.read(*self.spilled[key]))
+            if cache:
+                self._cache_value(key, value)
+        return value
+
+    def _get(self, domain, selector):
+        """
+        Returns the descriptor of a known selector, including its value.
+        """
+        desc = self.dstore[domain][selector]
+        if self.values is None:
+            return desc
+        desc = copy.copy(desc)
+        desc.value = self._load_value(domain, selector)
+        return desc
+
+    def cache_stats(self):
+        if self.values is None:
+            return {}
+        stats = self.values.stats()
+        stats['spilled'] = len(self.spilled)
+        stats['spill_size'] = self.spill.size
+        return stats
+
+    def dedup_stats(self):
+        return self.value_refs.stats()
+
+    @synchronized
+    def find(self, domain, selector_regex, limit=0, offset=0):
+        return self.selindex.find(domain, selector_regex, limit, offset)
+
+    @synchronized
     def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
-        result = []
-        for selector in self.processed[domain].keys():
-            if selector.startswith(selector_prefix):
-                if offset > 0:
-                    offset -= 1
-                    continue
-                desc = self.dstore[domain][selector]
-                result.append(desc)
-                if limit != 0 and len(result) >= limit:
-                    return result
-        return result
+        return [self._get(domain, selector) for selector in
+                self.selindex.find_by_prefix(domain, selector_prefix, limit,
+                                             offset)]
 
+    @synchronized
+    def find_page(self, domain, selector_regex, limit, cursor=''):
+        selectors, position = self.selindex.find_page(
+            domain, selector_regex, limit, parse_cursor(cursor))
+        return selectors, make_cursor(position)
+
+    @synchronized
+    def find_by_selector_page(self, domain, selector_prefix, limit,
+                              cursor=''):
+        selectors, position = self.selindex.find_by_prefix_page(
+            domain, selector_prefix, limit, parse_cursor(cursor))
+        return ([self._get(domain, selector) for selector in selectors],
+                make_cursor(position))
+
+    @synchronized
     def find_by_uuid(self, domain, uuid):
-        result = []
-        for _, desc in self.dstore[domain].iteritems():
-            if desc.uuid == uuid:
-                result.append(desc)
-        return result
+        if uuid not in self.uuids[domain]:
+            return []
+        return [self._get(domain, selector) for selector in
+                self.uuids[domain][uuid]]
 
+    @synchronized
+    def find_by_agent(self, domain, agent_name):
+        """
+        Return a list of descriptors produced by agent_name.
+
+        Unspecified list order.
+        """
+        if agent_name not in self.agents[domain]:
+            return []
+        return [self._get(domain, selector) for selector in
+                self.agents[domain][agent_name]]
+
+    @synchronized
     def find_by_value(self, domain, selector_prefix, value_regex):
         result = []
-        for _, desc in self.dstore[domain].iteritems():
-            if desc.selector.startswith(selector_prefix) and \
-                    re.match(value_regex, desc.value):
-                result.append(desc)
+        selectors = None
+        if self.ngram is not None:
+            selectors = self.ngram.candidates(domain, value_regex)
+        if selectors is None:
+            selectors = self.dstore[domain].iterkeys()
+        for selector in selectors:
+            if selector.startswith(selector_prefix) and \
+                    re.match(value_regex,
+                             self._load_value(domain, selector, cache=False)):
+                result.append(self._get(domain, selector))
         return result
 
+    @synchronized
     def list_uuids(self, domain):
-        result = dict()
-        for desc in self.dstore[domain].values():
-            # Heuristic for choosing uuid label : prefer label of a descriptor
-            # that has no precursor
-            if desc.uuid not in result or not desc.precursors:
-                result[desc.uuid] = desc.label
-        return result
+        return dict(self.labels[domain])
+
+    @synchronized
+    def list_selectors(self):
+        return [(domain, selector) for domain, descs in
+                self.dstore.iteritems() for selector in descs]
+
+    def list_agent_states(self):
+        return self.internal_state.keys()
 
     def _version_lookup(self, domain, selector):
         """
@@ -115,102 +286,288 @@ class RAMStorage(Storage):
                 selector = None
         return selector
 
+    @synchronized
     def get_descriptor(self, domain, selector):
         selector = self._version_lookup(domain, selector)
 
         # Check whether domain & selector are known
         if domain not in self.dstore or selector not in self.dstore[domain]:
             return None
-        return self.dstore[domain][selector]
+        return self._get(domain, selector)
 
+    @synchronized
     def get_value(self, domain, selector):
         selector = self._version_lookup(domain, selector)
 
         # Check whether domain & selector are known
         if domain not in self.dstore or selector not in self.dstore[domain]:
             return None
-        return self.dstore[domain][selector].value
+        return self._load_value(domain, selector)
 
+    @synchronized
     def get_children(self, domain, selector, recurse=True):
-        result = set()
-        if selector not in self.dstore[domain]:
-            return result
-        for child in self.edges[domain][selector]:
-            result.add(self.dstore[domain][child])
-            if recurse:
-                result |= self.get_children(child, domain, recurse)
-        return result
+        return set(self._get(domain, child) for child, _ in
+                   self.lineage.iter_descendants(domain, selector,
+                                                 0 if recurse else 1))
+
+    @synchronized
+    def get_descendants(self, domain, selector, max_depth=0):
+        return list(self.lineage.iter_descendants(domain, selector,
+                                                  max_depth))
 
+    @synchronized
+    def get_ancestors(self, domain, selector, max_depth=0):
+        return list(self.lineage.iter_ancestors(domain, selector, max_depth))
+
+    @synchronized
+    def ancestry_summary(self, domain, selector):
+        return self.lineage.ancestry(domain, selector)
+
+    @synchronized
     def add(self, descriptor):
         selector = descriptor.selector
         domain = descriptor.domain
         if selector in self.dstore[domain]:
             return False
+        value = stored_value = descriptor.value
+        value_key = (domain, selector)
+        new_value = True
+        if isinstance(value, str):
+            value_key = self.value_digests[(domain, selector)] = \
+                value_digest(value)
+            new_value = self.value_refs.add(value_key, len(value))
+            if self.values is None:
+                stored_value = self.shared_values.setdefault(value_key,
+                                                             value)
+        if self.values is not None:
+            if new_value:
+                self._cache_value(value_key, value)
+            stored_value = None
+        if stored_value is not value:
+            descriptor = copy.copy(descriptor)
+            descriptor.value = stored_value
         self.dstore[domain][selector] = descriptor
         self.version_cache[domain][selector.split('%')[0]][descriptor.version]\
             = selector
-        for precursor in descriptor.precursors:
-            self.edges[domain][precursor].add(selector)
-        self.processed[domain][selector] = set()
+        self.lineage.add(domain, selector, descriptor.precursors)
+        self.selector_ids[domain][selector] = len(self.selectors[domain])
+        self.selectors[domain].append(selector)
+        self.added_times[domain].append(time.time())
+        self.uuids[domain][descriptor.uuid].add(selector)
+        if descriptor.uuid not in self.labels[domain] or \
+                not descriptor.precursors:
+            # Heuristic for choosing uuid label : prefer label of a descriptor
+            # that has no precursor
+            self.labels[domain][descriptor.uuid] = descriptor.label
+        self.agents[domain][descriptor.agent].add(selector)
+        self.selindex.add(domain, selector)
+        if self.ngram is not None:
+            self.ngram.add(domain, selector, value)
         return True
 
-    def mark_processed(self, domain, selector, agent_name, config_txt):
-        result = False
+    def _agent_id(self, agent_name, config_txt):
         key = (agent_name, config_txt)
+        agent_id = self.agent_ids.get(key)
+        if agent_id is None:
+            agent_id = self.agent_ids[key] = len(self.agent_keys)
+            self.agent_keys.append(key)
+            self.agent_name_ids[agent_name].append(agent_id)
+        return agent_id
+
+    @staticmethod
+    def _ids_having(bitsets, selector_id):
+        """
+        Returns the list of agent ids whose bitset contains selector_id.
+
+        :param bitsets: self.processed['domain'] or
+            self.processable['domain']
+        """
+        return [agent_id for agent_id, bitset in bitsets.iteritems()
+                if selector_id in bitset]
+
+    def _keys_having(self, bitsets, selector_id):
+        """
+        Returns the set of (agent name, configuration text) whose bitset
+        contains selector_id.
+
+        :param bitsets: self.processed['domain'] or
+            self.processable['domain']
+        """
+        return set(self.agent_keys[agent_id] for agent_id in
+                   self._ids_having(bitsets, selector_id))
+
+    @synchronized
+    def mark_processed(self, domain, selector, agent_name, config_txt):
+        selector_id = self.selector_ids[domain].get(selector)
+        if selector_id is None:
+            return False
+        agent_id = self._agent_id(agent_name, config_txt)
         # Add to processed if not already there
-        if key not in self.processed[domain][selector]:
-            result = True
-            self.processed[domain][selector].add(key)
+        result = self.processed[domain][agent_id].add(selector_id)
+        if result and not any(
+                selector_id in self.processed[domain][other_id]
+                for other_id in self.agent_name_ids[agent_name]
+                if other_id != agent_id):
+            self.processed_counts[domain][agent_name] += 1
         # Remove from processable
-        if selector in self.processable[domain]:
-            if key in self.processable[domain][selector]:
-                result = False
-                self.processable[domain][selector].discard(key)
+        if self.processable[domain][agent_id].discard(selector_id):
+            result = False
         return result
 
+    @synchronized
     def mark_processable(self, domain, selector, agent_name, config_txt):
-        result = False
-        key = (agent_name, config_txt)
-        if key not in self.processable[domain][selector]:
-            self.processable[domain][selector].add((agent_name, config_txt))
-            if key not in self.processed[domain][selector]:
-                # avoid case where two instances of an agent run in different
-                # modes
-                result = True
-        return result
+        selector_id = self.selector_ids[domain].get(selector)
+        if selector_id is None:
+            return False
+        agent_id = self._agent_id(agent_name, config_txt)
+        # avoid case where two instances of an agent run in different modes
+        return self.processable[domain][agent_id].add(selector_id) and \
+            selector_id not in self.processed[domain][agent_id]
 
+    @synchronized
     def get_processed(self, domain, selector):
-        return self.processed[domain][selector]
+        if selector not in self.selector_ids[domain]:
+            return set()
+        return self._keys_having(self.processed[domain],
+                                 self.selector_ids[domain][selector])
 
+    @synchronized
     def get_processable(self, domain, selector):
-        return self.processable[domain][selector]
+        if selector not in self.selector_ids[domain]:
+            return set()
+        return self._keys_having(self.processable[domain],
+                                 self.selector_ids[domain][selector])
 
+    @synchronized
     def processed_stats(self, domain):
         """
         Returns a list of couples, (agent names, number of processed selectors)
         and the total amount of selectors in this domain.
         """
-        result = Counter()
-        processed = self.processed[domain]
-        for agentlist in processed.values():
-            result.update([name for name, _ in agentlist])
-        return result.items(), len(processed)
+        return ([(agent_name, count) for agent_name, count in
+                 self.processed_counts[domain].iteritems() if count],
+                len(self.selector_ids[domain]))
 
+    @synchronized
     def list_unprocessed_by_agent(self, agent_name, config_txt):
         result = []
-        for domain in self.dstore.keys():
-            selectors = set(self.dstore[domain].keys())
-            processed_selectors = set([sel for sel, name_confs in
-                                       self.processed[domain].items() if
-                                       (agent_name, config_txt) in
-                                       name_confs])
-            unprocessed_sels = selectors - processed_selectors
-            result.extend([(domain, self.dstore[domain][sel].uuid, sel)
-                           for sel in unprocessed_sels])
+        agent_id = self._agent_id(agent_name, config_txt)
+        for domain, selectors in self.selectors.items():
+            dstore = self.dstore[domain]
+            processed = self.processed[domain][agent_id]
+            for selector_id in processed.iter_missing(len(selectors)):
+                selector = selectors[selector_id]
+                if selector is None:
+                    continue
+                result.append((domain, dstore[selector].uuid, selector))
         return result
 
+    def collect_garbage(self, limit=0, resume=False):
+        if not self.retention:
+            return 0
+        with self._lock:
+            if not resume:
+                selectors = [(domain, selector) for domain, dstore in
+                             self.dstore.items()
+                             for selector in reversed(dstore)]
+                self._gc_scan = self.retention.scan(
+                    selectors, self._describe, self.lineage.children_of)
+        removed = 0
+        # the lock is released between scanned descriptors
+        while not limit or removed < limit:
+            with self._lock:
+                step = next(self._gc_scan, None) if self._gc_scan else None
+                if step is None:
+                    self._gc_scan = None
+                    break
+                domain, selector, expired = step
+                if expired:
+                    self._remove(domain, selector)
+                    removed += 1
+        return removed
+
+    def _describe(self, domain, selector):
+        """
+        Returns (uuid, time added) of a selector, None if it is unknown.
+        """
+        selector_id = self.selector_ids[domain].get(selector)
+        if selector_id is None:
+            return None
+        return (self.dstore[domain][selector].uuid,
+                self.added_times[domain][selector_id])
+
+    def _remove(self, domain, selector):
+        """
+        Removes a known selector from all indexes.
+        """
+        desc = self.dstore[domain].pop(selector)
+        selprefix = selector.split('%')[0]
+        versions = self.version_cache[domain][selprefix]
+        if versions.get(desc.version) == selector:
+            del versions[desc.version]
+        if not versions:
+            del self.version_cache[domain][selprefix]
+        self.lineage.remove(domain, selector)
+        selector_id = self.selector_ids[domain].pop(selector)
+        self.selectors[domain][selector_id] = None
+        for agent_name in set(self.agent_keys[agent_id][0] for agent_id in
+                              self._ids_having(self.processed[domain],
+                                               selector_id)):
+            self.processed_counts[domain][agent_name] -= 1
+        for bitsets in (self.processed[domain], self.processable[domain]):
+            for bitset in bitsets.itervalues():
+                bitset.discard(selector_id)
+        uuid_selectors = self.uuids[domain][desc.uuid]
+        uuid_selectors.discard(selector)
+        if not uuid_selectors:
+            del self.uuids[domain][desc.uuid]
+            self.labels[domain].pop(desc.uuid, None)
+        agent_selectors = self.agents[domain][desc.agent]
+        agent_selectors.discard(selector)
+        if not agent_selectors:
+            del self.agents[domain][desc.agent]
+        self.selindex.remove(domain, selector)
+        if self.ngram is not None:
+            self.ngram.remove(domain, selector)
+        value_key = (domain, selector)
+        digest = self.value_digests.pop((domain, selector), None)
+        if digest is not None:
+            # other selectors may refer to the same value
+            value_key = digest if self.value_refs.remove(digest) else None
+            if value_key is not None:
+                self.shared_values.pop(digest, None)
+        if self.values is not None and value_key is not None:
+            # space used in the spill file is not reclaimed
+            self.values.pop(value_key)
+            self.spilled.pop(value_key, None)
+
     def store_agent_state(self, agent_name, state):
         self.internal_state[agent_name] = state
 
     def load_agent_state(self, agent_name):
         return self.internal_state.get(agent_name, "")
+
+    def store_state(self):
+        if self.values is not None:
+            log.info("Value cache: %(entries)d values in memory (%(size)d "
+                     "bytes), hit ratio %(hit_ratio).2f, %(evictions)d "
+                     "evictions, %(spilled)d values spilled (%(spill_size)d "
+                     "bytes)", self.cache_stats())
+        log.info("Value deduplication: %(references)d byte string values, "
+                 "%(unique_values)d distinct, %(logical_bytes)d bytes stored "
+                 "in %(stored_bytes)d bytes (ratio %(ratio).2f)",
+                 self.dedup_stats())
+
+    @staticmethod
+    def add_arguments(subparser):
+        add_ngram_arguments(subparser)
+        add_retention_arguments(subparser)
+        subparser.add_argument(
+            "--max-memory", type=int, default=0,
+            help="Max size (bytes) of descriptor values kept in memory. Least "
+            "recently used values are spilled to a temporary file. 0 keeps "
+            "all values in memory.")
+        subparser.add_argument(
+            "--spill-dir",
+            help="Directory where the spill file is created (defaults to the "
+            "system's temporary directory)")
@@ -0,0 +1,748 @@
+import argparse
+import logging
+import os
+import re
+import struct
+import threading
+from collections import defaultdict
+from rebus.storage import Storage, MetadataDB, parse_cursor, make_cursor
+from rebus.descriptor import Descriptor
+from rebus.tools.lineage import LineageIndex
+from rebus.tools.selector_index import SelectorIndex
+from rebus.tools.serializer import picklev2 as store_serializer
+log = logging.getLogger("rebus.storage.segmentstorage")
+
+#: Version of the index snapshot format. Snapshots having another version are
+#: ignored, and segments are scanned again.
+INDEX_VERSION = 2
+
+#: Record header: record kind, key length, value length
+_HEADER = struct.Struct('<BII')
+#: Record containing a descriptor: the key is its serialized metadata, the
+#: value is its (raw or serialized) value
+_DESCRIPTOR = 1
+#: Record containing an agent's internal state: the key is the agent's name,
+#: the value is its serialized state
+_AGENT_STATE = 2
+
+#: Storage-private metadata key describing how the record value is encoded
+_VALUE_FORMAT_KEY = 'value_format'
+#: record value contains the serialized value
+_VALUE_PICKLE = 'pickle'
+#: record value contains the value itself, which is a byte string
+_VALUE_RAW = 'raw'
+
+_SEGMENT_NAME = re.compile(r'^segment-(\d{8})\.log$')
+
+
+@Storage.register
+class SegmentStorage(Storage):
+    """
+    Stores descriptors as records appended to large segment files, instead
+    of two files per descriptor. An offset index is kept in memory, and
+    snapshotted to disk by store_state().
+
+    Segments that mostly contain superseded records (ex. former agent
+    states) are compacted in the background: their live records are copied
+    to the current segment, then they are removed.
+    """
+
+    _name_ = "segmentstorage"
+    STORES_INTSTATE = True
+
+    def __init__(self, options):
+        self.basepath = options.path.rstrip('/')
+        if not os.path.isdir(self.basepath):
+            raise IOError('Directory %s does not exist' % self.basepath)
+        self.segment_size = options.segment_size
+        self.compact_ratio = options.compact_ratio
+        self.fsync_batch = options.fsync_batch
+        self.snapshot_path = os.path.join(self.basepath, 'index.snapshot')
+
+        #: Protects segment files and self.locations, which are modified by
+        #: the compaction thread
+        self._lock = threading.RLock()
+
+        #: self.locations['domain']['/selector/%hash'] = (segment number,
+        #: record offset, key length, value length, value format)
+        self.locations = defaultdict(dict)
+
+        #: self.state_locations['agent name'] = (segment number, record
+        #: offset, key length, value length)
+        self.state_locations = {}
+
+        #: self.version_cache['domain']['/selector/'][version] = /selector/%123
+        #: where 1234 is the hash of this selector's version 42
+        self.version_cache = defaultdict(lambda: defaultdict(dict))
+
+        #: precursors and children of stored descriptors
+        self.lineage = LineageIndex()
+
+        #: self.uuids['domain']['uuid'] is the set of selectors that belong to
+        #: descriptors having this uuid
+        self.uuids = defaultdict(lambda: defaultdict(set))
+
+        #: self.labels['domain']['uuid'] is the label of descriptors having
+        #: this UUID
+        self.labels = defaultdict(lambda: defaultdict(str))
+
+        #: index of selectors, ordered by insertion. Used by find and
+        #: find_by_selector
+        self.selindex = SelectorIndex()
+
+        #: self.processable['domain']['/selector/%hash'] is a set of (agent
+        #: name, configuration text) that are running in interactive mode, and
+        #: are able to process this descriptor.
+        #: This attribute is not saved to disk.
+        self.processable = defaultdict(lambda: defaultdict(set))
+
+        #: self.segment_bytes[segment number] = [total bytes, live bytes]
+        self.segment_bytes = {}
+
+        #: read-only file objects, by segment number
+        self._readers = {}
+
+        # A sqlite3 database records which (agent name, configuration text)
+        # have finished processing each (domain, /selector/%hash).
+        self.db = MetadataDB(
+            os.path.join(self.basepath, 'segmentstorage.sqlite3'),
+            options.db_commit_batch, options.db_commit_interval,
+            options.db_readers)
+
+        segments = self._list_segments()
+        position = None
+        if self._load_index():
+            position = self.position
+            for segno in segments[:]:
+                if segno < position[0] and segno not in self.segment_bytes:
+                    # compacted, but not removed before exiting
+                    log.info("Removing compacted segment %d", segno)
+                    os.remove(self._segment_path(segno))
+                    segments.remove(segno)
+        else:
+            self.segment_bytes = dict((segno, [0, 0]) for segno in segments)
+        self._scan(segments, position)
+
+        #: current segment number, and its file object, opened for appending
+        self.active = max(segments) if segments else 0
+        self._writer = None
+        self._open_active(self.active)
+        self._unsynced = 0
+
+        if options.import_diskstorage:
+            self.import_diskstorage(options.import_diskstorage)
+
+        self._closing = threading.Event()
+        self._compactor = None
+        if options.compact_interval > 0:
+            self._compactor = threading.Thread(
+                target=self._compact_loop, args=(options.compact_interval,))
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _segment_path(self, segno):
+        return os.path.join(self.basepath, 'segment-%08d.log' % segno)
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.basepath):
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _open_active(self, segno):
+        if self._writer:
+            self._writer.close()
+        self.active = segno
+        self._writer = open(self._segment_path(segno), 'ab')
+        self.segment_bytes.setdefault(segno, [0, 0])
+
+    def _reader(self, segno):
+        if segno == self.active:
+            self._writer.flush()
+        fp = self._readers.get(segno)
+        if fp is None:
+            fp = self._readers[segno] = open(self._segment_path(segno), 'rb')
+        return fp
+
+    def _read(self, segno, offset, length):
+        with self._lock:
+            fp = self._reader(segno)
+            fp.seek(offset)
+            return fp.read(length)
+
+    def _append_record(self, kind, key, value):
+        """
+        Appends a record to the active segment, starting a new segment if it
+        is full. Returns (segment number, record offset).
+        """
+        with self._lock:
+            if self.segment_bytes[self.active][0] >= self.segment_size:
+                self._sync()
+                self._open_active(self.active + 1)
+            offset = self.segment_bytes[self.active][0]
+            self._writer.write(_HEADER.pack(kind, len(key), len(value)))
+            self._writer.write(key)
+            self._writer.write(value)
+            size = _HEADER.size + len(key) + len(value)
+            self.segment_bytes[self.active][0] += size
+            self.segment_bytes[self.active][1] += size
+            self._unsynced += 1
+            if self.fsync_batch and self._unsynced >= self.fsync_batch:
+                self._sync()
+            return self.active, offset
+
+    def _sync(self):
+        self._writer.flush()
+        if self.fsync_batch:
+            os.fsync(self._writer.fileno())
+        self._unsynced = 0
+
+    def _iter_records(self, segno, start=0):
+        """
+        Yields (kind, record offset, key, key length, value length) for
+        records of a segment, starting at offset start. Values are not read.
+        A truncated record, left by an interrupted write, is removed.
+        """
+        path = self._segment_path(segno)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            offset = start
+            while offset < size:
+                fp.seek(offset)
+                header = fp.read(_HEADER.size)
+                if len(header) == _HEADER.size:
+                    kind, keylen, valuelen = _HEADER.unpack(header)
+                    end = offset + _HEADER.size + keylen + valuelen
+                    if end <= size:
+                        yield kind, offset, fp.read(keylen), keylen, valuelen
+                        offset = end
+                        continue
+                log.warning("Truncating incomplete record at offset %d of "
+                            "segment %d", offset, segno)
+                with open(path, 'r+b') as wfp:
+                    wfp.truncate(offset)
+                break
+
+    def _scan(self, segments, position):
+        """
+        Registers records written after position.
+
+        :param position: (segment number, offset) up to which segments are
+            described by the index snapshot, or None to scan all segments
+        """
+        scanned = 0
+        for segno in segments:
+            start = 0
+            if position is not None:
+                if segno < position[0]:
+                    continue
+                if segno == position[0]:
+                    start = position[1]
+            stats = self.segment_bytes.setdefault(segno, [0, 0])
+            for kind, offset, key, keylen, valuelen in \
+                    self._iter_records(segno, start):
+                size = _HEADER.size + keylen + valuelen
+                stats[0] += size
+                stats[1] += size
+                if kind == _DESCRIPTOR:
+                    meta = store_serializer.loads(key)
+                    self._register(meta, (segno, offset, keylen, valuelen))
+                elif kind == _AGENT_STATE:
+                    self._set_state_location(key, (segno, offset, keylen,
+                                                   valuelen))
+                scanned += 1
+        if scanned:
+            log.info("Scanned %d records from segments", scanned)
+
+    def _mark_dead(self, location):
+        """
+        Records that the record at location has been superseded.
+        """
+        segno, _, keylen, valuelen = location[:4]
+        if segno in self.segment_bytes:
+            self.segment_bytes[segno][1] -= _HEADER.size + keylen + valuelen
+
+    def _set_state_location(self, agent_name, location):
+        previous = self.state_locations.get(agent_name)
+        if previous is not None:
+            self._mark_dead(previous)
+        self.state_locations[agent_name] = location
+
+    def _register(self, meta, location):
+        """
+        Adds a descriptor to in-memory indexes.
+
+        :param meta: dictionary of descriptor attributes, including the
+            value format
+        :param location: (segment number, record offset, key length, value
+            length)
+        """
+        domain = meta['domain']
+        selector = meta['selector']
+        value_format = meta.get(_VALUE_FORMAT_KEY, _VALUE_PICKLE)
+        previous = self.locations[domain].get(selector)
+        self.locations[domain][selector] = location + (value_format,)
+        if previous is not None:
+            # copied by an interrupted compaction
+            self._mark_dead(previous)
+            return
+        self.db.add_selector(domain, selector)
+        self.version_cache[domain][selector.split('%')[0]][meta['version']]\
+            = selector
+        self.lineage.add(domain, selector, meta['precursors'])
+        uuid = meta['uuid']
+        self.uuids[domain][uuid].add(selector)
+        if not self.labels[domain][uuid] or not meta['precursors']:
+            # Heuristic for choosing uuid label : prefer label of a descriptor
+            # that has no precursor
+            self.labels[domain][uuid] = meta['label']
+        self.selindex.add(domain, selector)
+
+    def _load_index(self):
+        """
+        Restores in-memory indexes from the index snapshot. Returns False if
+        it is missing or unusable.
+        """
+        if not os.path.isfile(self.snapshot_path):
+            return False
+        try:
+            with open(self.snapshot_path, 'rb') as fp:
+                snapshot = store_serializer.load(fp)
+            if snapshot['version'] != INDEX_VERSION:
+                log.info("Ignoring index snapshot having version %s",
+                         snapshot['version'])
+                return False
+            for segno in snapshot['segment_bytes']:
+                if not os.path.isfile(self._segment_path(segno)):
+                    log.warning("Index snapshot refers to missing segment %d",
+                                segno)
+                    return False
+        except Exception:
+            log.warning("Could not load index snapshot %s",
+                        self.snapshot_path, exc_info=1)
+            return False
+        self.position = snapshot['position']
+        self.segment_bytes = snapshot['segment_bytes']
+        for domain, locations in snapshot['locations'].iteritems():
+            self.locations[domain].update(locations)
+        self.state_locations = snapshot['state_locations']
+        for domain, selectors in snapshot['version_cache'].iteritems():
+            for selprefix, versions in selectors.iteritems():
+                self.version_cache[domain][selprefix].update(versions)
+        self.lineage = LineageIndex.load(snapshot['lineage'])
+        for domain, uuids in snapshot['uuids'].iteritems():
+            for uuid, selectors in uuids.iteritems():
+                self.uuids[domain][uuid].update(selectors)
+        for domain, labels in snapshot['labels'].iteritems():
+            self.labels[domain].update(labels)
+        self.selindex = SelectorIndex.load(snapshot['selindex'])
+        return True
+
+    def _write_index(self):
+        """
+        Atomically replaces the index snapshot.
+        """
+        with self._lock:
+            self._sync()
+            snapshot = {
+                'version': INDEX_VERSION,
+                'position': (self.active, self.segment_bytes[self.active][0]),
+                'segment_bytes': self.segment_bytes,
+                'locations': dict(self.locations),
+                'state_locations': self.state_locations,
+                'version_cache': {
+                    d: {p: dict(v) for p, v in s.iteritems()}
+                    for d, s in self.version_cache.iteritems()},
+                'lineage': self.lineage.dump(),
+                'uuids': {d: dict(u) for d, u in self.uuids.iteritems()},
+                'labels': {d: dict(l) for d, l in self.labels.iteritems()},
+                'selindex': self.selindex.dump(),
+            }
+            tmppath = self.snapshot_path + '.tmp'
+            with open(tmppath, 'wb') as fp:
+                store_serializer.dump(snapshot, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmppath, self.snapshot_path)
+
+    def _compact_loop(self, interval):
+        while not self._closing.wait(interval):
+            try:
+                self.compact()
+            except Exception:
+                log.error("Segment compaction failed", exc_info=1)
+
+    def compact(self):
+        """
+        Copies live records of sealed segments whose live bytes ratio is lower
+        than self.compact_ratio to the active segment, then removes them.
+        Returns the number of removed segments.
+        """
+        with self._lock:
+            candidates = [
+                segno for segno, (total, live) in self.segment_bytes.items()
+                if segno != self.active and
+                (total == 0 or float(live) / total < self.compact_ratio)]
+        for segno in sorted(candidates):
+            self._compact_segment(segno)
+        if candidates:
+            self._write_index()
+            for segno in candidates:
+                os.remove(self._segment_path(segno))
+            log.info("Compacted %d segments", len(candidates))
+        return len(candidates)
+
+    def _compact_segment(self, segno):
+        """
+        Copies live records of segment segno to the active segment. The
+        segment is forgotten, but not removed.
+        """
+        with self._lock:
+            for kind, offset, key, keylen, valuelen in \
+                    self._iter_records(segno):
+                location = (segno, offset, keylen, valuelen)
+                if kind == _DESCRIPTOR:
+                    meta = store_serializer.loads(key)
+                    domain, selector = meta['domain'], meta['selector']
+                    current = self.locations[domain].get(selector)
+                    if current is None or current[:4] != location:
+                        continue
+                    value = self._read(segno, offset + _HEADER.size + keylen,
+                                       valuelen)
+                    newseg, newoffset = self._append_record(kind, key, value)
+                    self.locations[domain][selector] = \
+                        (newseg, newoffset, keylen, valuelen, current[4])
+                elif kind == _AGENT_STATE:
+                    if self.state_locations.get(key) != location:
+                        continue
+                    value = self._read(segno, offset + _HEADER.size + keylen,
+                                       valuelen)
+                    newseg, newoffset = self._append_record(kind, key, value)
+                    self.state_locations[key] = (newseg, newoffset, keylen,
+                                                 valuelen)
+            fp = self._readers.pop(segno, None)
+            if fp:
+                fp.close()
+            del self.segment_bytes[segno]
+
+    def close(self):
+        self._closing.set()
+        if self._compactor is not None:
+            # lets a running compaction finish
+            self._compactor.join()
+        self.store_state()
+        with self._lock:
+            self._writer.close()
+            for fp in self._readers.values():
+                fp.close()
+            self._readers.clear()
+        self.db.close()
+
+    def import_diskstorage(self, path):
+        """
+        Copies descriptors, processed and processable state and agent states
+        from a DiskStorage directory, which is opened read-only. Descriptors
+        that are already present are skipped.
+        """
+        from rebus.storage_backends.diskstorage import DiskStorage
+        parser = argparse.ArgumentParser()
+        DiskStorage.add_arguments(parser)
+        source = DiskStorage(parser.parse_args(
+            ['--path', path, '--read-only', '--cache-size', '0',
+             '--db-readers', '0']))
+        imported = 0
+        try:
+            for domain, selector in source.list_selectors():
+                desc = source.get_descriptor(domain, selector)
+                if desc is None:
+                    continue
+                desc.value = source.get_value(domain, selector)
+                if self.add(desc):
+                    imported += 1
+                for agent_name, config_txt in source.get_processed(
+                        domain, selector):
+                    self.db.add_processed(domain, selector, agent_name,
+                                          config_txt)
+                for agent_name, config_txt in source.get_processable(
+                        domain, selector):
+                    self.mark_processable(domain, selector, agent_name,
+                                          config_txt)
+            for agent_name in source.list_agent_states():
+                self.store_agent_state(agent_name,
+                                       source.load_agent_state(agent_name))
+        finally:
+            source.close()
+        self.store_state()
+        log.info("Imported %d descriptors from disk storage %s", imported,
+                 path)
+
+    def find(self, domain, selector_regex, limit=0, offset=0):
+        with self._lock:
+            return self.selindex.find(domain, selector_regex, limit, offset)
+
+    def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
+        with self._lock:
+            selectors = self.selindex.find_by_prefix(domain, selector_prefix,
+                                                     limit, offset)
+        return [self.get_descriptor(domain, selector) for selector in
+                selectors]
+
+    def find_page(self, domain, selector_regex, limit, cursor=''):
+        with self._lock:
+            selectors, position = self.selindex.find_page(
+                domain, selector_regex, limit, parse_cursor(cursor))
+        return selectors, make_cursor(position)
+
+    def find_by_selector_page(self, domain, selector_prefix, limit,
+                              cursor=''):
+        with self._lock:
+            selectors, position = self.selindex.find_by_prefix_page(
+                domain, selector_prefix, limit, parse_cursor(cursor))
+        return ([self.get_descriptor(domain, selector)
+                 for selector in selectors], make_cursor(position))
+
+    def find_by_uuid(self, domain, uuid):
+        with self._lock:
+            selectors = list(self.uuids[domain].get(uuid, ()))
+        return [self.get_descriptor(domain, selector) for selector in
+                selectors]
+
+    def find_by_value(self, domain, selector_prefix, value_regex):
+        result = []
+        with self._lock:
+            selectors = self.locations[domain].keys()
+        for selector in selectors:
+            if selector.startswith(selector_prefix) and \
+                    re.match(value_regex, self.get_value(domain, selector)):
+                result.append(self.get_descriptor(domain, selector))
+        return result
+
+    def list_uuids(self, domain):
+        with self._lock:
+            return dict((uuid, self.labels[domain][uuid])
+                        for uuid in self.uuids[domain])
+
+    def list_selectors(self):
+        return self.db.list_selectors()
+
+    def list_agent_states(self):
+        with self._lock:
+            return self.state_locations.keys()
+
+    def _version_lookup(self, domain, selector):
+        """
+        :param selector: selector, containing either a version (/selector/~12)
+        or a hash (/selector/%1234)
+        Perform version lookup if needed.
+        Returns a selector containing a hash value /selector/%1234
+        """
+        # if version is specified, but no hash
+        if '%' not in selector and '~' in selector:
+            selprefix, version = selector.split('~')
+            try:
+                intversion = int(version)
+                if intversion < 0:
+                    maxversion = max(self.version_cache[domain][selprefix])
+                    intversion = maxversion + intversion + 1
+                selector = self.version_cache[domain][selprefix][intversion]
+            except (KeyError, ValueError):
+                # ValueError: invalid version integer
+                # KeyError: unknown version
+                selector = None
+        return selector
+
+    def _location(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+        if not selector or domain not in self.locations:
+            return None
+        return self.locations[domain].get(selector)
+
+    def get_descriptor(self, domain, selector):
+        """
+        Returns descriptor metadata, None if descriptor was not found.
+        """
+        with self._lock:
+            location = self._location(domain, selector)
+            if location is None:
+                return None
+            segno, offset, keylen, _, _ = location
+            meta = store_serializer.loads(
+                self._read(segno, offset + _HEADER.size, keylen))
+        meta.pop(_VALUE_FORMAT_KEY, None)
+        return Descriptor(**meta)
+
+    def get_value(self, domain, selector):
+        """
+        Returns descriptor value, None if descriptor was not found.
+        """
+        with self._lock:
+            location = self._location(domain, selector)
+            if location is None:
+                return None
+            segno, offset, keylen, valuelen, value_format = location
+            data = self._read(segno, offset + _HEADER.size + keylen, valuelen)
+        if value_format == _VALUE_RAW:
+            return data
+        return Descriptor.unserialize_value(store_serializer, data)
+
+    def get_value_range(self, domain, selector, offset, length):
+        with self._lock:
+            location = self._location(domain, selector)
+            if location is None:
+                return None
+            segno, recoffset, keylen, valuelen, value_format = location
+            if value_format != _VALUE_RAW:
+                return Storage.get_value_range(self, domain, selector, offset,
+                                               length)
+            offset = min(max(0, offset), valuelen)
+            length = max(0, min(length, valuelen - offset))
+            return self._read(segno, recoffset + _HEADER.size + keylen +
+                              offset, length)
+
+    def get_value_size(self, domain, selector):
+        with self._lock:
+            location = self._location(domain, selector)
+        if location is None:
+            return None
+        if location[4] != _VALUE_RAW:
+            return len(self.get_value(domain, selector))
+        return location[3]
+
+    def get_children(self, domain, selector, recurse=True):
+        result = set()
+        for child, _ in self.get_descendants(domain, selector,
+                                             0 if recurse else 1):
+            desc = self.get_descriptor(domain, child)
+            if desc:
+                result.add(desc)
+        return result
+
+    def get_descendants(self, domain, selector, max_depth=0):
+        with self._lock:
+            return list(self.lineage.iter_descendants(domain, selector,
+                                                      max_depth))
+
+    def get_ancestors(self, domain, selector, max_depth=0):
+        with self._lock:
+            return list(self.lineage.iter_ancestors(domain, selector,
+                                                    max_depth))
+
+    def ancestry_summary(self, domain, selector):
+        with self._lock:
+            return self.lineage.ancestry(domain, selector)
+
+    def add(self, descriptor):
+        domain = descriptor.domain
+        selector = descriptor.selector
+        meta = descriptor.meta_dict()
+        if isinstance(descriptor.value, str):
+            meta[_VALUE_FORMAT_KEY] = _VALUE_RAW
+            value = descriptor.value
+        else:
+            value = descriptor.serialize_value(store_serializer)
+        key = store_serializer.dumps(meta)
+        with self._lock:
+            if selector in self.locations[domain]:
+                return False
+            segno, offset = self._append_record(_DESCRIPTOR, key, value)
+            self._register(meta, (segno, offset, len(key), len(value)))
+        return True
+
+    def mark_processed(self, domain, selector, agent_name, config_txt):
+        result = self.db.add_processed(domain, selector, agent_name,
+                                       config_txt)
+        # Remove from processable
+        if selector in self.processable[domain]:
+            key = (agent_name, config_txt)
+            if key in self.processable[domain][selector]:
+                result = False
+                self.processable[domain][selector].discard(key)
+        return result
+
+    def mark_processable(self, domain, selector, agent_name, config_txt):
+        result = False
+        key = (agent_name, config_txt)
+        if key not in self.processable[domain][selector]:
+            self.processable[domain][selector].add(key)
+            if not self.db.is_processed(domain, selector, agent_name,
+                                        config_txt):
+                result = True
+        return result
+
+    def get_processed(self, domain, selector):
+        return self.db.list_processed(domain, selector)
+
+    def get_processable(self, domain, selector):
+        return self.processable[domain][selector]
+
+    def processed_stats(self, domain):
+        return self.db.processed_stats(domain)
+
+    def store_agent_state(self, agent_name, state):
+        with self._lock:
+            segno, offset = self._append_record(_AGENT_STATE, agent_name,
+                                                state)
+            self._set_state_location(agent_name, (segno, offset,
+                                                  len(agent_name), len(state)))
+
+    def load_agent_state(self, agent_name):
+        with self._lock:
+            location = self.state_locations.get(agent_name)
+            if location is None:
+                return ""
+            segno, offset, keylen, valuelen = location
+            return self._read(segno, offset + _HEADER.size + keylen, valuelen)
+
+    def store_state(self):
+        self.db.flush()
+        self._write_index()
+
+    def list_unprocessed_by_agent(self, agent_name, config_txt):
+        dom_sel = self.db.list_unprocessed_by_agent(agent_name, config_txt)
+        res = []
+        for domain, selector in dom_sel:
+            desc = self.get_descriptor(domain, selector)
+            if not desc:
+                log.warning("Could not get data for %s:%s", domain, selector)
+                continue
+            res.append((domain, desc.uuid, selector))
+        return res
+
+    @staticmethod
+    def add_arguments(subparser):
+        subparser.add_argument(
+            "--path", help="Segment storage path", default="/tmp/rebus-seg")
+        subparser.add_argument(
+            "--segment-size", type=int, default=256*1024*1024,
+            help="Size (bytes) above which a new segment file is started")
+        subparser.add_argument(
+            "--compact-interval", type=float, default=600,
+            help="Interval (seconds) between background compactions. 0 "
+            "disables background compaction.")
+        subparser.add_argument(
+            "--compact-ratio", type=float, default=0.5,
+            help="Sealed segments whose live records make up less than this "
+            "ratio of their size are compacted")
+        subparser.add_argument(
+            "--fsync-batch", type=int, default=64,
+            help="Flush appended records to disk every FSYNC_BATCH records. "
+            "0 disables fsync calls.")
+        subparser.add_argument(
+            "--db-commit-batch", type=int, default=1,
+            help="Max number of metadata database inserts grouped in a "
+            "transaction. Values > 1 enable write-behind mode.")
+        subparser.add_argument(
+            "--db-commit-interval", type=float, default=1.0,
+            help="In write-behind mode, max age (seconds) of metadata "
+            "database inserts that have not been committed")
+        subparser.add_argument(
+            "--db-readers", type=int, default=4,
+            help="Number of read-only metadata database connections used by "
+            "queries, which then do not wait for inserts. 0 runs queries on "
+            "the writer connection.")
+        subparser.add_argument(
+            "--import-diskstorage", metavar="PATH",
+            help="Import descriptors, processed state and agent states from "
+            "the disk storage at PATH at startup")
@@ -0,0 +1,532 @@
+import logging
+import os
+import re
+import sqlite3
+from collections import defaultdict
+from rebus.storage import Storage, MetadataDB, parse_cursor, make_cursor
+from rebus.descriptor import Descriptor
+from rebus.tools.lineage import breadth_first, combine_summaries
+from rebus.tools.selector_index import prefix_upper_bound
+from rebus.tools.serializer import picklev2 as store_serializer
+log = logging.getLogger("rebus.storage.sqlitestorage")
+
+#: descriptors.value contains the serialized value
+_VALUE_PICKLE = 'pickle'
+#: descriptors.value contains the value itself, which is a byte string
+_VALUE_RAW = 'raw'
+
+
+class DescriptorDB(MetadataDB):
+    """
+    MetadataDB that also holds descriptors, their values, lineage edges,
+    uuids and agent states.
+    """
+
+    def __init__(self, db_path, commit_batch=1, commit_interval=1.0,
+                 read_only=False, readers=4):
+        """
+        :param read_only: if True, the database must exist, and is only
+            queried. Several read-only instances may be used from other
+            processes while a writer is running.
+        """
+        MetadataDB.__init__(self, db_path, commit_batch, commit_interval,
+                            readers, read_only)
+        if read_only:
+            return
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS descriptors(id INTEGER PRIMARY KEY, '
+            'domain TEXT, selector TEXT, selprefix TEXT, version INTEGER, '
+            'uuid TEXT, meta BLOB, value_format TEXT, value BLOB, '
+            'ancestry BLOB)')
+        columns = [row[1] for row in self._cursor.execute(
+            'PRAGMA table_info(descriptors)')]
+        if 'ancestry' not in columns:
+            # database created by a former version
+            self._cursor.execute(
+                'ALTER TABLE descriptors ADD COLUMN ancestry BLOB')
+        self._cursor.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS descriptors_selector ON '
+            'descriptors(domain, selector)')
+        self._cursor.execute(
+            'CREATE INDEX IF NOT EXISTS descriptors_version ON '
+            'descriptors(domain, selprefix, version)')
+        self._cursor.execute(
+            'CREATE INDEX IF NOT EXISTS descriptors_uuid ON '
+            'descriptors(domain, uuid)')
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS edges(domain TEXT, parent TEXT, '
+            'child TEXT, PRIMARY KEY(domain, parent, child))')
+        self._cursor.execute(
+            'CREATE INDEX IF NOT EXISTS edges_child ON edges(domain, child)')
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS uuids(domain TEXT, uuid TEXT, '
+            'label BLOB, PRIMARY KEY(domain, uuid))')
+        self._cursor.execute(
+            'CREATE TABLE IF NOT EXISTS agent_states(agent_name TEXT '
+            'PRIMARY KEY, state BLOB)')
+        self._db.commit()
+
+    def add_descriptor(self, meta, value_format, value, ancestry):
+        """
+        Inserts a descriptor, its lineage edges and uuid. Returns False if it
+        was already present.
+
+        :param meta: dictionary of descriptor attributes, without its value
+        :param value: value, serialized according to value_format
+        :param ancestry: ancestry summary, or None if it is unknown
+        """
+        domain, selector = meta['domain'], meta['selector']
+        if ancestry is not None:
+            ancestry = sqlite3.Binary(store_serializer.dumps(ancestry))
+        with self._dblock:
+            try:
+                self._cursor.execute(
+                    'INSERT OR ABORT INTO descriptors(domain, selector, '
+                    'selprefix, version, uuid, meta, value_format, value, '
+                    'ancestry) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (domain, selector, selector.split('%')[0],
+                     meta['version'], meta['uuid'],
+                     sqlite3.Binary(store_serializer.dumps(meta)),
+                     value_format, sqlite3.Binary(value), ancestry))
+            except sqlite3.IntegrityError:
+                return False
+            self._insert_selector(domain, selector)
+            self._cursor.executemany(
+                'INSERT OR IGNORE INTO edges(domain, parent, child) '
+                'VALUES (?, ?, ?)',
+                [(domain, precursor, selector)
+                 for precursor in meta['precursors']])
+            label = sqlite3.Binary(store_serializer.dumps(meta['label']))
+            # Heuristic for choosing uuid label : prefer label of a
+            # descriptor that has no precursor
+            self._cursor.execute(
+                'INSERT OR %s INTO uuids(domain, uuid, label) '
+                'VALUES (?, ?, ?)' %
+                ('IGNORE' if meta['precursors'] else 'REPLACE'),
+                (domain, meta['uuid'], label))
+            self._inserted()
+        return True
+
+    def lookup_version(self, domain, selprefix, version):
+        """
+        Returns the selector of version version of selprefix, or None.
+        Negative versions count from the latest one.
+        """
+        with self._reading() as cursor:
+            if version < 0:
+                maxversion = cursor.execute(
+                    'SELECT MAX(version) FROM descriptors WHERE domain=? '
+                    'AND selprefix=?', (domain, selprefix)).fetchone()[0]
+                if maxversion is None:
+                    return None
+                version = maxversion + version + 1
+            row = cursor.execute(
+                'SELECT selector FROM descriptors WHERE domain=? AND '
+                'selprefix=? AND version=? ORDER BY id DESC LIMIT 1',
+                (domain, selprefix, version)).fetchone()
+        return str(row[0]) if row else None
+
+    def get_meta(self, domain, selector):
+        """
+        Returns the dictionary of descriptor attributes, or None.
+        """
+        with self._reading() as cursor:
+            row = cursor.execute(
+                'SELECT meta FROM descriptors WHERE domain=? AND selector=?',
+                (domain, selector)).fetchone()
+        return store_serializer.loads(str(row[0])) if row else None
+
+    def get_ancestry(self, domain, selector):
+        """
+        Returns (True, ancestry summary or None if it is unknown), or
+        (False, None) if selector is not stored.
+        """
+        with self._reading() as cursor:
+            row = cursor.execute(
+                'SELECT ancestry FROM descriptors WHERE domain=? AND '
+                'selector=?', (domain, selector)).fetchone()
+        if row is None:
+            return False, None
+        if row[0] is None:
+            return True, None
+        return True, store_serializer.loads(str(row[0]))
+
+    def get_value(self, domain, selector):
+        """
+        Returns (value format, stored value), or None.
+        """
+        with self._reading() as cursor:
+            row = cursor.execute(
+                'SELECT value_format, value FROM descriptors WHERE domain=? '
+                'AND selector=?', (domain, selector)).fetchone()
+        return (str(row[0]), str(row[1])) if row else None
+
+    def get_value_range(self, domain, selector, offset, length):
+        """
+        Returns (value format, length of the stored value, part of the stored
+        value), or None.
+        """
+        with self._reading() as cursor:
+            row = cursor.execute(
+                'SELECT value_format, length(value), substr(value, ?, ?) '
+                'FROM descriptors WHERE domain=? AND selector=?',
+                (offset + 1, length, domain, selector)).fetchone()
+        return (str(row[0]), row[1], str(row[2])) if row else None
+
+    def iter_values(self, domain, selector_prefix):
+        """
+        Yields (selector, value format, stored value) of descriptors whose
+        selector starts with selector_prefix.
+        """
+        query = 'SELECT selector, value_format, value FROM descriptors ' \
+            'WHERE domain=? AND selector>=? '
+        params = [domain, selector_prefix]
+        upper = prefix_upper_bound(selector_prefix)
+        if upper is not None:
+            query += 'AND selector<? '
+            params.append(upper)
+        with self._reading() as cursor:
+            rows = cursor.execute(query + 'ORDER BY id', params)
+            for selector, value_format, value in rows:
+                yield str(selector), str(value_format), str(value)
+
+    def list_by_uuid(self, domain, uuid):
+        with self._reading() as cursor:
+            res = cursor.execute(
+                'SELECT meta FROM descriptors WHERE domain=? AND uuid=?',
+                (domain, uuid)).fetchall()
+        return [store_serializer.loads(str(meta)) for (meta,) in res]
+
+    def list_uuids(self, domain):
+        with self._reading() as cursor:
+            res = cursor.execute(
+                'SELECT uuid, label FROM uuids WHERE domain=?',
+                (domain,)).fetchall()
+        return dict((str(uuid), store_serializer.loads(str(label)))
+                    for uuid, label in res)
+
+    def list_children(self, domain, selector):
+        with self._reading() as cursor:
+            res = cursor.execute(
+                'SELECT child FROM edges WHERE domain=? AND parent=?',
+                (domain, selector)).fetchall()
+        return [str(child) for (child,) in res]
+
+    def list_precursors(self, domain, selector):
+        with self._reading() as cursor:
+            res = cursor.execute(
+                'SELECT parent FROM edges WHERE domain=? AND child=?',
+                (domain, selector)).fetchall()
+        return [str(parent) for (parent,) in res]
+
+    def uuid_of(self, domain, selector):
+        with self._reading() as cursor:
+            row = cursor.execute(
+                'SELECT uuid FROM descriptors WHERE domain=? AND selector=?',
+                (domain, selector)).fetchone()
+        return str(row[0]) if row else None
+
+    def store_agent_state(self, agent_name, state):
+        with self._dblock:
+            self._cursor.execute(
+                'INSERT OR REPLACE INTO agent_states(agent_name, state) '
+                'VALUES (?, ?)', (agent_name, sqlite3.Binary(state)))
+            self._inserted()
+
+    def load_agent_state(self, agent_name):
+        with self._reading() as cursor:
+            row = cursor.execute(
+                'SELECT state FROM agent_states WHERE agent_name=?',
+                (agent_name,)).fetchone()
+        return str(row[0]) if row else ""
+
+    def list_agent_states(self):
+        with self._reading() as cursor:
+            rows = cursor.execute(
+                'SELECT agent_name FROM agent_states').fetchall()
+        return [str(row[0]) for row in rows]
+
+    def checkpoint(self):
+        """
+        Commits pending inserts, and copies the write-ahead log to the
+        database file.
+        """
+        with self._dblock:
+            self.flush()
+            self._cursor.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+@Storage.register
+class SQLiteStorage(Storage):
+    """
+    Stores descriptors, values, lineage, processed and agent states in a
+    single sqlite3 database. Nothing but interactive processable state is
+    held in memory, so opening a large store is immediate.
+
+    The database uses write-ahead logging: other processes may open it using
+    --read-only while the bus master is running, and see descriptors once
+    they have been committed.
+    """
+
+    _name_ = "sqlitestorage"
+    STORES_INTSTATE = True
+
+    def __init__(self, options):
+        self.path = options.path
+        self.read_only = options.read_only
+        if self.read_only and not os.path.isfile(self.path):
+            raise IOError('Database %s does not exist' % self.path)
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(dirname):
+            raise IOError('Directory %s does not exist' % dirname)
+
+        #: self.processable['domain']['/selector/%hash'] is a set of (agent
+        #: name, configuration text) that are running in interactive mode, and
+        #: are able to process this descriptor.
+        #: This attribute is not saved to disk.
+        self.processable = defaultdict(lambda: defaultdict(set))
+
+        self.db = DescriptorDB(self.path, options.db_commit_batch,
+                               options.db_commit_interval, self.read_only,
+                               options.db_readers)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise IOError('Database %s has been opened read-only' % self.path)
+
+    def close(self):
+        if not self.read_only:
+            self.db.checkpoint()
+        self.db.close()
+
+    def find(self, domain, selector_regex, limit=0, offset=0):
+        return self.db.find(domain, selector_regex, limit, offset)
+
+    def find_by_selector(self, domain, selector_prefix, limit=0, offset=0):
+        return [self.get_descriptor(domain, selector) for selector in
+                self.db.find_by_selector(domain, selector_prefix, limit,
+                                         offset, oldest_first=True)]
+
+    def find_page(self, domain, selector_regex, limit, cursor=''):
+        selectors, position = self.db.find_page(
+            domain, selector_regex, limit, parse_cursor(cursor))
+        return selectors, make_cursor(position)
+
+    def find_by_selector_page(self, domain, selector_prefix, limit,
+                              cursor=''):
+        selectors, position = self.db.find_by_selector_page(
+            domain, selector_prefix, limit, parse_cursor(cursor))
+        return ([self.get_descriptor(domain, selector)
+                 for selector in selectors], make_cursor(position))
+
+    def find_by_uuid(self, domain, uuid):
+        return [Descriptor(**meta)
+                for meta in self.db.list_by_uuid(domain, uuid)]
+
+    def find_by_value(self, domain, selector_prefix, value_regex):
+        matching = []
+        for selector, value_format, value in \
+                self.db.iter_values(domain, selector_prefix):
+            if value_format != _VALUE_RAW:
+                value = Descriptor.unserialize_value(store_serializer, value)
+            if re.match(value_regex, value):
+                matching.append(selector)
+        return [self.get_descriptor(domain, selector) for selector in
+                matching]
+
+    def list_uuids(self, domain):
+        return self.db.list_uuids(domain)
+
+    def list_selectors(self):
+        return self.db.list_selectors()
+
+    def list_agent_states(self):
+        return self.db.list_agent_states()
+
+    def _version_lookup(self, domain, selector):
+        """
+        :param selector: selector, containing either a version (/selector/~12)
+        or a hash (/selector/%1234)
+        Perform version lookup if needed.
+        Returns a selector containing a hash value /selector/%1234
+        """
+        # if version is specified, but no hash
+        if '%' not in selector and '~' in selector:
+            selprefix, version = selector.split('~')
+            try:
+                selector = self.db.lookup_version(domain, selprefix,
+                                                  int(version))
+            except ValueError:
+                # invalid version integer
+                selector = None
+        return selector
+
+    def get_descriptor(self, domain, selector):
+        """
+        Returns descriptor metadata, None if descriptor was not found.
+        """
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        meta = self.db.get_meta(domain, selector)
+        if meta is None:
+            return None
+        return Descriptor(**meta)
+
+    def get_value(self, domain, selector):
+        """
+        Returns descriptor value, None if descriptor was not found.
+        """
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        stored = self.db.get_value(domain, selector)
+        if stored is None:
+            return None
+        value_format, data = stored
+        if value_format == _VALUE_RAW:
+            return data
+        return Descriptor.unserialize_value(store_serializer, data)
+
+    def get_value_range(self, domain, selector, offset, length):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        offset, length = max(0, offset), max(0, length)
+        stored = self.db.get_value_range(domain, selector, offset, length)
+        if stored is None:
+            return None
+        if stored[0] != _VALUE_RAW:
+            return Storage.get_value_range(self, domain, selector, offset,
+                                           length)
+        return stored[2]
+
+    def get_value_size(self, domain, selector):
+        selector = self._version_lookup(domain, selector)
+        if not selector:
+            return None
+        stored = self.db.get_value_range(domain, selector, 0, 0)
+        if stored is None:
+            return None
+        if stored[0] != _VALUE_RAW:
+            return len(self.get_value(domain, selector))
+        return stored[1]
+
+    def get_children(self, domain, selector, recurse=True):
+        result = set()
+        for child, _ in self.get_descendants(domain, selector,
+                                             0 if recurse else 1):
+            desc = self.get_descriptor(domain, child)
+            if desc:
+                result.add(desc)
+        return result
+
+    def ancestry_summary(self, domain, selector):
+        stored, ancestry = self.db.get_ancestry(domain, selector)
+        if stored and ancestry is None:
+            # an ancestor was missing when this descriptor was added
+            return Storage.ancestry_summary(self, domain, selector)
+        return ancestry
+
+    def get_descendants(self, domain, selector, max_depth=0):
+        return breadth_first(
+            selector, lambda sel: self.db.list_children(domain, sel),
+            max_depth)
+
+    def get_ancestors(self, domain, selector, max_depth=0):
+        return breadth_first(
+            selector, lambda sel: self.db.list_precursors(domain, sel),
+            max_depth)
+
+    def add(self, descriptor):
+        self._check_writable()
+        meta = descriptor.meta_dict()
+        if isinstance(descriptor.value, str):
+            value_format, value = _VALUE_RAW, descriptor.value
+        else:
+            value_format = _VALUE_PICKLE
+            value = descriptor.serialize_value(store_serializer)
+        summaries = []
+        for precursor in descriptor.precursors:
+            summaries.append(self.ancestry_summary(descriptor.domain,
+                                                   precursor))
+        ancestry = None
+        if None not in summaries:
+            ancestry = combine_summaries(descriptor.selector, summaries)
+        return self.db.add_descriptor(meta, value_format, value, ancestry)
+
+    def mark_processed(self, domain, selector, agent_name, config_txt):
+        self._check_writable()
+        result = self.db.add_processed(domain, selector, agent_name,
+                                       config_txt)
+        # Remove from processable
+        if selector in self.processable[domain]:
+            key = (agent_name, config_txt)
+            if key in self.processable[domain][selector]:
+                result = False
+                self.processable[domain][selector].discard(key)
+        return result
+
+    def mark_processable(self, domain, selector, agent_name, config_txt):
+        result = False
+        key = (agent_name, config_txt)
+        if key not in self.processable[domain][selector]:
+            self.processable[domain][selector].add(key)
+            if not self.db.is_processed(domain, selector, agent_name,
+                                        config_txt):
+                result = True
+        return result
+
+    def get_processed(self, domain, selector):
+        return self.db.list_processed(domain, selector)
+
+    def get_processable(self, domain, selector):
+        return self.processable[domain][selector]
+
+    def processed_stats(self, domain):
+        return self.db.processed_stats(domain)
+
+    def store_agent_state(self, agent_name, state):
+        self._check_writable()
+        self.db.store_agent_state(agent_name, state)
+
+    def load_agent_state(self, agent_name):
+        return self.db.load_agent_state(agent_name)
+
+    def store_state(self):
+        if not self.read_only:
+            self.db.checkpoint()
+
+    def list_unprocessed_by_agent(self, agent_name, config_txt):
+        dom_sel = self.db.list_unprocessed_by_agent(agent_name, config_txt)
+        res = []
+        for domain, selector in dom_sel:
+            uuid = self.db.uuid_of(domain, selector)
+            if uuid is None:
+                log.warning("Could not get data for %s:%s", domain, selector)
+                continue
+            res.append((domain, uuid, selector))
+        return res
+
+    @staticmethod
+    def add_arguments(subparser):
+        subparser.add_argument(
+            "--path", help="SQLite database path",
+            default="/tmp/rebus.sqlite3")
+        subparser.add_argument(
+            "--read-only", action="store_true",
+            help="Open an existing database in read-only mode. May be used "
+            "while another process writes to it.")
+        subparser.add_argument(
+            "--db-commit-batch", type=int, default=1,
+            help="Max number of database inserts grouped in a transaction. "
+            "Values > 1 enable write-behind mode.")
+        subparser.add_argument(
+            "--db-commit-interval", type=float, default=1.0,
+            help="In write-behind mode, max age (seconds) of database "
+            "inserts that have not been committed")
+        subparser.add_argument(
+            "--db-readers", type=int, default=4,
+            help="Number of read-only database connections used by queries, "
+            "which then do not wait for inserts. 0 runs queries on the "
+            "writer connection.")
@@ -0,0 +1,71 @@
+"""
+Compact set of small non-negative integers, backed by a bytearray.
+"""
+
+
+class Bitset(object):
+    """
+    Set of integers, using one bit per integer between 0 and the largest
+    member. Used by storage backends to hold per-agent processed state of
+    densely numbered descriptors.
+    """
+    __slots__ = ('_bits', '_count')
+
+    def __init__(self):
+        self._bits = bytearray()
+        #: number of members
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] &
+                                               (1 << (i & 7)))
+
+    def add(self, i):
+        """
+        Returns True if i was not already a member.
+        """
+        byte = i >> 3
+        if byte >= len(self._bits):
+            self._bits.extend(bytearray(byte + 1 - len(self._bits)))
+        mask = 1 << (i & 7)
+        if self._bits[byte] & mask:
+            return False
+        self._bits[byte] |= mask
+        self._count += 1
+        return True
+
+    def discard(self, i):
+        """
+        Returns True if i was a member.
+        """
+        if i not in self:
+            return False
+        self._bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+        self._count -= 1
+        return True
+
+    def __iter__(self):
+        for byte, bits in enumerate(self._bits):
+            if bits:
+                for bit in xrange(8):
+                    if bits & (1 << bit):
+                        yield (byte << 3) | bit
+
+    def iter_missing(self, size):
+        """
+        Yields integers between 0 and size - 1 that are not members.
+        """
+        for byte in xrange((size + 7) >> 3):
+            bits = self._bits[byte] if byte < len(self._bits) else 0
+            if bits == 0xff:
+                continue
+            for bit in xrange(8):
+                i = (byte << 3) | bit
+                if i >= size:
+                    return
+                if not bits & (1 << bit):
+                    yield i
@@ -0,0 +1,52 @@
+"""
+Helpers for bulk bus requests (get_many, get_values_many), whose results are
+exchanged in bounded-size chunks.
+
+Slaves send at most CHUNK_SELECTORS selectors per request. Masters reply with
+results for the first requested selectors only, stopping once the reply
+reaches CHUNK_BYTES; slaves then request the remaining selectors.
+"""
+
+#: max number of selectors sent in a single bulk request
+CHUNK_SELECTORS = 100
+#: size (bytes) after which a master stops adding results to a reply
+CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def bounded_results(items, serialize, max_bytes=CHUNK_BYTES):
+    """
+    Returns the list of serialize(item) for the first items, stopping after
+    the result that brings the total size to max_bytes. At least one result
+    is returned if items is not empty.
+
+    :param serialize: function(item) returning a string
+    """
+    results = []
+    size = 0
+    for item in items:
+        result = serialize(item)
+        results.append(result)
+        size += len(result)
+        if size >= max_bytes:
+            break
+    return results
+
+
+def fetch_in_chunks(selectors, fetch, chunk_selectors=CHUNK_SELECTORS):
+    """
+    Returns the list of results for selectors, requested chunk by chunk.
+
+    :param fetch: function(list of selectors) returning results for the first
+        selectors of this list. None is used as the result of remaining
+        selectors if it returns an empty list.
+    """
+    selectors = list(selectors)
+    results = []
+    while len(results) < len(selectors):
+        chunk = selectors[len(results):len(results) + chunk_selectors]
+        received = fetch(chunk)
+        if not received:
+            results.extend([None] * (len(selectors) - len(results)))
+            break
+        results.extend(received[:len(chunk)])
+    return results
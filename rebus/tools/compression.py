@@ -0,0 +1,114 @@
+"""
+Per-selector-prefix compression policy for stored values.
+
+Policies are given as PREFIX=POLICY rules, POLICY being one of:
+
+* none: values are stored as-is
+* zlib:N: values are compressed using zlib level N (1-9)
+* auto: a sample of each value is compressed; the value is compressed (zlib
+  level 6) only if the sample compresses well
+
+The rule having the longest matching prefix applies. Values whose selector
+starts with one of SKIPPED_PREFIXES are already compressed, and are never
+compressed again.
+"""
+import zlib
+from collections import defaultdict
+
+#: Selector prefixes of already compressed formats
+SKIPPED_PREFIXES = ('/compressed/', '/archive/')
+
+#: zlib level used by the 'auto' policy
+AUTO_LEVEL = 6
+#: number of bytes compressed to estimate compressibility
+AUTO_SAMPLE_SIZE = 64*1024
+#: max ratio (compressed sample size / sample size) for compressing a value
+AUTO_MAX_RATIO = 0.9
+
+
+def parse_rule(rule):
+    """
+    Parses a PREFIX=POLICY rule. Returns (prefix, policy), policy being None
+    (no compression), a zlib level, or 'auto'.
+
+    Raises ValueError if rule is invalid.
+    """
+    if '=' not in rule:
+        raise ValueError("Invalid compression rule %r, expected "
+                         "PREFIX=POLICY" % rule)
+    prefix, policy = rule.rsplit('=', 1)
+    if not prefix.startswith('/'):
+        raise ValueError("Invalid selector prefix in compression rule %r" %
+                         rule)
+    if policy == 'none':
+        return prefix, None
+    if policy == 'auto':
+        return prefix, 'auto'
+    if policy.startswith('zlib:'):
+        try:
+            level = int(policy[len('zlib:'):])
+        except ValueError:
+            level = -1
+        if 1 <= level <= 9:
+            return prefix, level
+    raise ValueError("Invalid compression policy in rule %r (expected none, "
+                     "zlib:1 to zlib:9 or auto)" % rule)
+
+
+class CompressionPolicy(object):
+    """
+    Chooses how values are compressed, and keeps compression statistics per
+    rule prefix.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: list of (prefix, policy), as returned by parse_rule
+        """
+        #: list of (prefix, policy), longest prefixes first
+        self.rules = sorted(rules, key=lambda r: len(r[0]), reverse=True)
+        #: self.stats[prefix] = {'values': ..., 'compressed': ...,
+        #: 'original_bytes': ..., 'stored_bytes': ...}
+        self.stats = defaultdict(lambda: {'values': 0, 'compressed': 0,
+                                          'original_bytes': 0,
+                                          'stored_bytes': 0})
+
+    def _rule(self, selector):
+        """
+        Returns (prefix, policy) of the rule applying to selector.
+        """
+        for prefix in SKIPPED_PREFIXES:
+            if selector.startswith(prefix):
+                return prefix, None
+        for prefix, policy in self.rules:
+            if selector.startswith(prefix):
+                return prefix, policy
+        return '', None
+
+    def compress(self, selector, data):
+        """
+        Returns (stored data, True if it is compressed).
+        """
+        prefix, policy = self._rule(selector)
+        level = policy
+        if policy == 'auto':
+            sample = data[:AUTO_SAMPLE_SIZE]
+            level = None
+            if sample and len(zlib.compress(sample, 1)) <= \
+                    len(sample) * AUTO_MAX_RATIO:
+                level = AUTO_LEVEL
+        stored, compressed = data, False
+        if level is not None:
+            compressed_data = zlib.compress(data, level)
+            if len(compressed_data) < len(data):
+                stored, compressed = compressed_data, True
+        stats = self.stats[prefix]
+        stats['values'] += 1
+        stats['compressed'] += int(compressed)
+        stats['original_bytes'] += len(data)
+        stats['stored_bytes'] += len(stored)
+        return stored, compressed
+
+    @staticmethod
+    def decompress(data):
+        return zlib.decompress(data)
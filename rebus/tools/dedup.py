@@ -0,0 +1,76 @@
+"""
+Content-addressed deduplication of stored values: identical values are
+stored once, keyed by the digest of their contents, and reference counted.
+"""
+import hashlib
+
+
+def value_digest(data):
+    """
+    Returns the digest (hex string) identifying a byte string value.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def dedup_stats(references, unique_values, logical_bytes, stored_bytes):
+    """
+    Returns the dictionary of deduplication counters returned by
+    Storage.dedup_stats.
+
+    :param references: number of descriptors referring to a deduplicated
+        value
+    :param unique_values: number of distinct stored values
+    :param logical_bytes: size of values as seen by descriptors
+    :param stored_bytes: size of distinct stored values
+    """
+    return {'references': references, 'unique_values': unique_values,
+            'logical_bytes': logical_bytes, 'stored_bytes': stored_bytes,
+            'ratio': float(logical_bytes) / stored_bytes if stored_bytes
+            else 1.0}
+
+
+class ValueRefs(object):
+    """
+    Reference counts of deduplicated values.
+    """
+
+    def __init__(self):
+        #: self.refs[digest] = [number of references, value size]
+        self.refs = {}
+        self.references = 0
+        self.logical_bytes = 0
+        self.stored_bytes = 0
+
+    def add(self, digest, size):
+        """
+        Adds a reference to a value. Returns True if it was not referenced
+        yet, and has to be stored.
+        """
+        self.references += 1
+        self.logical_bytes += size
+        ref = self.refs.get(digest)
+        if ref is not None:
+            ref[0] += 1
+            return False
+        self.refs[digest] = [1, size]
+        self.stored_bytes += size
+        return True
+
+    def remove(self, digest):
+        """
+        Removes a reference to a value. Returns True if it is not referenced
+        anymore, and may be forgotten.
+        """
+        ref = self.refs[digest]
+        ref[0] -= 1
+        self.references -= 1
+        self.logical_bytes -= ref[1]
+        if ref[0]:
+            return False
+        del self.refs[digest]
+        self.stored_bytes -= ref[1]
+        return True
+
+    def stats(self):
+        return dedup_stats(self.references, len(self.refs),
+                           self.logical_bytes, self.stored_bytes)
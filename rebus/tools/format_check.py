@@ -13,6 +13,8 @@ _ALLOWED_SELECTOR_REGEX = re.compile(
 _ALLOWED_FULLSELECTOR_REGEX = re.compile(
     r'/[a-zA-Z0-9/_-]+%[a-f0-9]{64}')
 _ALLOWED_DOMAIN_REGEX = re.compile(r'^[a-zA-Z0-9-]*$')
+#: pagination cursor, as returned by find_page and find_by_selector_page
+_ALLOWED_CURSOR_REGEX = re.compile(r'^[0-9]*$')
 
 
 def is_valid_domain(domain):
@@ -22,6 +24,13 @@ def is_valid_domain(domain):
     return _ALLOWED_DOMAIN_REGEX.match(domain)
 
 
+def is_valid_cursor(cursor):
+    """
+    Checks a pagination cursor
+    """
+    return _ALLOWED_CURSOR_REGEX.match(cursor)
+
+
 def is_valid_selector(selector):
     """
     Checks a selector string, which may include a hash.
@@ -50,21 +59,19 @@ def processing_depth(store, descriptor):
         selector (excluding hash) - used to ensure analyses terminate
     """
     selector_prefix = descriptor.selector.split('%')[0]
-    levelset = set()
-    to_review = [(0, sel) for sel in descriptor.precursors]
-    while to_review:
-        l, s = to_review.pop()
-        if l > 1000:
-            # avoid loops
-            return False
-        prefix = s.split('%')[0]
-        if prefix == selector_prefix:
-            levelset.add(l)
-        d = store.get_descriptor(descriptor.domain, s)
-        if not d:
-            # precursor does not exist: refuse this.
-            return False
-        to_review.extend([(l+1, sel) for sel in d.precursors])
-        if len(levelset) > 2:
+    # bit n is set if an ancestor at depth n has the same selector prefix,
+    # precursors having depth 0
+    levels = 0
+    for precursor in descriptor.precursors:
+        # None if an ancestor does not exist, or if ancestors form a loop:
+        # refuse this.
+        summary = store.ancestry_summary(descriptor.domain, precursor)
+        if summary is None:
             return False
-    return True
+        for prefix, mask in summary:
+            if mask.bit_length() - 1 > 1000:
+                # avoid very deep lineages
+                return False
+            if prefix == selector_prefix:
+                levels |= mask
+    return bin(levels).count('1') <= 2
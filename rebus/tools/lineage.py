@@ -0,0 +1,265 @@
+"""
+Lineage graph of descriptors, shared by storage backends.
+
+Each descriptor is given a dense integer id in its domain. Precursor and
+children adjacency lists refer to these ids, so that the graph can be walked
+without unserializing descriptors.
+
+The ancestry summary of a descriptor is a tuple of (selector prefix, depth
+bitmask), sorted by prefix. Bit n of a prefix's mask is set if the
+descriptor (n = 0), one of its precursors (n = 1), one of their precursors
+(n = 2), etc. has a selector starting with this prefix. Summaries are
+computed from precursors' summaries, and allow checking
+format_check.processing_depth without walking the lineage graph.
+"""
+from array import array
+from collections import defaultdict
+from collections import deque
+
+
+def breadth_first(start, neighbours, max_depth=0):
+    """
+    Yields (node, depth) for nodes reachable from start, in breadth-first
+    order. start itself is not yielded. Each node is yielded once, at its
+    smallest depth.
+
+    :param neighbours: function(node) returning an iterable of nodes
+    :param max_depth: max depth of yielded nodes. Unlimited if 0.
+    """
+    seen = set([start])
+    queue = deque([(start, 0)])
+    while queue:
+        node, depth = queue.popleft()
+        if max_depth and depth >= max_depth:
+            continue
+        for neighbour in neighbours(node):
+            if neighbour in seen:
+                continue
+            seen.add(neighbour)
+            yield neighbour, depth + 1
+            queue.append((neighbour, depth + 1))
+
+
+def combine_summaries(selector, precursor_summaries):
+    """
+    Returns the ancestry summary of a descriptor, from the summaries of its
+    precursors.
+    """
+    depths = defaultdict(int)
+    depths[selector.split('%')[0]] = 1
+    for summary in precursor_summaries:
+        for prefix, mask in summary:
+            depths[prefix] |= mask << 1
+    return tuple(sorted(depths.iteritems()))
+
+
+def summarize(start, precursors_of, selector_of, summaries, interned=None):
+    """
+    Returns the ancestry summary of node start, computing missing summaries
+    of its ancestors iteratively. Returns None if start or one of its
+    ancestors is unknown, or if the lineage graph contains a loop.
+
+    :param precursors_of: function(node) returning precursor nodes, or None
+        if node is unknown
+    :param selector_of: function(node) returning the node's selector
+    :param summaries: dictionary mapping nodes to their summary, to which
+        computed summaries are added
+    :param interned: optional dictionary of known summaries, used to share
+        identical summaries
+    """
+    stack = [start]
+    expanded = set()
+    while stack:
+        node = stack[-1]
+        if node in summaries:
+            stack.pop()
+            continue
+        precursors = precursors_of(node)
+        if precursors is None:
+            return None
+        missing = [precursor for precursor in precursors
+                   if precursor not in summaries]
+        if missing:
+            if node in expanded:
+                # node is one of its own ancestors
+                return None
+            expanded.add(node)
+            stack.extend(missing)
+            continue
+        summary = combine_summaries(
+            selector_of(node), [summaries[precursor] for precursor in
+                                precursors])
+        if interned is not None:
+            summary = interned.setdefault(summary, summary)
+        summaries[node] = summary
+        stack.pop()
+    return summaries[start]
+
+
+class LineageIndex(object):
+    """
+    Precursors and children of stored descriptors.
+    """
+
+    def __init__(self):
+        #: self.ids['domain']['/selector/%hash'] is a dense integer id. Ids
+        #: are also given to precursors that have not been stored.
+        self.ids = defaultdict(dict)
+        #: self.selectors['domain'][id] is a selector
+        self.selectors = defaultdict(list)
+        #: self.precursors['domain'][id] is a tuple of precursor ids, or None
+        #: if this selector is not stored
+        self.precursors = defaultdict(list)
+        #: self.children['domain'][id] is an array of ids of stored
+        #: descriptors that have been spawned from this one
+        self.children = defaultdict(list)
+        #: self.summaries['domain'][id] is the ancestry summary of a stored
+        #: descriptor. Computed when descriptors are added, or when they are
+        #: first requested after the index has been loaded.
+        self.summaries = defaultdict(dict)
+        #: identical summaries are shared
+        self._interned = {}
+
+    def __contains__(self, domain_selector):
+        domain, selector = domain_selector
+        selector_id = self.ids[domain].get(selector)
+        return selector_id is not None and \
+            self.precursors[domain][selector_id] is not None
+
+    def _id(self, domain, selector):
+        selector_id = self.ids[domain].get(selector)
+        if selector_id is None:
+            selector_id = self.ids[domain][selector] = \
+                len(self.selectors[domain])
+            self.selectors[domain].append(selector)
+            self.precursors[domain].append(None)
+            self.children[domain].append(array('L'))
+        return selector_id
+
+    def add(self, domain, selector, precursors):
+        """
+        Records a stored descriptor.
+
+        :param precursors: list of precursor selectors
+        """
+        selector_id = self._id(domain, selector)
+        if self.precursors[domain][selector_id] is not None:
+            return
+        precursor_ids = tuple(self._id(domain, precursor)
+                              for precursor in precursors)
+        self.precursors[domain][selector_id] = precursor_ids
+        for precursor_id in precursor_ids:
+            self.children[domain][precursor_id].append(selector_id)
+        self._summarize(domain, selector_id)
+
+    def remove(self, domain, selector):
+        """
+        Forgets a stored descriptor. Its id is kept, and given back if it is
+        stored again.
+        """
+        selector_id = self.ids[domain].get(selector)
+        if selector_id is None:
+            return
+        precursor_ids = self.precursors[domain][selector_id]
+        if precursor_ids is None:
+            return
+        for precursor_id in precursor_ids:
+            children = self.children[domain][precursor_id]
+            if selector_id in children:
+                children.remove(selector_id)
+        self.precursors[domain][selector_id] = None
+        self.summaries[domain].pop(selector_id, None)
+
+    def children_of(self, domain, selector):
+        """
+        Returns selectors of descriptors spawned from selector.
+        """
+        selector_id = self.ids[domain].get(selector)
+        if selector_id is None:
+            return []
+        selectors = self.selectors[domain]
+        return [selectors[i] for i in self.children[domain][selector_id]]
+
+    def precursors_of(self, domain, selector):
+        """
+        Returns precursor selectors of a stored descriptor, None if it is
+        unknown.
+        """
+        selector_id = self.ids[domain].get(selector)
+        if selector_id is None:
+            return None
+        precursor_ids = self.precursors[domain][selector_id]
+        if precursor_ids is None:
+            return None
+        selectors = self.selectors[domain]
+        return [selectors[i] for i in precursor_ids]
+
+    def _summarize(self, domain, selector_id):
+        return summarize(selector_id, self.precursors[domain].__getitem__,
+                         self.selectors[domain].__getitem__,
+                         self.summaries[domain], self._interned)
+
+    def ancestry(self, domain, selector):
+        """
+        Returns the ancestry summary of a stored descriptor, None if it or
+        one of its ancestors is not stored.
+        """
+        selector_id = self.ids[domain].get(selector)
+        if selector_id is None:
+            return None
+        return self._summarize(domain, selector_id)
+
+    def _walk(self, domain, selector, adjacency, max_depth):
+        selector_id = self.ids[domain].get(selector)
+        if selector_id is None:
+            return
+        selectors = self.selectors[domain]
+        precursors = self.precursors[domain]
+        for node, depth in breadth_first(
+                selector_id, lambda i: adjacency[i] or (), max_depth):
+            if precursors[node] is not None:
+                yield selectors[node], depth
+
+    def iter_descendants(self, domain, selector, max_depth=0):
+        """
+        Yields (selector, depth) of stored descendants of selector, children
+        having depth 1, in breadth-first order.
+
+        :param max_depth: max depth of yielded descendants. Unlimited if 0.
+        """
+        return self._walk(domain, selector, self.children[domain], max_depth)
+
+    def iter_ancestors(self, domain, selector, max_depth=0):
+        """
+        Yields (selector, depth) of stored ancestors of selector, precursors
+        having depth 1, in breadth-first order.
+
+        :param max_depth: max depth of yielded ancestors. Unlimited if 0.
+        """
+        return self._walk(domain, selector, self.precursors[domain],
+                          max_depth)
+
+    def dump(self):
+        """
+        Returns a picklable representation of this index.
+        """
+        return {domain: (self.selectors[domain], self.precursors[domain])
+                for domain in self.selectors}
+
+    @classmethod
+    def load(cls, dumped):
+        """
+        Returns a LineageIndex from the output of dump()
+        """
+        index = cls()
+        for domain, (selectors, precursors) in dumped.iteritems():
+            index.selectors[domain] = list(selectors)
+            index.precursors[domain] = list(precursors)
+            index.ids[domain] = {selector: i for i, selector in
+                                 enumerate(selectors)}
+            children = index.children[domain] = \
+                [array('L') for _ in selectors]
+            for selector_id, precursor_ids in enumerate(precursors):
+                for precursor_id in precursor_ids or ():
+                    children[precursor_id].append(selector_id)
+        return index
@@ -0,0 +1,17 @@
+"""
+Helpers for storage backends that are accessed from several threads.
+"""
+import functools
+
+
+def synchronized(method):
+    """
+    Decorator for methods that must run while holding the instance's _lock
+    attribute, e.g. storage methods that must not run while expired
+    descriptors are being removed.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,132 @@
+"""
+Size-bounded caches used by storage backends.
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ByteLRU(object):
+    """
+    Least recently used cache, bounded by the total size (in bytes) of its
+    values. Sizes are provided by callers.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: max total size of cached values
+        """
+        self.max_bytes = max_bytes
+        #: total size of cached values
+        self.size = 0
+        #: self._items[key] is (value, size), least recently used first
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default. Marks key as most
+        recently used.
+        """
+        item = self._items.pop(key, None)
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items[key] = item
+        return item[0]
+
+    def put(self, key, value, size):
+        """
+        Caches value. Returns the list of (key, value) that have been evicted
+        to make room for it - value itself is returned if it is larger than
+        max_bytes.
+        """
+        self.pop(key)
+        if size > self.max_bytes:
+            return [(key, value)]
+        evicted = []
+        while self._items and self.size + size > self.max_bytes:
+            oldkey, (oldvalue, oldsize) = self._items.popitem(last=False)
+            self.size -= oldsize
+            self.evictions += 1
+            evicted.append((oldkey, oldvalue))
+        self._items[key] = (value, size)
+        self.size += size
+        return evicted
+
+    def pop(self, key):
+        """
+        Removes key from cache, returns its value or None.
+        """
+        item = self._items.pop(key, None)
+        if item is None:
+            return None
+        self.size -= item[1]
+        return item[0]
+
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        Returns a dictionary of cache counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._items),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.,
+        }
+
+
+class SpillFile(object):
+    """
+    Append-only temporary file holding serialized values that have been
+    evicted from memory. The file is deleted when closed.
+    """
+
+    def __init__(self, directory=None):
+        """
+        :param directory: directory where the file is created. Defaults to
+            the system's temporary directory.
+        """
+        self._fp = tempfile.TemporaryFile(prefix='rebus-spill-',
+                                          dir=directory)
+        self._lock = threading.Lock()
+        #: current size of the file
+        self.size = 0
+
+    def write(self, data):
+        """
+        Returns (offset, length) of written data.
+        """
+        with self._lock:
+            self._fp.seek(0, os.SEEK_END)
+            self._fp.write(data)
+            offset = self.size
+            self.size += len(data)
+        return offset, len(data)
+
+    def read(self, offset, length):
+        with self._lock:
+            self._fp.flush()
+            self._fp.seek(offset)
+            return self._fp.read(length)
+
+    def close(self):
+        self._fp.close()
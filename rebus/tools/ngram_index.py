@@ -0,0 +1,183 @@
+"""
+Trigram inverted index over descriptor values, used by storage backends to
+pre-filter find_by_value candidates.
+
+A regex such as 'abc.*defg' can only match values containing the trigrams
+abc, def and efg: only descriptors whose values contain all of them are
+candidates. Values that are not byte strings, or that are too large, are not
+indexed and are always candidates.
+"""
+import re
+import sre_constants
+import sre_parse
+from array import array
+from collections import defaultdict
+
+#: Length of indexed substrings
+NGRAM = 3
+
+
+def _collect_literals(subpattern, literals):
+    """
+    Appends to literals the literal strings that must appear in any string
+    matched by subpattern.
+    """
+    run = []
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL and av < 256:
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append(''.join(run))
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            _collect_literals(av[-1], literals)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            minimum, _, item = av
+            if minimum >= 1:
+                _collect_literals(item, literals)
+        # Other operators (branches, character sets...) do not require any
+        # literal
+    if run:
+        literals.append(''.join(run))
+
+
+def required_literals(value_regex):
+    """
+    Returns a list of strings, at least NGRAM characters long, that must
+    appear in any string matched by value_regex. Returns an empty list if
+    none could be determined.
+    """
+    try:
+        parsed = sre_parse.parse(value_regex)
+    except (sre_constants.error, TypeError):
+        return []
+    if parsed.pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return []
+    literals = []
+    _collect_literals(parsed, literals)
+    return [literal for literal in literals if len(literal) >= NGRAM]
+
+
+def _ngrams(string):
+    return set(string[i:i+NGRAM] for i in xrange(len(string) - NGRAM + 1))
+
+
+class NgramIndex(object):
+    """
+    Maps trigrams to the descriptors whose values contain them.
+    """
+
+    def __init__(self, max_value_size):
+        """
+        :param max_value_size: values larger than this (bytes) are not
+            indexed
+        """
+        self.max_value_size = max_value_size
+        #: self.docs[docid] is (domain, selector), or None if it has been
+        #: removed
+        self.docs = []
+        #: self.doc_ids[(domain, selector)] is docid
+        self.doc_ids = {}
+        #: self.postings[trigram] is an array of increasing docids
+        self.postings = defaultdict(lambda: array('L'))
+        #: docids of descriptors whose value is not indexed
+        self.unindexed = set()
+
+    def __contains__(self, domain_selector):
+        return domain_selector in self.doc_ids
+
+    def add(self, domain, selector, value):
+        """
+        Index value of descriptor domain:selector.
+        """
+        if (domain, selector) in self.doc_ids:
+            return
+        docid = len(self.docs)
+        self.docs.append((domain, selector))
+        self.doc_ids[(domain, selector)] = docid
+        if not isinstance(value, str) or len(value) > self.max_value_size:
+            self.unindexed.add(docid)
+            return
+        for ngram in _ngrams(value):
+            self.postings[ngram].append(docid)
+
+    def remove(self, domain, selector):
+        """
+        Forget descriptor domain:selector. Its docid remains in postings, and
+        is ignored.
+        """
+        docid = self.doc_ids.pop((domain, selector), None)
+        if docid is not None:
+            self.docs[docid] = None
+            self.unindexed.discard(docid)
+
+    def candidates(self, domain, value_regex):
+        """
+        Returns the set of selectors in domain whose value may match
+        value_regex, or None if the regex does not allow filtering.
+        """
+        ngrams = set()
+        for literal in required_literals(value_regex):
+            ngrams |= _ngrams(literal)
+        if not ngrams:
+            return None
+        # Intersect shortest postings first
+        postings = sorted((self.postings.get(ngram, ()) for ngram in ngrams),
+                          key=len)
+        docids = set(postings[0])
+        for posting in postings[1:]:
+            if not docids:
+                break
+            docids.intersection_update(posting)
+        docids |= self.unindexed
+        result = set()
+        for docid in docids:
+            doc = self.docs[docid]
+            if doc is not None and doc[0] == domain:
+                result.add(doc[1])
+        return result
+
+    def dump(self):
+        """
+        Returns a picklable representation of this index.
+        """
+        return {
+            'max_value_size': self.max_value_size,
+            'itemsize': array('L').itemsize,
+            'docs': self.docs,
+            'postings': {ngram: posting.tostring() for ngram, posting in
+                         self.postings.iteritems()},
+            'unindexed': self.unindexed,
+        }
+
+    @classmethod
+    def load(cls, dumped):
+        """
+        Returns an NgramIndex from the output of dump(). Raises ValueError if
+        it has been written on an incompatible platform.
+        """
+        if dumped['itemsize'] != array('L').itemsize:
+            raise ValueError("Incompatible n-gram index item size")
+        index = cls(dumped['max_value_size'])
+        index.docs = dumped['docs']
+        index.doc_ids = {doc: docid for docid, doc in enumerate(index.docs)
+                         if doc is not None}
+        for ngram, posting in dumped['postings'].iteritems():
+            index.postings[ngram].fromstring(posting)
+        index.unindexed = dumped['unindexed']
+        return index
+
+
+def add_ngram_arguments(subparser):
+    """
+    Adds n-gram index options to a storage backend's argument parser.
+    """
+    subparser.add_argument(
+        "--ngram-index", action="store_true",
+        help="Maintain a trigram index of descriptor values to speed up "
+        "find_by_value requests")
+    subparser.add_argument(
+        "--ngram-max-value-size", type=int, default=1024*1024,
+        help="Values larger than this (bytes) are not indexed, and always "
+        "checked by find_by_value")
@@ -0,0 +1,228 @@
+"""
+Retention rules, and background removal of expired descriptors.
+
+A rule is a comma-separated list of KEY=VALUE conditions, all of which must
+be satisfied for a descriptor to expire:
+
+* domain=DOMAIN: descriptor belongs to this domain
+* prefix=/SELECTOR/PREFIX: descriptor's selector starts with this prefix
+* uuid=UUID: descriptor belongs to this analysis
+* age=N[s|m|h|d]: descriptor has been stored more than N seconds (minutes,
+  hours, days) ago
+
+Example: "domain=default,prefix=/string/,age=7d".
+
+Expired descriptors are only removed once all descriptors that have been
+spawned from them have been removed: precursors of stored descriptors remain
+available, as required by format_check.processing_depth.
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+log = logging.getLogger("rebus.tools.retention")
+
+_AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class RetentionRule(namedtuple("RetentionRule",
+                               ("domain", "prefix", "uuid", "age"))):
+    """
+    Conditions of a retention rule. Unset conditions are None.
+    """
+
+    def matches_selector(self, domain, selector):
+        return (self.domain is None or domain == self.domain) and \
+            (self.prefix is None or selector.startswith(self.prefix))
+
+    def matches(self, uuid, added, now):
+        """
+        :param added: time at which the descriptor has been stored
+        """
+        return (self.uuid is None or uuid == self.uuid) and \
+            (self.age is None or now - added > self.age)
+
+
+def parse_rule(rule):
+    """
+    Parses a retention rule. Returns a RetentionRule.
+
+    Raises ValueError if rule is invalid.
+    """
+    conditions = dict.fromkeys(RetentionRule._fields)
+    for condition in rule.split(','):
+        if '=' not in condition:
+            raise ValueError("Invalid retention condition %r, expected "
+                             "KEY=VALUE" % condition)
+        key, value = condition.split('=', 1)
+        if key not in conditions:
+            raise ValueError("Unknown retention condition %r (expected %s)" %
+                             (key, ', '.join(RetentionRule._fields)))
+        if key == 'age':
+            unit = 1
+            if value[-1:] in _AGE_UNITS:
+                unit = _AGE_UNITS[value[-1]]
+                value = value[:-1]
+            try:
+                value = float(value) * unit
+            except ValueError:
+                raise ValueError("Invalid age in retention rule %r" % rule)
+        elif key == 'prefix' and not value.startswith('/'):
+            raise ValueError("Invalid selector prefix in retention rule %r" %
+                             rule)
+        conditions[key] = value
+    return RetentionRule(**conditions)
+
+
+class RetentionPolicy(object):
+    """
+    Chooses which descriptors may be removed. A descriptor expires if it
+    matches any rule.
+    """
+
+    def __init__(self, rules):
+        """
+        :param rules: list of RetentionRule, as returned by parse_rule
+        """
+        self.rules = list(rules)
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def removable(self, selectors, describe, children, now=None):
+        """
+        Yields (domain, selector) of expired descriptors having no remaining
+        children, children being yielded before their precursors.
+
+        :param selectors: iterable of (domain, selector), from most recently
+            to least recently stored
+        :param describe: function(domain, selector) returning (uuid, time at
+            which the descriptor has been stored), or None if it is unknown
+        :param children: function(domain, selector) returning selectors of
+            descriptors that have been spawned from this one
+        """
+        for domain, selector, expired in self.scan(selectors, describe,
+                                                   children, now):
+            if expired:
+                yield domain, selector
+
+    def scan(self, selectors, describe, children, now=None):
+        """
+        Yields (domain, selector, expired) for each of selectors, expired
+        being True if the descriptor may be removed. Parameters are those of
+        removable.
+
+        describe and children are called lazily, when the previous selector
+        has been yielded: a scan may be resumed after the store has changed,
+        as long as removable descriptors are removed before resuming it.
+        """
+        if now is None:
+            now = time.time()
+        removed = set()
+        for domain, selector in selectors:
+            rules = [rule for rule in self.rules
+                     if rule.matches_selector(domain, selector)]
+            expired = False
+            if rules:
+                info = describe(domain, selector)
+                expired = info is not None and \
+                    any(rule.matches(info[0], info[1], now)
+                        for rule in rules) and \
+                    all((domain, child) in removed
+                        for child in children(domain, selector))
+            if expired:
+                removed.add((domain, selector))
+            yield domain, selector, expired
+
+
+class GarbageCollector(object):
+    """
+    Periodically calls store.collect_garbage() from a background thread.
+    Each collection scans the store once. Descriptors are removed in batches
+    separated by pauses, the scan being resumed after each pause, so that bus
+    requests are not delayed for long.
+    """
+
+    def __init__(self, store, interval, batch_size, pause):
+        """
+        :param store: Storage instance
+        :param interval: seconds between two collections
+        :param batch_size: max number of descriptors removed at once
+        :param pause: seconds between two batches
+        """
+        self.store = store
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._closing.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _loop(self):
+        while not self._closing.wait(self.interval):
+            try:
+                self.collect()
+            except Exception:
+                log.error("Garbage collection failed", exc_info=1)
+
+    def collect(self):
+        """
+        Removes expired descriptors, batch by batch. Returns the number of
+        removed descriptors.
+        """
+        total = 0
+        resume = False
+        while True:
+            removed = self.store.collect_garbage(self.batch_size, resume)
+            resume = True
+            total += removed
+            if removed < self.batch_size or self._closing.wait(self.pause):
+                break
+        if total:
+            log.info("Removed %d expired descriptors", total)
+        return total
+
+
+def add_retention_arguments(subparser):
+    """
+    Adds retention options to a storage backend's argument parser.
+    """
+    subparser.add_argument(
+        "--retention", action="append", default=[], type=parse_rule,
+        metavar="RULE",
+        help="Remove descriptors matching RULE, a comma-separated list of "
+        "conditions: domain=DOMAIN, prefix=/SELECTOR/PREFIX, uuid=UUID, "
+        "age=N[s|m|h|d]. May be used several times. Descriptors are kept "
+        "while descriptors spawned from them are stored.")
+    subparser.add_argument(
+        "--gc-interval", type=float, default=3600,
+        help="Interval (seconds) between background removals of expired "
+        "descriptors. 0 disables background removal.")
+    subparser.add_argument(
+        "--gc-batch", type=int, default=100,
+        help="Max number of descriptors removed at once")
+    subparser.add_argument(
+        "--gc-pause", type=float, default=1.0,
+        help="Pause (seconds) between two batches of removals")
+
+
+def start_collector(store, options):
+    """
+    Returns a started GarbageCollector for store if retention rules and a
+    collection interval have been set, else None.
+    """
+    if not options.retention or options.gc_interval <= 0:
+        return None
+    collector = GarbageCollector(store, options.gc_interval,
+                                 max(1, options.gc_batch), options.gc_pause)
+    collector.start()
+    return collector
@@ -0,0 +1,303 @@
+"""
+In-memory index of selectors, shared by storage backends.
+
+Selectors are stored in a trie keyed by selector path components
+(/binary/elf/%1234 is stored under binary -> elf -> ''). Each trie node lists
+the selectors it holds in insertion order, so that:
+
+* find_by_prefix only explores the subtree matching the requested prefix;
+* find only runs the regex on selectors that start with its literal prefix;
+* find_page and find_by_prefix_page resume after the sequence number of the
+  last selector of the previous page, at a cost that does not depend on the
+  number of selectors of previous pages.
+"""
+import heapq
+import re
+import sre_constants
+import sre_parse
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+
+def literal_prefix(selector_regex):
+    """
+    Returns the longest string that starts every string matched by
+    re.match(selector_regex). Returns '' if the regex is invalid, or if no
+    such prefix could be determined. The prefix stops before the first
+    non-ASCII character, which may not be compared with byte string
+    selectors.
+    """
+    try:
+        parsed = sre_parse.parse(selector_regex)
+    except (sre_constants.error, TypeError):
+        return ''
+    if parsed.pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return ''
+    prefix = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL and av < 128:
+            prefix.append(chr(av))
+        elif op == sre_constants.AT and av == sre_constants.AT_BEGINNING and \
+                not prefix:
+            continue
+        else:
+            break
+    return ''.join(prefix)
+
+
+def prefix_upper_bound(prefix):
+    """
+    Returns the smallest string that is greater than every string starting
+    with prefix, or None if there is none.
+    """
+    while prefix and prefix[-1] == '\xff':
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class _Node(object):
+    __slots__ = ('children', 'seqs', 'selectors')
+
+    def __init__(self):
+        #: maps a path component to a child _Node
+        self.children = {}
+        #: insertion sequence numbers of selectors stored in this node,
+        #: increasing
+        self.seqs = array('L')
+        #: selectors stored in this node, same order as self.seqs
+        self.selectors = []
+
+    def iter_entries(self, reverse, after):
+        """
+        Yields (key, selector), key being the sequence number (negated if
+        reverse is True), skipping entries up to sequence number after.
+        """
+        if reverse:
+            end = len(self.seqs) if after is None else \
+                bisect_left(self.seqs, after)
+            for i in xrange(end - 1, -1, -1):
+                yield -self.seqs[i], self.selectors[i]
+        else:
+            start = 0 if after is None else bisect_right(self.seqs, after)
+            for i in xrange(start, len(self.seqs)):
+                yield self.seqs[i], self.selectors[i]
+
+
+class SelectorIndex(object):
+    """
+    Index of (domain, selector), ordered by insertion.
+    """
+
+    def __init__(self):
+        #: self.roots['domain'] is the root _Node for this domain
+        self.roots = defaultdict(_Node)
+        #: self.seq_of['domain']['selector'] is the sequence number of an
+        #: indexed selector, used to find it in its node
+        self.seq_of = defaultdict(dict)
+        #: sequence number of the next added selector
+        self.next_seq = 1
+
+    @staticmethod
+    def _components(selector):
+        """
+        Returns (path components, remainder). The remainder starts with '%' or
+        '~' if selector contains a hash or a version.
+        """
+        pos = len(selector)
+        for sep in ('%', '~'):
+            if sep in selector:
+                pos = min(pos, selector.index(sep))
+        return selector[1:pos].split('/'), selector[pos:]
+
+    def add(self, domain, selector):
+        """
+        Index selector. Returns its sequence number.
+        """
+        node = self.roots[domain]
+        components, _ = self._components(selector)
+        for component in components:
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _Node()
+            node = child
+        seq = self.next_seq
+        self.next_seq += 1
+        node.seqs.append(seq)
+        node.selectors.append(selector)
+        self.seq_of[domain][selector] = seq
+        return seq
+
+    def remove(self, domain, selector):
+        """
+        Remove selector from the index. Returns False if it was not indexed.
+        """
+        seq = self.seq_of[domain].pop(selector, None)
+        if seq is None:
+            return False
+        node = self.roots[domain]
+        components, _ = self._components(selector)
+        for component in components:
+            node = node.children[component]
+        i = bisect_left(node.seqs, seq)
+        del node.seqs[i]
+        del node.selectors[i]
+        return True
+
+    def _subtree(self, node):
+        """
+        Returns the list of nodes in the subtree rooted at node.
+        """
+        nodes = []
+        to_visit = [node]
+        while to_visit:
+            node = to_visit.pop()
+            nodes.append(node)
+            to_visit.extend(node.children.itervalues())
+        return nodes
+
+    def _prefix_nodes(self, domain, prefix):
+        """
+        Returns the list of nodes that may contain selectors starting with
+        prefix.
+        """
+        if domain not in self.roots:
+            return []
+        if not prefix.startswith('/'):
+            return [] if prefix else self._subtree(self.roots[domain])
+        components, remainder = self._components(prefix)
+        node = self.roots[domain]
+        if remainder:
+            # the prefix contains a full path: a single node is concerned
+            for component in components:
+                node = node.children.get(component)
+                if node is None:
+                    return []
+            return [node]
+        for component in components[:-1]:
+            node = node.children.get(component)
+            if node is None:
+                return []
+        # last component may be incomplete
+        partial = components[-1]
+        nodes = []
+        for component, child in node.children.iteritems():
+            if component.startswith(partial):
+                nodes.extend(self._subtree(child))
+        return nodes
+
+    def iter_prefix(self, domain, prefix, reverse=False, after=None):
+        """
+        Yields (seq, selector) for selectors starting with prefix, in
+        insertion order (most recent first if reverse is True).
+
+        :param after: if set, only selectors that come after the selector
+            having this sequence number are returned.
+        """
+        nodes = self._prefix_nodes(domain, prefix)
+        entries = heapq.merge(*[node.iter_entries(reverse, after) for node in
+                                nodes])
+        for key, selector in entries:
+            if selector.startswith(prefix):
+                yield (-key if reverse else key), selector
+
+    def find(self, domain, selector_regex, limit=0, offset=0):
+        """
+        Returns selectors matching selector_regex, from most recent to oldest.
+        Only the subtree matching the regex' literal prefix is explored.
+        """
+        regex = re.compile(selector_regex)
+        result = []
+        for _, selector in self.iter_prefix(
+                domain, literal_prefix(selector_regex), reverse=True):
+            if regex.match(selector):
+                if offset > 0:
+                    offset -= 1
+                    continue
+                result.append(selector)
+                if limit != 0 and len(result) >= limit:
+                    break
+        return result
+
+    def find_by_prefix(self, domain, selector_prefix, limit=0, offset=0):
+        """
+        Returns selectors starting with selector_prefix, from oldest to most
+        recent.
+        """
+        result = []
+        for _, selector in self.iter_prefix(domain, selector_prefix):
+            if offset > 0:
+                offset -= 1
+                continue
+            result.append(selector)
+            if limit != 0 and len(result) >= limit:
+                break
+        return result
+
+    @staticmethod
+    def _page(entries, limit):
+        """
+        Returns (selectors, seq of the last returned selector) for the first
+        limit (seq, selector) of entries. seq is None if entries is exhausted.
+        """
+        result = []
+        for seq, selector in entries:
+            result.append(selector)
+            if limit != 0 and len(result) >= limit:
+                return result, seq
+        return result, None
+
+    def find_page(self, domain, selector_regex, limit, after=None):
+        """
+        Returns (selectors, seq): up to limit selectors matching
+        selector_regex, from most recent to oldest, and the sequence number
+        from which the next page may be requested, or None if there are no
+        more results.
+
+        :param after: sequence number returned along the previous page, None
+            for the first page
+        """
+        regex = re.compile(selector_regex)
+        entries = self.iter_prefix(domain, literal_prefix(selector_regex),
+                                   reverse=True, after=after)
+        return self._page(((seq, selector) for seq, selector in entries
+                           if regex.match(selector)), limit)
+
+    def find_by_prefix_page(self, domain, selector_prefix, limit, after=None):
+        """
+        Returns (selectors, seq): up to limit selectors starting with
+        selector_prefix, from oldest to most recent, and the sequence number
+        from which the next page may be requested, or None if there are no
+        more results.
+
+        :param after: sequence number returned along the previous page, None
+            for the first page
+        """
+        return self._page(self.iter_prefix(domain, selector_prefix,
+                                           after=after), limit)
+
+    def dump(self):
+        """
+        Returns a picklable representation of this index.
+        """
+        domains = {}
+        for domain, root in self.roots.iteritems():
+            domains[domain] = list(heapq.merge(
+                *[node.iter_entries(False, None) for node in
+                  self._subtree(root)]))
+        return {'next_seq': self.next_seq, 'domains': domains}
+
+    @classmethod
+    def load(cls, dumped):
+        """
+        Returns a SelectorIndex from the output of dump()
+        """
+        index = cls()
+        for domain, entries in dumped['domains'].iteritems():
+            for seq, selector in entries:
+                index.next_seq = seq
+                index.add(domain, selector)
+        index.next_seq = dumped['next_seq']
+        return index
@@ -0,0 +1,216 @@
+"""
+Portable snapshots of a whole storage: descriptors, values, processed state
+and agents' internal states, written to a single compressed archive, from
+which any storage backend may be filled.
+
+An archive starts with MAGIC, followed by frames. Each frame is made of a
+one-byte kind, the length of its payload (4 bytes, big endian), and its
+payload, a zlib-compressed pickle:
+
+* 'D': list of (domain, selector, meta_dict, value, processed, processable)
+  of up to CHUNK_SELECTORS descriptors, in the order in which they have been
+  stored. meta_dict and value are None for descriptors that were already
+  present in the archive an incremental export is based on; only their
+  processed state is exported.
+* 'S': list of (agent name, internal state)
+* 'M': manifest, last frame: {'domain': [selectors]} of all descriptors that
+  were stored when the archive was exported. Incremental exports skip
+  descriptors listed in the manifest of a previous archive.
+
+Chunks are read from the storage, serialized and compressed by a pool of
+threads, and decompressed and unserialized in parallel when importing. At
+most WINDOW chunks per thread are in flight. Chunks are written, then added
+to the storage, in archive order, so that descriptors are stored in the same
+order as in the exported storage.
+"""
+import logging
+import struct
+import zlib
+from collections import defaultdict
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+from rebus.descriptor import Descriptor
+from rebus.tools.chunks import CHUNK_SELECTORS
+from rebus.tools.serializer import picklev2 as snapshot_serializer
+
+log = logging.getLogger("rebus.snapshot")
+
+MAGIC = 'REBUS-SNAPSHOT-1\n'
+_FRAME = struct.Struct('>cI')
+#: zlib level used to compress frames
+LEVEL = 6
+#: number of chunks per thread that are read ahead
+WINDOW = 2
+
+
+def _encode(obj):
+    return zlib.compress(snapshot_serializer.dumps(obj), LEVEL)
+
+
+def _decode(payload):
+    return snapshot_serializer.loads(zlib.decompress(payload))
+
+
+def _ordered_map(pool, func, iterable, window):
+    """
+    Yields func(item) for items of iterable, in order, computed by pool.
+    Only window items are read ahead.
+    """
+    iterator = iter(iterable)
+    while True:
+        items = list(islice(iterator, window))
+        if not items:
+            return
+        for result in pool.map(func, items):
+            yield result
+
+
+def _write_frame(fp, kind, payload):
+    fp.write(_FRAME.pack(kind, len(payload)))
+    fp.write(payload)
+
+
+def iter_frames(fp, skip=()):
+    """
+    Yields (kind, payload) of an archive's frames. Payloads of frames whose
+    kind is in skip are not read, and are yielded as None.
+
+    Raises ValueError if fp is not a snapshot archive.
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a rebus snapshot archive")
+    while True:
+        header = fp.read(_FRAME.size)
+        if not header:
+            return
+        if len(header) != _FRAME.size:
+            raise ValueError("Truncated snapshot archive")
+        kind, length = _FRAME.unpack(header)
+        if kind in skip:
+            fp.seek(length, 1)
+            yield kind, None
+            continue
+        payload = fp.read(length)
+        if len(payload) != length:
+            raise ValueError("Truncated snapshot archive")
+        yield kind, payload
+
+
+def read_manifest(path):
+    """
+    Returns the set of (domain, selector) listed in an archive's manifest.
+    """
+    with open(path, 'rb') as fp:
+        for kind, payload in iter_frames(fp, skip=('D', 'S')):
+            if kind == 'M':
+                manifest = _decode(payload)
+                return set((domain, selector) for domain, selectors in
+                           manifest.iteritems() for selector in selectors)
+    raise ValueError("Snapshot archive %s has no manifest" % path)
+
+
+def _export_chunk(store, domain, selectors, known):
+    """
+    Returns the compressed 'D' payload for selectors of a domain.
+    """
+    new = [selector for selector in selectors if (domain, selector) not in
+           known]
+    descs = dict(zip(new, store.get_many(domain, new)))
+    values = dict(zip(new, store.get_values_many(domain, new)))
+    records = []
+    for selector in selectors:
+        desc = descs.get(selector)
+        processed = list(store.get_processed(domain, selector))
+        processable = list(store.get_processable(domain, selector))
+        if desc is None and (domain, selector) not in known:
+            # removed while exporting
+            continue
+        if desc is None and not processed and not processable:
+            continue
+        records.append((domain, selector,
+                        desc.meta_dict() if desc is not None else None,
+                        values.get(selector), processed, processable))
+    return _encode(records)
+
+
+def export_storage(store, path, since=None, jobs=4):
+    """
+    Writes a snapshot of store to path. Returns the number of exported
+    descriptors.
+
+    :param since: path of a previous archive. If set, descriptors it
+        contains are not exported again.
+    :param jobs: number of threads reading and compressing descriptors
+    """
+    known = read_manifest(since) if since else frozenset()
+    manifest = defaultdict(list)
+    for domain, selector in store.list_selectors():
+        manifest[domain].append(selector)
+    chunks = [(domain, selectors[i:i+CHUNK_SELECTORS])
+              for domain, selectors in manifest.iteritems()
+              for i in xrange(0, len(selectors), CHUNK_SELECTORS)]
+    exported = sum(1 for domain, selectors in manifest.iteritems()
+                   for selector in selectors if (domain, selector) not in
+                   known)
+    pool = ThreadPool(jobs)
+    try:
+        with open(path, 'wb') as fp:
+            fp.write(MAGIC)
+            for payload in _ordered_map(
+                    pool, lambda chunk: _export_chunk(store, chunk[0],
+                                                      chunk[1], known),
+                    chunks, jobs * WINDOW):
+                _write_frame(fp, 'D', payload)
+            states = [(name, store.load_agent_state(name)) for name in
+                      store.list_agent_states()]
+            _write_frame(fp, 'S', _encode(states))
+            _write_frame(fp, 'M', _encode(dict(manifest)))
+    finally:
+        pool.close()
+        pool.join()
+    log.info("Exported %d descriptors to %s%s", exported, path,
+             " (since %s)" % since if since else "")
+    return exported
+
+
+def import_storage(store, path, jobs=4):
+    """
+    Adds the contents of a snapshot archive to store, then stores its state.
+    Descriptors that are already present are skipped; their processed state
+    is merged. Returns the number of added descriptors.
+
+    Incremental archives must be imported after the archive they are based
+    on.
+
+    :param jobs: number of threads decompressing and unserializing chunks
+    """
+    imported = 0
+    pool = ThreadPool(jobs)
+    try:
+        with open(path, 'rb') as fp:
+            frames = ((kind, payload) for kind, payload in
+                      iter_frames(fp, skip=('M',)) if kind != 'M')
+            for kind, records in _ordered_map(
+                    pool, lambda frame: (frame[0], _decode(frame[1])),
+                    frames, jobs * WINDOW):
+                if kind == 'S':
+                    for agent_name, state in records:
+                        store.store_agent_state(agent_name, state)
+                    continue
+                for domain, selector, meta, value, processed, \
+                        processable in records:
+                    if meta is not None and \
+                            store.add(Descriptor(value=value, **meta)):
+                        imported += 1
+                    for agent_name, config_txt in processed:
+                        store.mark_processed(domain, selector, agent_name,
+                                             config_txt)
+                    for agent_name, config_txt in processable:
+                        store.mark_processable(domain, selector, agent_name,
+                                               config_txt)
+    finally:
+        pool.close()
+        pool.join()
+    store.store_state()
+    log.info("Imported %d descriptors from %s", imported, path)
+    return imported
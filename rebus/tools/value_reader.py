@@ -0,0 +1,89 @@
+"""
+Read-only file-like access to descriptor values, fetching only the requested
+ranges. May be handed to tarfile, zipfile and similar modules.
+"""
+import os
+
+
+class ValueReader(object):
+    """
+    Seekable, read-only file-like object. Small reads are served from a
+    read-ahead buffer of block_size bytes.
+    """
+
+    def __init__(self, read_range, size, name=None, block_size=1024*1024):
+        """
+        :param read_range: function(offset, length) returning the requested
+            part of the value
+        :param size: size of the value
+        :param name: optional name, ex. the descriptor's label
+        :param block_size: minimum size of requested ranges
+        """
+        self._read_range = read_range
+        self.size = size
+        self.name = name
+        self.block_size = block_size
+        self.closed = False
+        self._pos = 0
+        #: read-ahead buffer, and its offset in the value
+        self._buf = ''
+        self._buf_offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def tell(self):
+        self._check_open()
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._check_open()
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        elif whence != os.SEEK_SET:
+            raise ValueError("Invalid whence (%r)" % whence)
+        if offset < 0:
+            raise IOError("Invalid offset (%d)" % offset)
+        self._pos = offset
+        return self._pos
+
+    def read(self, size=-1):
+        self._check_open()
+        if size is None or size < 0:
+            size = self.size - self._pos
+        size = max(0, min(size, self.size - self._pos))
+        if size == 0:
+            return ''
+        start = self._pos - self._buf_offset
+        if 0 <= start and start + size <= len(self._buf):
+            data = self._buf[start:start + size]
+        elif size >= self.block_size:
+            data = self._read_range(self._pos, size)
+        else:
+            self._buf = self._read_range(self._pos, self.block_size)
+            self._buf_offset = self._pos
+            data = self._buf[:size]
+        self._pos += len(data)
+        return data
+
+    def close(self):
+        self.closed = True
+        self._buf = ''
@@ -0,0 +1,53 @@
+#! /usr/bin/env python2
+"""
+Measures how many descriptors can be recorded and marked as processed per
+second by MetadataDB, with one transaction per insert (default), and in
+write-behind mode.
+
+Usage: python2 test/bench_metadatadb.py [--count N] [--agents N]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from rebus.storage import MetadataDB
+
+
+def run(path, count, agents, commit_batch):
+    """
+    Returns the number of marks per second.
+    """
+    db = MetadataDB(os.path.join(path, 'bench-%d.sqlite3' % commit_batch),
+                    commit_batch=commit_batch)
+    start = time.time()
+    for i in xrange(count):
+        selector = '/binary/elf/%%%064x' % i
+        db.add_selector('default', selector)
+        for agent in xrange(agents):
+            db.add_processed('default', selector, 'agent%d' % agent, '{}')
+    db.close()
+    return count * (agents + 1) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--count', type=int, default=2000,
+                        help="Number of descriptors")
+    parser.add_argument('--agents', type=int, default=4,
+                        help="Number of agents marking each descriptor as "
+                        "processed")
+    parser.add_argument('--commit-batch', type=int, default=1000,
+                        help="Max transaction size in write-behind mode")
+    options = parser.parse_args()
+    path = tempfile.mkdtemp('rebus-bench')
+    try:
+        for batch in (1, options.commit_batch):
+            print("commit_batch=%-6d %10.0f marks/s" % (
+                batch, run(path, options.count, options.agents, batch)))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1040 @@
+import argparse
+import os
+import shutil
+import sqlite3
+import StringIO
+import tempfile
+import threading
+import zipfile
+import pytest
+
+from rebus.descriptor import Descriptor
+from rebus.storage import MetadataDB
+from rebus.storage_backends import diskstorage
+from rebus.storage_backends.diskstorage import DiskStorage
+from rebus.storage_backends.ramstorage import RAMStorage
+from rebus.storage_backends.segmentstorage import SegmentStorage
+from rebus.storage_backends.sqlitestorage import SQLiteStorage
+from rebus.tools import format_check
+from rebus.tools.chunks import bounded_results, fetch_in_chunks
+from rebus.tools.retention import GarbageCollector
+from rebus.tools.selector_index import SelectorIndex
+from rebus.tools.snapshot import export_storage, import_storage, \
+    read_manifest
+from rebus.tools.value_reader import ValueReader
+
+
+# This file implements storage backend tests - descriptors are added directly
+# to storage instances, without running a bus.
+
+
+def storage_options(storage_class, args):
+    """
+    Returns a namespace containing parsed arguments for the requested storage
+    backend.
+
+    :param args: list of arguments
+    """
+    parser = argparse.ArgumentParser()
+    storage_class.add_arguments(parser)
+    return parser.parse_args(args)
+
+
+@pytest.fixture(scope='function')
+def diskpath(request):
+    # py.test-provided fixture "tmpdir" does not guarantee an empty temp
+    # directory, which get re-used when test is run again - rolling our own...
+    tmpdir = tempfile.mkdtemp('rebus-test-diskstorage')
+
+    def fin():
+        shutil.rmtree(tmpdir)
+    request.addfinalizer(fin)
+    return tmpdir
+
+
+def open_diskstorage(path, *args):
+    return DiskStorage(storage_options(DiskStorage,
+                                       ['--path', path] + list(args)))
+
+
+def open_segmentstorage(path, *args):
+    return SegmentStorage(storage_options(
+        SegmentStorage, ['--path', path, '--compact-interval', '0'] +
+        list(args)))
+
+
+def open_sqlitestorage(path, *args):
+    return SQLiteStorage(storage_options(
+        SQLiteStorage, ['--path', os.path.join(path, 'rebus.sqlite3')] +
+        list(args)))
+
+
+@pytest.fixture(scope='function',
+                params=['diskstorage', 'ramstorage', 'segmentstorage',
+                        'sqlitestorage'])
+def store(request, diskpath):
+    if request.param == 'diskstorage':
+        return open_diskstorage(diskpath)
+    if request.param == 'segmentstorage':
+        return open_segmentstorage(diskpath)
+    if request.param == 'sqlitestorage':
+        return open_sqlitestorage(diskpath)
+    return RAMStorage()
+
+
+def make_descriptors():
+    """
+    Returns a list of descriptors: an injected binary, and two of its
+    children.
+    """
+    root = Descriptor('ls', '/binary/elf', '\x7fELF' + 'A' * 100,
+                      agent='inject')
+    strings = root.spawn_descriptor('/string/ascii', 'hello world',
+                                    'strings')
+    hashed = root.spawn_descriptor('/hash/md5', '0123456789abcdef', 'hasher')
+    return [root, strings, hashed]
+
+
+def lineage_edges(store):
+    """
+    Returns the set of (domain, precursor, selector) of a store's lineage
+    index.
+    """
+    lineage = store.lineage
+    return set((domain, precursor, selector)
+               for domain, ids in lineage.ids.items() for selector in ids
+               for precursor in lineage.precursors_of(domain, selector) or ())
+
+
+def test_add_get(store):
+    descs = make_descriptors()
+    for desc in descs:
+        assert store.add(desc)
+    assert not store.add(descs[0])
+    for desc in descs:
+        stored = store.get_descriptor(desc.domain, desc.selector)
+        assert (stored.selector, stored.uuid) == (desc.selector, desc.uuid)
+        assert stored.precursors == desc.precursors
+        assert store.get_value(desc.domain, desc.selector) == desc.value
+    stored = store.get_descriptor('default', '/binary/elf/~-1')
+    assert stored.selector == descs[0].selector
+    assert store.list_uuids('default') == {descs[0].uuid: 'ls'}
+
+
+def test_catalog_snapshot(diskpath):
+    descs = make_descriptors()
+    store = open_diskstorage(diskpath)
+    store.add(descs[0])
+    store.store_state()
+    # added after the snapshot has been written: recorded to the delta
+    store.add(descs[1])
+    store.add(descs[2])
+
+    reopened = open_diskstorage(diskpath, '--discover-processes', '1')
+    assert reopened.descriptor_count == 3
+    assert reopened.version_cache == store.version_cache
+    assert lineage_edges(reopened) == lineage_edges(store)
+    assert reopened.uuids == store.uuids
+    assert reopened.labels == store.labels
+
+    # missing snapshot: descriptors are discovered again
+    os.remove(os.path.join(diskpath, 'catalog.snapshot'))
+    rediscovered = open_diskstorage(diskpath, '--discover-processes', '2')
+    assert rediscovered.descriptor_count == 3
+    assert lineage_edges(rediscovered) == lineage_edges(store)
+    assert rediscovered.uuids == store.uuids
+    assert os.path.isfile(os.path.join(diskpath, 'catalog.snapshot'))
+
+
+def test_journal_recovery(diskpath):
+    descs = make_descriptors()
+    store = open_diskstorage(diskpath)
+    store.add(descs[0])
+    store.store_state()
+    # Simulate a crash: descs[1] has been completely written but not
+    # registered, descs[2] was being written
+    for desc in descs[1:]:
+        store.add(desc)
+    fname = store._pathFromSelector('default', descs[2].selector)
+    os.rename(fname + '.meta', fname + '.meta.tmp')
+    store.db.remove_selectors_except(set([('default', descs[0].selector)]))
+    open(os.path.join(diskpath, 'catalog.delta'), 'wb').close()
+    with open(os.path.join(diskpath, 'journal'), 'wb') as fp:
+        for desc in descs[1:]:
+            relname = store._pathFromSelector(
+                'default', desc.selector)[len(diskpath):]
+            diskstorage._write_record(
+                fp, ('begin', relname, 'default', desc.selector))
+
+    recovered = open_diskstorage(diskpath)
+    assert recovered.descriptor_count == 2
+    assert recovered.get_value('default', descs[1].selector) == descs[1].value
+    assert recovered.get_descriptor('default', descs[2].selector) is None
+    assert not os.path.exists(fname + '.meta.tmp')
+    assert not os.path.exists(fname + '.value')
+    assert os.path.getsize(os.path.join(diskpath, 'journal')) == 0
+    # the recovered descriptor is part of the catalog
+    assert open_diskstorage(diskpath).descriptor_count == 2
+
+
+def test_journal_lost_data(diskpath):
+    descs = make_descriptors()
+    store = open_diskstorage(diskpath, '--fsync-batch', '16')
+    store.add(descs[0])
+    store.store_state()
+    journal = os.path.join(diskpath, 'journal')
+    for desc in descs[1:]:
+        store.add(desc)
+    with open(journal, 'rb') as fp:
+        records = fp.read()
+    # Simulate a power loss: the renames of descs[1] and descs[2] reached the
+    # disk, but neither the contents of descs[1]'s files, nor the renames'
+    # end records did, and descs[2]'s rename of its .meta file was lost
+    fname = store._pathFromSelector('default', descs[1].selector)
+    open(fname + '.meta', 'wb').close()
+    with open(fname + '.value', 'r+b') as fp:
+        fp.truncate(1)
+    lost = store._pathFromSelector('default', descs[2].selector)
+    os.rename(lost + '.meta', lost + '.meta.tmp')
+    store.db.remove_selectors_except(set([('default', descs[0].selector)]))
+    open(os.path.join(diskpath, 'catalog.delta'), 'wb').close()
+    with open(journal, 'wb') as fp:
+        fp.write(records)
+
+    recovered = open_diskstorage(diskpath)
+    assert recovered.descriptor_count == 1
+    for desc, path in zip(descs[1:], (fname, lost)):
+        assert recovered.get_descriptor('default', desc.selector) is None
+        for ext in ('.meta', '.meta.tmp', '.value'):
+            assert not os.path.exists(path + ext)
+    assert open_diskstorage(diskpath).descriptor_count == 1
+
+
+def test_journal_batch_fsync(diskpath, monkeypatch):
+    store = open_diskstorage(diskpath, '--fsync-batch', '8')
+    journal_fsyncs = []
+    fsync = os.fsync
+
+    def counting_fsync(fd):
+        if fd == store._journal.fileno():
+            journal_fsyncs.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', counting_fsync)
+    root = make_descriptors()[0]
+    for i in range(32):
+        store.add(root.spawn_descriptor('/string/ascii', 'value %d' % i,
+                                        'strings'))
+    # once per batch
+    assert len(journal_fsyncs) == 4
+
+
+def test_journal_lost_begin_records(diskpath):
+    descs = make_descriptors()
+    store = open_diskstorage(diskpath, '--fsync-batch', '16')
+    store.add(descs[0])
+    store.store_state()
+    journal = os.path.join(diskpath, 'journal')
+    for desc in descs[1:]:
+        store.add(desc)
+    # Simulate a power loss: only the 'batch' record reached the disk. The
+    # contents of descs[1]'s value did not, nor did the rename of descs[2]'s
+    # .meta file
+    records = list(diskstorage._read_records(journal))
+    assert records[0][0] == 'batch'
+    with open(journal, 'wb') as fp:
+        diskstorage._write_record(fp, records[0])
+    fname = store._pathFromSelector('default', descs[1].selector)
+    with open(fname + '.value', 'r+b') as fp:
+        fp.truncate(1)
+    lost = store._pathFromSelector('default', descs[2].selector)
+    os.rename(lost + '.meta', lost + '.meta.tmp')
+
+    recovered = open_diskstorage(diskpath)
+    assert recovered.descriptor_count == 1
+    assert recovered.db.count_selectors() == 1
+    for desc, path in zip(descs[1:], (fname, lost)):
+        assert recovered.get_descriptor('default', desc.selector) is None
+        for ext in ('.meta', '.meta.tmp', '.value'):
+            assert not os.path.exists(path + ext)
+    assert recovered.get_value('default', descs[0].selector) == \
+        descs[0].value
+
+
+@pytest.mark.parametrize('shard_by', ['hash', 'domain'])
+def test_diskstorage_shards(diskpath, shard_by):
+    shards = [os.path.join(diskpath, name) for name in ('main', 's1', 's2')]
+    for path in shards:
+        os.mkdir(path)
+    store = open_diskstorage(shards[0], '--shard-path', shards[1],
+                             '--shard-path', shards[2], '--shard-by', shard_by)
+    descs = []
+    for domain in ('default', 'other', 'third'):
+        root = Descriptor('ls', '/binary/elf', 'ELF' + domain, domain,
+                          agent='inject')
+        descs.append(root)
+        descs.extend(root.spawn_descriptor('/string/ascii', str(i), 'strings')
+                     for i in range(4))
+    for desc in descs:
+        store.add(desc)
+        store.mark_processed(desc.domain, desc.selector, 'agent', '{}')
+        fname = store._pathFromSelector(desc.domain, desc.selector)
+        assert os.path.isfile(fname + '.meta')
+    used = set(store._shard_of(d.domain, d.selector) for d in descs)
+    assert len(used) > 1
+    assert [db.count_selectors() for db in store.db.dbs] == \
+        [sum(1 for d in descs if store._shard_of(d.domain, d.selector) == i)
+         for i in range(3)]
+    assert store.processed_stats('default') == ([('agent', 5)], 5)
+    for selector in ('/binary/elf/~-1', '/binary/', '/string/ascii/%'):
+        assert not store.get_processed('default', selector)
+    assert store.get_descriptor('other', '/binary/elf/~-1').selector == \
+        descs[5].selector
+    store.store_state()
+    # shard paths are recorded, and files are found again by discovery
+    reopened = open_diskstorage(shards[0], '--rediscover')
+    assert reopened.shard_paths == shards
+    assert sorted(reopened.find('default', '/', 0, 0)) == \
+        sorted(d.selector for d in descs if d.domain == 'default')
+    assert reopened.get_value('third', descs[-1].selector) == '3'
+    assert reopened.list_unprocessed_by_agent('agent', '{}') == []
+    with pytest.raises(IOError):
+        open_diskstorage(shards[0], '--shard-path', shards[1])
+
+
+def test_metadatadb_write_behind(diskpath):
+    dbpath = os.path.join(diskpath, 'test.sqlite3')
+    db = MetadataDB(dbpath, commit_batch=100, commit_interval=60)
+    reader = MetadataDB(dbpath)
+    db.add_selector('default', '/sel/%00')
+    assert db.add_processed('default', '/sel/%00', 'agent', '{}')
+    assert not db.add_processed('default', '/sel/%00', 'agent', '{}')
+    assert db.is_processed('default', '/sel/%00', 'agent', '{}')
+    # not committed yet
+    assert reader.count_selectors() == 0
+    db.flush()
+    assert reader.count_selectors() == 1
+    assert reader.is_processed('default', '/sel/%00', 'agent', '{}')
+    db.close()
+
+
+def test_metadatadb_readers(diskpath):
+    db = MetadataDB(os.path.join(diskpath, 'test.sqlite3'), readers=2)
+    for selector in ('/binary/elf/%00', '/string/%01'):
+        db.add_selector('default', selector)
+    db.add_processed('default', '/string/%01', 'agent', '{}')
+    results = []
+
+    def query():
+        results.append(db.list_unprocessed_by_agent('agent', '{}'))
+        results.append(db.find('default', '/binary/', 0, 0))
+
+    # queries do not wait for the writer connection
+    with db._dblock:
+        thread = threading.Thread(target=query)
+        thread.start()
+        thread.join(10)
+        assert results == [[('default', '/binary/elf/%00')],
+                           ['/binary/elf/%00']]
+    db.close()
+
+
+def test_find(store):
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    # most recent first
+    assert store.find('default', '/', 0, 0) == [d.selector for d in
+                                                 reversed(descs)]
+    assert store.find('default', '/binary/e.f/', 0, 0) == [descs[0].selector]
+    assert store.find('default', '/(hash|string)/', 1, 1) == \
+        [descs[1].selector]
+    assert store.find('default', '/nothing', 0, 0) == []
+    assert store.find('other', '/', 0, 0) == []
+    # oldest first
+    found = store.find_by_selector('default', '/', 0, 0)
+    assert [d.selector for d in found] == [d.selector for d in descs]
+    found = store.find_by_selector('default', '/str', 0, 0)
+    assert [d.selector for d in found] == [descs[1].selector]
+    found = store.find_by_selector('default', descs[2].selector[:-3], 0, 0)
+    assert [d.selector for d in found] == [descs[2].selector]
+    found = store.find_by_selector('default', '/', 1, 1)
+    assert [d.selector for d in found] == [descs[1].selector]
+
+
+def test_find_page(store):
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    selectors, cursor = store.find_page('default', '/', 2)
+    assert selectors == [descs[2].selector, descs[1].selector]
+    # page boundaries do not depend on descriptors added meanwhile
+    store.add(descs[0].spawn_descriptor('/string/utf8', 'new', 'strings'))
+    selectors, cursor = store.find_page('default', '/', 2, cursor)
+    assert (selectors, cursor) == ([descs[0].selector], '')
+    found, cursor = store.find_by_selector_page('default', '/', 1)
+    assert [d.selector for d in found] == [descs[0].selector]
+    found, cursor = store.find_by_selector_page('default', '/', 2, cursor)
+    assert [d.selector for d in found] == [descs[1].selector,
+                                           descs[2].selector]
+    found, cursor = store.find_by_selector_page('default', '/', 2, cursor)
+    assert len(found) == 1 and found[0].selector.startswith('/string/utf8')
+    assert cursor == ''
+
+
+def test_get_many(store):
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    selectors = [descs[1].selector, '/string/%' + '0' * 64, descs[0].selector]
+    found = store.get_many('default', selectors)
+    assert [d and d.selector for d in found] == \
+        [descs[1].selector, None, descs[0].selector]
+    assert store.get_values_many('default', selectors) == \
+        [descs[1].value, None, descs[0].value]
+    # replies are bounded, slaves request remaining selectors
+    replies = []
+
+    def fetch(chunk):
+        replies.append(bounded_results(
+            chunk, lambda sel: store.get_value('default', sel) or '', 10))
+        return replies[-1]
+    assert fetch_in_chunks(selectors, fetch, 2) == \
+        [descs[1].value, '', descs[0].value]
+    assert [len(reply) for reply in replies] == [1, 2]
+
+
+def test_selector_index_snapshot(diskpath):
+    store = open_diskstorage(diskpath)
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    store.store_state()
+    reopened = open_diskstorage(diskpath)
+    assert reopened.find('default', '/', 0, 0) == \
+        store.find('default', '/', 0, 0)
+    os.remove(os.path.join(diskpath, 'catalog.snapshot'))
+    rediscovered = open_diskstorage(diskpath, '--discover-processes', '2')
+    assert rediscovered.find('default', '/', 0, 0) == \
+        store.find('default', '/', 0, 0)
+
+
+def test_selector_index_remove():
+    index = SelectorIndex()
+    for i in range(6):
+        index.add('default', '/binary/%%0%d' % i)
+    index = SelectorIndex.load(index.dump())
+    assert index.remove('default', '/binary/%03')
+    assert not index.remove('default', '/binary/%03')
+    assert index.remove('default', '/binary/%00')
+    assert index.find('default', '/binary/') == \
+        ['/binary/%05', '/binary/%04', '/binary/%02', '/binary/%01']
+    assert index.find('default', u'/binary/\u20ac|/binary/%01') == \
+        ['/binary/%01']
+
+
+def test_metadatadb_find(diskpath):
+    db = MetadataDB(os.path.join(diskpath, 'test.sqlite3'))
+    for selector in ('/binary/elf/%00', '/string/%01', '/binary/pe/%02'):
+        db.add_selector('default', selector)
+    assert db.find('default', '/binary/', 0, 0) == ['/binary/pe/%02',
+                                                    '/binary/elf/%00']
+    assert db.find('default', '/.*/%01', 0, 0) == ['/string/%01']
+    assert db.find('default', u'/string/\u20ac|/string/', 0, 0) == \
+        ['/string/%01']
+    assert db.find_by_selector('default', '/binary/', 1, 1) == \
+        ['/binary/elf/%00']
+    assert db.find_by_selector('default', '/binary/', 1, 1,
+                               oldest_first=True) == ['/binary/pe/%02']
+
+
+@pytest.mark.parametrize('ngram', [False, True])
+def test_find_by_value(store, ngram, diskpath):
+    if ngram:
+        if isinstance(store, DiskStorage):
+            store = open_diskstorage(diskpath, '--ngram-index',
+                                     '--ngram-max-value-size', '50')
+        elif isinstance(store, RAMStorage):
+            store = RAMStorage(storage_options(RAMStorage, ['--ngram-index']))
+        else:
+            pytest.skip("no n-gram index support")
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+
+    def found(prefix, regex):
+        return sorted(d.selector for d in
+                      store.find_by_value('default', prefix, regex))
+    assert found('/', '.*world') == [descs[1].selector]
+    assert found('/string', 'hel+o w(or)+ld') == [descs[1].selector]
+    assert found('/hash', 'hello') == []
+    assert found('/', '\x7fELFAAA') == [descs[0].selector]
+    assert found('/', '(?i)HELLO') == [descs[1].selector]
+    assert found('/', '.*(world|cdef)') == sorted([descs[1].selector,
+                                                   descs[2].selector])
+
+
+def test_ngram_index_persistence(diskpath):
+    descs = make_descriptors()
+    store = open_diskstorage(diskpath, '--ngram-index')
+    store.add(descs[0])
+    store.add(descs[1])
+    store.store_state()
+    store.add(descs[2])
+    assert os.path.isfile(os.path.join(diskpath, 'ngram.index'))
+    reopened = open_diskstorage(diskpath, '--ngram-index')
+    assert ('default', descs[2].selector) in reopened.ngram
+    assert reopened.ngram.candidates('default', '.*cdef') == \
+        set([descs[2].selector])
+
+
+def test_find_by_uuid(store):
+    descs = make_descriptors()
+    other = Descriptor('other', '/binary/pe', 'MZ', agent='inject')
+    for desc in descs + [other]:
+        store.add(desc)
+    found = store.find_by_uuid('default', descs[0].uuid)
+    assert sorted(d.selector for d in found) == \
+        sorted(d.selector for d in descs)
+    assert store.find_by_uuid('default', 'unknown') == []
+    assert store.list_uuids('default') == {descs[0].uuid: 'ls',
+                                           other.uuid: 'other'}
+    if isinstance(store, RAMStorage):
+        assert [d.selector for d in store.find_by_agent('default', 'strings')]\
+            == [descs[1].selector]
+
+
+def test_processed_state(store):
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    root, strings = descs[0].selector, descs[1].selector
+    assert store.mark_processed('default', root, 'strings', '{}')
+    assert not store.mark_processed('default', root, 'strings', '{}')
+    assert store.mark_processable('default', strings, 'web', '{}')
+    assert not store.mark_processable('default', strings, 'web', '{}')
+    assert store.get_processable('default', strings) == set([('web', '{}')])
+    # processed by an agent that was able to process it: already accounted
+    assert not store.mark_processed('default', strings, 'web', '{}')
+    assert store.get_processable('default', strings) == set()
+    assert store.get_processed('default', strings) == set([('web', '{}')])
+    assert not store.mark_processable('default', root, 'strings', '{}')
+
+    unprocessed = store.list_unprocessed_by_agent('strings', '{}')
+    assert sorted(unprocessed) == sorted(
+        ('default', d.uuid, d.selector) for d in descs[1:])
+    # another configuration of an agent does not count twice
+    assert store.mark_processed('default', root, 'strings', '{"a": 1}')
+    stats, total = store.processed_stats('default')
+    assert sorted(stats) == [('strings', 1), ('web', 1)]
+    assert total == 3
+    assert store.processed_stats('other') == ([], 0)
+
+
+def test_metadatadb_counters(diskpath):
+    dbpath = os.path.join(diskpath, 'test.sqlite3')
+    # database written by a former version, having no counters
+    db = sqlite3.connect(dbpath)
+    db.execute('CREATE TABLE processed(domain TEXT, selector TEXT, '
+               'agent_name TEXT, config_txt TEXT)')
+    db.execute('CREATE TABLE selectors(domain TEXT, selector TEXT)')
+    db.executemany('INSERT INTO selectors VALUES (?, ?)',
+                   [('default', '/a/%00'), ('default', '/b/%01')])
+    db.executemany('INSERT INTO processed VALUES (?, ?, ?, ?)',
+                   [('default', '/a/%00', 'agent', '{}'),
+                    ('default', '/a/%00', 'agent', '{"a": 1}')])
+    db.commit()
+    db.close()
+    db = MetadataDB(dbpath)
+    assert db.processed_stats('default') == ([('agent', 1)], 2)
+    db.add_selector('default', '/c/%02')
+    db.add_selector('default', '/c/%02')
+    assert db.add_processed('default', '/c/%02', 'agent', '{}')
+    assert db.processed_stats('default') == ([('agent', 2)], 3)
+    db.remove_selector('default', '/a/%00')
+    assert db.processed_stats('default') == ([('agent', 1)], 2)
+
+
+def test_ramstorage_spill(diskpath):
+    store = RAMStorage(storage_options(RAMStorage, [
+        '--max-memory', '120', '--spill-dir', diskpath]))
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    # the 104 bytes root value has been evicted
+    stats = store.cache_stats()
+    assert stats['evictions'] == 1 and stats['spilled'] == 1
+    assert store.get_value('default', descs[0].selector) == descs[0].value
+    assert store.get_descriptor('default', descs[0].selector) == descs[0]
+    found = store.find_by_value('default', '/', '.*hello')
+    assert [d.value for d in found] == [descs[1].value]
+    assert store.find_by_uuid('default', descs[0].uuid)[0].value is not None
+    assert store.cache_stats()['hits'] > 0
+
+
+def test_diskstorage_cache(diskpath):
+    store = open_diskstorage(diskpath, '--cache-size', '1000')
+    descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    for _ in range(3):
+        stored = store.get_descriptor('default', descs[0].selector)
+        assert stored.uuid == descs[0].uuid
+        stored.label = 'modified'
+        stored.precursors.append('/modified/%00')
+        assert store.get_value('default', descs[0].selector) == descs[0].value
+    stats = store.cache_stats()
+    assert (stats['hits'], stats['misses']) == (5, 2)
+    stored = store.get_descriptor('default', descs[0].selector)
+    assert stored.label == 'ls'
+    assert stored.precursors == descs[0].precursors
+
+    uncached = open_diskstorage(diskpath, '--cache-size', '0')
+    assert uncached.get_value('default', descs[1].selector) == descs[1].value
+    assert uncached.cache_stats()['entries'] == 0
+
+
+def test_raw_values(diskpath):
+    store = open_diskstorage(diskpath)
+    descs = make_descriptors()
+    link = descs[0].spawn_descriptor('/link/test', {'key': ['v']}, 'linker')
+    for desc in descs + [link]:
+        store.add(desc)
+    fname = store._pathFromSelector('default', descs[0].selector)
+    with open(fname + '.value', 'rb') as fp:
+        assert fp.read() == descs[0].value
+    buf = store.get_value_buffer('default', descs[0].selector)
+    assert buf[:4] == '\x7fELF' and len(buf) == len(descs[0].value)
+    assert store.get_value_buffer('default', link.selector) == link.value
+
+    # descriptors written by former versions have pickled values
+    legacy = Descriptor('legacy', '/string/ascii', 'legacy value')
+    fname = store._mkdirs('default', legacy.selector)
+    with open(fname + '.value', 'wb') as fp:
+        fp.write(legacy.serialize_value(diskstorage.store_serializer))
+    with open(fname + '.meta', 'wb') as fp:
+        fp.write(legacy.serialize_meta(diskstorage.store_serializer))
+    reopened = open_diskstorage(diskpath, '--rediscover', '--cache-size', '0')
+    assert reopened.descriptor_count == 5
+    for desc in descs + [link, legacy]:
+        assert reopened.get_value('default', desc.selector) == desc.value
+        assert reopened.get_descriptor('default', desc.selector).label == \
+            desc.label
+
+
+def test_value_range(store):
+    descs = make_descriptors()
+    archive = StringIO.StringIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        zf.writestr('a.txt', 'A' * 5000)
+        zf.writestr('b.txt', 'hello')
+    zipped = descs[0].spawn_descriptor('/compressed/zip', archive.getvalue(),
+                                       'unarchive')
+    for desc in descs + [zipped]:
+        store.add(desc)
+    selector = descs[0].selector
+    assert store.get_value_range('default', selector, 0, 4) == '\x7fELF'
+    assert store.get_value_range('default', selector, 100, 10) == 'AAAA'
+    assert store.get_value_size('default', selector) == 104
+    assert store.get_value_size('default', '/binary/elf/~-1') == 104
+    assert store.get_value_range('default', '/unknown/%00', 0, 1) is None
+    assert store.get_value_size('default', '/unknown/%00') is None
+
+    reader = ValueReader(
+        lambda offset, length: store.get_value_range(
+            'default', zipped.selector, offset, length),
+        store.get_value_size('default', zipped.selector), block_size=64)
+    with zipfile.ZipFile(reader) as zf:
+        assert zf.read('b.txt') == 'hello'
+        assert zf.read('a.txt') == 'A' * 5000
+
+
+def test_diskstorage_fanout(diskpath):
+    descs = make_descriptors()
+    store = open_diskstorage(diskpath, '--fanout', '0')
+    for desc in descs[:2]:
+        store.add(desc)
+    store.store_state()
+    flat = store._pathFromSelector('default', descs[0].selector)
+    assert os.path.isfile(flat + '.meta')
+
+    # descriptors are found in both layouts while migrating
+    store = open_diskstorage(diskpath, '--fanout', '2', '--migrate-batch',
+                             '0')
+    store.add(descs[2])
+    fname = store._pathFromSelector('default', descs[2].selector)
+    hashed = descs[2].selector.split('%')[1]
+    assert fname.endswith('/hash/md5/%s/%s/%%%s' % (hashed[:2], hashed[2:4],
+                                                    hashed))
+    assert os.path.isfile(fname + '.meta')
+    for desc in descs:
+        assert store.get_value('default', desc.selector) == desc.value
+    assert not store.add(descs[0])
+    with pytest.raises(IOError):
+        open_diskstorage(diskpath, '--fanout', '1')
+
+    assert store.migrate_layout(2) == 2
+    assert store.migrate_layout(2) == 1
+    assert store.migrate_layout(2) == 0
+    assert store.migrating_from is None
+    assert not os.path.exists(flat + '.meta')
+    flatdir = os.path.dirname(flat)
+    assert all(os.path.isdir(os.path.join(flatdir, name))
+               for name in os.listdir(flatdir))
+    assert [desc.selector for desc in store.find_by_value(
+        'default', '/string', 'hello')] == [descs[1].selector]
+    store.store_state()
+    store = open_diskstorage(diskpath, '--rediscover')
+    assert store.fanout == 2
+    for desc in descs:
+        assert store.get_value('default', desc.selector) == desc.value
+
+
+@pytest.mark.parametrize('backend', ['diskstorage', 'ramstorage',
+                                     'ramstorage-budget'])
+def test_dedup(diskpath, backend):
+    if backend == 'diskstorage':
+        store = open_diskstorage(diskpath)
+    else:
+        store = RAMStorage(storage_options(
+            RAMStorage, ['--max-memory', '10', '--spill-dir', diskpath]
+            if backend == 'ramstorage-budget' else []))
+    value = 'MZ' + 'A' * 1000
+    descs = [Descriptor('a.exe', '/binary/pe', value, domain, agent='inject')
+             for domain in ('default', 'other')]
+    descs.append(descs[0].spawn_descriptor('/link/pe', value, 'linker'))
+    descs.append(descs[0].spawn_descriptor('/string/ascii', 'a', 'strings'))
+    for desc in descs:
+        assert store.add(desc)
+    stats = store.dedup_stats()
+    assert (stats['references'], stats['unique_values']) == (4, 2)
+    assert (stats['logical_bytes'], stats['stored_bytes']) == (3007, 1003)
+    for desc in descs:
+        assert store.get_value(desc.domain, desc.selector) == desc.value
+
+    store._remove('default', descs[0].selector)
+    assert store.get_value('other', descs[1].selector) == value
+    store._remove('default', descs[2].selector)
+    store._remove('other', descs[1].selector)
+    assert store.dedup_stats()['references'] == 1
+    assert store.dedup_stats()['stored_bytes'] == 1
+
+
+def test_dedup_recovery(diskpath):
+    value = 'MZ' + 'A' * 1000
+    root = Descriptor('a.exe', '/binary/pe', value, 'default',
+                      agent='inject')
+    link = root.spawn_descriptor('/link/pe', value, 'linker')
+    store = open_diskstorage(diskpath, '--fsync-batch', '16')
+    store.store_state()
+    journal = os.path.join(diskpath, 'journal')
+    store.add(root)
+    with open(journal, 'rb') as fp:
+        records = fp.read()
+    # Simulate a power loss: the value did not reach the disk, neither
+    # through the descriptor's .value file nor through the deduplicated value
+    fname = store._pathFromSelector('default', root.selector)
+    with open(fname + '.value', 'r+b') as fp:
+        fp.truncate(1)
+    digest = diskstorage.value_digest(value)
+    with open(journal, 'wb') as fp:
+        fp.write(records)
+
+    recovered = open_diskstorage(diskpath)
+    assert recovered.descriptor_count == 0
+    assert not os.path.exists(recovered._value_path(diskpath, digest))
+    assert recovered.add(root)
+    assert recovered.get_value('default', root.selector) == value
+    # truncated deduplicated values are not linked to
+    with open(recovered._value_path(diskpath, digest), 'r+b') as fp:
+        fp.truncate(1)
+    assert recovered.add(link)
+    assert recovered.get_value('default', link.selector) == value
+
+
+def test_compression(diskpath):
+    store = open_diskstorage(diskpath, '--compress', '/=auto',
+                             '--compress', '/string/=zlib:9',
+                             '--compress', '/hash/=none')
+    descs = make_descriptors()
+    text = descs[0].spawn_descriptor('/string/ascii', 'abc' * 1000, 'strings')
+    zipped = descs[0].spawn_descriptor('/compressed/zip', 'Z' * 1000, 'zip')
+    for desc in descs + [text, zipped]:
+        store.add(desc)
+    fname = store._pathFromSelector('default', text.selector)
+    assert os.path.getsize(fname + '.value') < 100
+    fname = store._pathFromSelector('default', zipped.selector)
+    assert os.path.getsize(fname + '.value') == 1000
+    stats = store.compression_stats()
+    assert stats['/string/']['compressed'] == 1
+    assert stats['/hash/'] == {'values': 1, 'compressed': 0,
+                               'original_bytes': 16, 'stored_bytes': 16}
+    assert stats['/']['compressed'] == 1
+    assert stats['/compressed/']['compressed'] == 0
+
+    reopened = open_diskstorage(diskpath, '--cache-size', '0')
+    for desc in descs + [text, zipped]:
+        assert reopened.get_value('default', desc.selector) == desc.value
+    assert reopened.get_value_range('default', text.selector, 3, 4) == 'abca'
+    assert reopened.get_value_size('default', text.selector) == 3000
+
+    with pytest.raises(SystemExit):
+        open_diskstorage(diskpath, '--compress', '/=zlib:12')
+
+
+def test_segmentstorage(diskpath):
+    descs = make_descriptors()
+    store = open_segmentstorage(diskpath, '--segment-size', '300')
+    store.add(descs[0])
+    store.store_agent_state('agent', 'state1')
+    store.store_state()
+    for desc in descs[1:]:
+        store.add(desc)
+    for i in range(20):
+        store.store_agent_state('agent', 'state%d' % i)
+    assert len(store.segment_bytes) > 1
+    # simulate an interrupted write
+    store._sync()
+    with open(store._segment_path(store.active), 'ab') as fp:
+        fp.write('\x01\x00\x00')
+
+    reopened = open_segmentstorage(diskpath)
+    for desc in descs:
+        assert reopened.get_value('default', desc.selector) == desc.value
+    assert reopened.load_agent_state('agent') == 'state19'
+    assert reopened.find('default', '/', 0, 0) == \
+        store.find('default', '/', 0, 0)
+
+    # segments only containing former agent states are removed
+    segments = len(reopened.segment_bytes)
+    assert reopened.compact() > 0
+    assert len(reopened.segment_bytes) < segments
+    for desc in descs:
+        assert reopened.get_value('default', desc.selector) == desc.value
+    assert reopened.load_agent_state('agent') == 'state19'
+
+    os.remove(os.path.join(diskpath, 'index.snapshot'))
+    rescanned = open_segmentstorage(diskpath)
+    assert rescanned.locations == reopened.locations
+    assert rescanned.load_agent_state('agent') == 'state19'
+
+
+def test_segmentstorage_threads(diskpath):
+    store = open_segmentstorage(diskpath, '--compact-interval', '0.01')
+    desc = make_descriptors()[0]
+    added = []
+    threads = [threading.Thread(target=lambda: added.append(store.add(desc)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(added) == [False] * 7 + [True]
+    assert store.find('default', '/', 0, 0) == [desc.selector]
+    store.close()
+    # a running compaction has finished
+    assert not store._compactor.is_alive()
+
+
+def test_segmentstorage_import(diskpath):
+    descs = make_descriptors()
+    diskdir = os.path.join(diskpath, 'disk')
+    segdir = os.path.join(diskpath, 'seg')
+    os.mkdir(diskdir)
+    os.mkdir(segdir)
+    source = open_diskstorage(diskdir)
+    for desc in descs:
+        source.add(desc)
+    source.mark_processed('default', descs[0].selector, 'strings', '{}')
+    source.store_agent_state('agent', 'state')
+    source.store_state()
+    source.close()
+    files = dict((name, os.stat(os.path.join(diskdir, name)).st_mtime)
+                 for name in os.listdir(diskdir))
+
+    store = open_segmentstorage(segdir, '--import-diskstorage', diskdir)
+    assert store.find('default', '/', 0, 0) == \
+        [desc.selector for desc in reversed(descs)]
+    for desc in descs:
+        assert store.get_value('default', desc.selector) == desc.value
+    assert store.get_processed('default', descs[0].selector) == \
+        set([('strings', '{}')])
+    assert store.load_agent_state('agent') == 'state'
+    # the source storage is only read
+    assert files == dict((name, os.stat(os.path.join(diskdir,
+                                                     name)).st_mtime)
+                         for name in os.listdir(diskdir))
+    with pytest.raises(IOError):
+        open_segmentstorage(segdir, '--import-diskstorage', segdir)
+    with pytest.raises(IOError):
+        open_diskstorage(diskdir, '--read-only').add(descs[0])
+
+
+def test_snapshot(store, diskpath):
+    descs = make_descriptors()
+    for desc in descs[:2]:
+        store.add(desc)
+    store.mark_processed('default', descs[0].selector, 'strings', '{}')
+    store.store_agent_state('agent', 'state')
+    full = os.path.join(diskpath, 'full.snap')
+    assert export_storage(store, full, jobs=2) == 2
+
+    store.add(descs[2])
+    store.mark_processed('default', descs[1].selector, 'web', '{}')
+    incremental = os.path.join(diskpath, 'incremental.snap')
+    assert export_storage(store, incremental, since=full) == 1
+
+    copy = RAMStorage()
+    assert import_storage(copy, full, jobs=2) == 2
+    assert import_storage(copy, incremental) == 1
+    assert copy.find('default', '/', 0, 0) == store.find('default', '/', 0,
+                                                         0)
+    for desc in descs:
+        assert copy.get_value('default', desc.selector) == desc.value
+        assert copy.get_processed('default', desc.selector) == \
+            store.get_processed('default', desc.selector)
+    assert copy.load_agent_state('agent') == 'state'
+    with pytest.raises(ValueError):
+        read_manifest(__file__)
+
+
+def test_sqlitestorage_reader(diskpath):
+    descs = make_descriptors()
+    store = open_sqlitestorage(diskpath, '--db-commit-batch', '100')
+    store.add(descs[0])
+    store.store_agent_state('agent', 'state')
+    store.store_state()
+    store.add(descs[1])
+
+    # readers only see committed descriptors
+    reader = open_sqlitestorage(diskpath, '--read-only',
+                                '--db-commit-batch', '100')
+    assert reader.db._flusher is None
+    assert reader.find('default', '/', 0, 0) == [descs[0].selector]
+    assert reader.load_agent_state('agent') == 'state'
+    with pytest.raises(IOError):
+        reader.add(descs[2])
+    store.store_state()
+    assert reader.get_value('default', descs[1].selector) == descs[1].value
+    assert reader.get_descriptor('default', '/string/ascii/~-1').selector == \
+        descs[1].selector
+    reader.close()
+    store.close()
+
+    with pytest.raises(IOError):
+        open_sqlitestorage(os.path.join(diskpath, 'missing'), '--read-only')
+    # read-only databases are not written to, not even to create the schema
+    path = os.path.join(diskpath, 'empty.sqlite3')
+    with pytest.raises(IOError):
+        MetadataDB(path, read_only=True)
+    open(path, 'wb').close()
+    MetadataDB(path, commit_batch=100, read_only=True).close()
+    assert os.path.getsize(path) == 0
+
+
+@pytest.mark.parametrize('backend', ['diskstorage', 'ramstorage'])
+def test_retention(backend, diskpath):
+    args = ['--retention', 'prefix=/string/', '--retention',
+            'domain=default,prefix=/binary/,age=0', '--gc-interval', '0']
+    if backend == 'diskstorage':
+        store = open_diskstorage(diskpath, *args)
+    else:
+        store = RAMStorage(storage_options(RAMStorage, args))
+    root, strings, hashed = descs = make_descriptors()
+    for desc in descs:
+        store.add(desc)
+    store.mark_processed('default', strings.selector, 'web', '{}')
+    # root is kept as long as its children are stored
+    assert store.collect_garbage() == 1
+    assert store.get_descriptor('default', strings.selector) is None
+    assert store.get_processed('default', strings.selector) == set()
+    assert store.find('default', '/', 0, 0) == [hashed.selector,
+                                                root.selector]
+    assert store.get_descriptor('default', root.selector) is not None
+    assert store.get_children('default', root.selector) == \
+        set([store.get_descriptor('default', hashed.selector)])
+    assert store.list_uuids('default') == {root.uuid: 'ls'}
+    assert store.collect_garbage() == 0
+    if backend == 'diskstorage':
+        assert not os.path.exists(os.path.join(diskpath, 'default',
+                                               'string'))
+        reopened = open_diskstorage(diskpath)
+        assert reopened.find('default', '/', 0, 0) == [hashed.selector,
+                                                       root.selector]
+        assert reopened.descriptor_count == 2
+
+    with pytest.raises(SystemExit):
+        RAMStorage(storage_options(RAMStorage, ['--retention', 'age=1y']))
+
+
+@pytest.mark.parametrize('backend', ['diskstorage', 'ramstorage'])
+def test_retention_batches(backend, diskpath):
+    args = ['--retention', 'prefix=/string/', '--retention', 'prefix=/binary/',
+            '--gc-interval', '0']
+    if backend == 'diskstorage':
+        store = open_diskstorage(diskpath, *args)
+    else:
+        store = RAMStorage(storage_options(RAMStorage, args))
+    root, _, hashed = make_descriptors()
+    strings = [root.spawn_descriptor('/string/ascii', 'value %d' % i,
+                                     'strings') for i in range(5)]
+    for desc in [root, hashed] + strings:
+        store.add(desc)
+    described = []
+    describe = store._describe
+    store._describe = lambda *args: described.append(args) or describe(*args)
+    if backend == 'diskstorage':
+        catalogs = []
+        write_catalog = store._write_catalog
+        store._write_catalog = lambda: catalogs.append(1) or write_catalog()
+    # removed two at a time, scanning the store once
+    assert GarbageCollector(store, 0, 2, 0).collect() == 5
+    assert sorted(described) == sorted(
+        [('default', root.selector)] +
+        [('default', desc.selector) for desc in strings])
+    if backend == 'diskstorage':
+        assert catalogs == [1]
+        assert open_diskstorage(diskpath).descriptor_count == 2
+    assert store.collect_garbage(0, resume=True) == 0
+
+
+def test_lineage(store):
+    root, strings, hashed = make_descriptors()
+    grandchild = strings.spawn_descriptor('/string/utf8', 'hello', 'conv')
+    for desc in (root, strings, hashed, grandchild):
+        store.add(desc)
+    assert sorted(store.get_descendants('default', root.selector)) == \
+        sorted([(strings.selector, 1), (hashed.selector, 1),
+                (grandchild.selector, 2)])
+    assert sorted(store.get_descendants('default', root.selector, 1)) == \
+        sorted([(strings.selector, 1), (hashed.selector, 1)])
+    assert list(store.get_ancestors('default', grandchild.selector)) == \
+        [(strings.selector, 1), (root.selector, 2)]
+    assert list(store.get_ancestors('default', root.selector)) == []
+    children = store.get_children('default', root.selector)
+    assert sorted(d.selector for d in children) == \
+        sorted([strings.selector, hashed.selector, grandchild.selector])
+    children = store.get_children('default', root.selector, recurse=False)
+    assert sorted(d.selector for d in children) == \
+        sorted([strings.selector, hashed.selector])
+
+
+def test_processing_depth(store):
+    root = make_descriptors()[0]
+    store.add(root)
+    # /binary/elf -> /string/ascii -> /binary/elf -> ...
+    chain = [root]
+    for i in range(4):
+        selector = '/string/ascii' if i % 2 == 0 else '/binary/elf'
+        chain.append(chain[-1].spawn_descriptor(selector, 'value%d' % i,
+                                                'unpack'))
+        store.add(chain[-1])
+    # /binary/elf found at depths 1 and 3
+    accepted = chain[3].spawn_descriptor('/binary/elf', 'a', 'unpack')
+    assert format_check.processing_depth(store, accepted)
+    # /binary/elf found at depths 0, 2 and 4
+    rejected = chain[4].spawn_descriptor('/binary/elf', 'b', 'unpack')
+    assert not format_check.processing_depth(store, rejected)
+    orphan = accepted.spawn_descriptor('/string/ascii', 'c', 'strings')
+    assert not format_check.processing_depth(store, orphan)
+    assert store.ancestry_summary('default', chain[2].selector) == \
+        (('/binary/elf/', 0b101), ('/string/ascii/', 0b10))